@@ -0,0 +1 @@
+"""Benchmarks of the chat app against local fakes of the model APIs."""
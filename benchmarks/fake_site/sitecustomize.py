@@ -0,0 +1,10 @@
+"""Install the API fakes in every Python process started with this on the path.
+
+``benchmarks.load --serve`` puts this directory on ``PYTHONPATH`` of the
+backend it starts, so the fakes are in place in the Reflex worker processes
+too.
+"""
+
+from benchmarks.fakes import install
+
+install()
@@ -0,0 +1,271 @@
+"""Local stand-ins for the Gemini and Replicate APIs.
+
+``install`` replaces the parts of ``google.generativeai`` and ``replicate``
+that the app calls with deterministic fakes, so the real ``State`` and
+``GeneratorState`` code paths run without network access or API keys:
+
+- ``GenerativeModel.generate_content`` answers text prompts with the
+  app's own ``FakeBackend`` (see ``chat.backend.llm``), so its
+  ``CHAT_FAKE_*`` settings apply, and answers image prompts (those asking for
+  an "Image size: WxH pixels.") with a solid PNG of that size.
+- ``replicate.predictions`` creates predictions that finish after a delay,
+  with a small PNG as output.
+
+The latencies and fault rates of images and predictions are read from the
+environment below. Faults are drawn from seeded random generators, so runs
+are repeatable.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Iterator
+
+from chat.backend.llm import FakeBackend
+from chat.backend.resilience import TransientError
+
+# Seconds to generate an image.
+FAKE_IMAGE_LATENCY = float(os.getenv("CHAT_FAKE_IMAGE_LATENCY", "1"))
+# Seconds for an upscaling prediction to finish.
+FAKE_UPSCALE_LATENCY = float(os.getenv("CHAT_FAKE_UPSCALE_LATENCY", "3"))
+# Share of image calls that fail: Gemini calls with a 503, predictions as
+# failed. Text calls fail at the rate of ``FakeBackend``.
+FAKE_IMAGE_FAILURE_RATE = float(os.getenv("CHAT_FAKE_IMAGE_FAILURE_RATE", "0"))
+# Share of image calls whose latency is ten times longer.
+FAKE_IMAGE_SLOW_RATE = float(os.getenv("CHAT_FAKE_IMAGE_SLOW_RATE", "0"))
+# Seed of the fault injection.
+FAKE_SEED = int(os.getenv("CHAT_FAKE_SEED", "0"))
+
+# Image prompts ask for their size, see ``generation._image_prompts``.
+_IMAGE_SIZE = re.compile(r"Image size: (\d+)x(\d+) pixels\.")
+# Size of the upscaled images; their content does not matter.
+_UPSCALED_SIZE = (64, 64)
+
+
+class _Faults:
+    """Decide which calls fail or are slow."""
+
+    def __init__(self, failure_rate: float, slow_rate: float, seed: int):
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self, latency: float) -> tuple[bool, float]:
+        """Get whether a call fails and its latency."""
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+            slow = self._random.random() < self.slow_rate
+        return failed, latency * 10 if slow else latency
+
+
+_faults = _Faults(FAKE_IMAGE_FAILURE_RATE, FAKE_IMAGE_SLOW_RATE, FAKE_SEED)
+# Answers the text prompts.
+_text = FakeBackend(seed=FAKE_SEED)
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+def _png(size: tuple[int, int], seed: str) -> bytes:
+    """Encode a solid image whose color depends on the seed."""
+    from PIL import Image
+
+    color = tuple(_digest(seed)[:3])
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _service_unavailable() -> Exception:
+    from google.api_core import exceptions
+
+    return exceptions.ServiceUnavailable("Injected failure")
+
+
+class FakeGenerativeModel:
+    """A stand-in for ``google.generativeai.GenerativeModel``."""
+
+    def __init__(self, model_name: str = "gemini-2.0-flash", **kwargs):
+        """Create the model.
+
+        Args:
+            model_name: The model name, mixed into the answers.
+            **kwargs: Ignored model settings.
+        """
+        self.model_name = model_name
+        self._client = None
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        """Answer a prompt.
+
+        Args:
+            contents: The prompt.
+            stream: Whether to return the answer chunk by chunk.
+            **kwargs: Ignored generation settings.
+
+        Returns:
+            A response with ``text`` and ``candidates``, or an iterator of
+            chunks with ``text`` when streaming.
+
+        Raises:
+            ServiceUnavailable: If a failure is injected.
+        """
+        prompt = contents if isinstance(contents, str) else str(contents)
+        size = _IMAGE_SIZE.search(prompt)
+        if size:
+            return self._image(prompt, (int(size[1]), int(size[2])))
+        if stream:
+            return self._stream(prompt)
+        try:
+            text = _text.generate(self.model_name, prompt)
+        except TransientError:
+            raise _service_unavailable() from None
+        return SimpleNamespace(text=text, candidates=[])
+
+    def count_tokens(self, contents):
+        """Estimate the tokens of a prompt, at four characters per token."""
+        return SimpleNamespace(total_tokens=len(str(contents)) // 4)
+
+    def _stream(self, prompt: str) -> Iterator[SimpleNamespace]:
+        try:
+            for chunk in _text.stream(self.model_name, prompt):
+                yield SimpleNamespace(text=chunk)
+        except TransientError:
+            # The SDK fails with the API's error, not the app's.
+            raise _service_unavailable() from None
+
+    def _image(self, prompt: str, size: tuple[int, int]) -> SimpleNamespace:
+        failed, latency = _faults.draw(FAKE_IMAGE_LATENCY)
+        time.sleep(latency)
+        if failed:
+            raise _service_unavailable()
+        part = SimpleNamespace(
+            inline_data=SimpleNamespace(data=_png(size, prompt), mime_type="image/png")
+        )
+        candidate = SimpleNamespace(content=SimpleNamespace(parts=[part]))
+        return SimpleNamespace(candidates=[candidate])
+
+
+@dataclass
+class FakePrediction:
+    """A stand-in for ``replicate.prediction.Prediction``."""
+
+    id: str
+    status: str = "starting"
+    output: list[str] | None = None
+    error: str | None = None
+    # When the prediction finishes, and whether it then fails.
+    finishes_at: float = field(default=0.0, repr=False)
+    fails: bool = field(default=False, repr=False)
+
+
+class FakePredictions:
+    """A stand-in for ``replicate.predictions``."""
+
+    def __init__(self, latency: float = FAKE_UPSCALE_LATENCY):
+        """Create the predictions API.
+
+        Args:
+            latency: Seconds for a prediction to finish.
+        """
+        self.latency = latency
+        self._predictions: dict[str, FakePrediction] = {}
+        self._lock = threading.Lock()
+
+    async def async_create(self, version=None, input=None, **kwargs):
+        """Start a prediction.
+
+        Args:
+            version: Ignored model version.
+            input: Ignored model input.
+            **kwargs: Ignored settings, e.g. the webhook.
+
+        Returns:
+            The starting prediction.
+        """
+        failed, latency = _faults.draw(self.latency)
+        prediction = FakePrediction(
+            id=uuid.uuid4().hex,
+            finishes_at=time.monotonic() + latency,
+            fails=failed,
+        )
+        with self._lock:
+            self._predictions[prediction.id] = prediction
+        return FakePrediction(prediction.id)
+
+    async def async_get(self, id: str) -> FakePrediction:
+        """Get the current state of a prediction.
+
+        Args:
+            id: The prediction id.
+
+        Returns:
+            A snapshot of the prediction.
+        """
+        return self.get(id)
+
+    def get(self, id: str) -> FakePrediction:
+        """Get the current state of a prediction.
+
+        Args:
+            id: The prediction id.
+
+        Returns:
+            A snapshot of the prediction.
+        """
+        with self._lock:
+            prediction = self._predictions[id]
+            if prediction.status in ("starting", "processing"):
+                if time.monotonic() < prediction.finishes_at:
+                    prediction.status = "processing"
+                elif prediction.fails:
+                    prediction.status, prediction.error = "failed", "Injected failure"
+                else:
+                    prediction.status = "succeeded"
+                    data = base64.b64encode(_png(_UPSCALED_SIZE, id)).decode()
+                    prediction.output = [f"data:image/png;base64,{data}"]
+            if prediction.status != "processing":
+                # Finished predictions are not polled again.
+                self._predictions.pop(id, None)
+            return FakePrediction(
+                prediction.id, prediction.status, prediction.output, prediction.error
+            )
+
+    def cancel(self, id: str) -> FakePrediction:
+        """Cancel a prediction.
+
+        Args:
+            id: The prediction id.
+
+        Returns:
+            The canceled prediction.
+        """
+        with self._lock:
+            self._predictions.pop(id, None)
+        return FakePrediction(id, "canceled")
+
+    async def async_cancel(self, id: str) -> FakePrediction:
+        """Cancel a prediction, see ``cancel``."""
+        return self.cancel(id)
+
+
+def install():
+    """Replace the Gemini and Replicate APIs with the fakes in this process."""
+    import google.generativeai as genai
+    import replicate
+    from google.generativeai import client
+
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    client._client_manager.make_client = lambda name: None
+    replicate.predictions = FakePredictions()
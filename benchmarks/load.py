@@ -0,0 +1,570 @@
+"""Drive simulated clients through the app and report latency and memory.
+
+Each client opens a websocket to the Reflex backend like a browser tab,
+hydrates its state, then repeatedly runs the selected scenarios:
+
+- ``chat``: ask a question (``State.process_question``).
+- ``data``: load a CSV file (``State.load_data``).
+- ``image``: generate an image (``GeneratorState.generate_image``).
+- ``upscale``: upscale the generated image (``GeneratorState.upscale_image``).
+
+A scenario ends when the state flag it sets while busy (e.g. ``processing``)
+goes back to false. It fails if it times out, or if the state then shows an
+error (e.g. an answer starting with "❌") or no result. The report has the
+p50/p95/p99 latency and throughput of each scenario, the time to the first
+visible update (first streamed chunk, first image, data preview), and the
+memory of the backend per session.
+
+With ``--serve`` the backend is started here with the Gemini and Replicate
+APIs replaced by the fakes in ``benchmarks/fakes.py``, so no keys or network
+are needed and results are repeatable. Their latency and fault rates are set
+with the ``CHAT_FAKE_*`` variables. Run from the repository root::
+
+    python -m benchmarks.load --serve --clients 20 --iterations 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Callable
+
+import httpx
+import numpy as np
+import pandas as pd
+import psutil
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SITE = os.path.join(ROOT, "benchmarks", "fake_site")
+
+# The websocket path and namespace of Reflex events.
+EVENT_PATH = "/_event"
+
+# Full names of the app's states, as used in event names and deltas.
+ROOT_STATE = "reflex___state____state"
+CHAT_STATE = f"{ROOT_STATE}.chat___state____state"
+GENERATOR_STATE = f"{ROOT_STATE}.chat___backend___generation____generator_state"
+OPTIONS_STATE = f"{ROOT_STATE}.chat___backend___options____options_state"
+ON_LOAD_STATE = f"{ROOT_STATE}.reflex___state____on_load_internal_state"
+
+SCENARIOS = ("chat", "data", "image", "upscale")
+
+# Words the questions and image prompts are made of.
+_WORDS = (
+    "average revenue region trend month customer order growth forecast "
+    "outlier price segment summary compare product city weekly total churn"
+).split()
+
+
+@dataclass
+class Sample:
+    """One run of a scenario."""
+
+    seconds: float
+    # Seconds to the first visible update, if the scenario has one.
+    first: float | None = None
+    error: str | None = None
+
+
+@dataclass
+class Report:
+    """The results of a benchmark run."""
+
+    clients: int
+    iterations: int
+    seconds: float
+    scenarios: dict[str, dict] = field(default_factory=dict)
+    memory: dict[str, float] = field(default_factory=dict)
+
+
+class Session:
+    """A simulated browser tab connected to the backend."""
+
+    def __init__(self, url: str, timeout: float):
+        """Create the session.
+
+        Args:
+            url: The backend URL.
+            timeout: Seconds a scenario may take before it counts as failed.
+        """
+        self.url = url
+        self.timeout = timeout
+        self.token = str(uuid.uuid4())
+        self.state: dict[str, dict] = {}
+        self._sio = socketio.AsyncClient(reconnection=False)
+        self._sio.on("event", self._on_update, namespace=EVENT_PATH)
+        self._hydrated: asyncio.Event | None = None
+        # The scenario being run: the busy flag, the var of its first
+        # visible update, and when each was seen.
+        self._busy: tuple[str, str] | None = None
+        self._progress: tuple[str, str] | None = None
+        self._was_busy = False
+        self._first: float | None = None
+        self._done: asyncio.Future | None = None
+
+    async def connect(self):
+        """Open the websocket and hydrate the state, like a page load."""
+        self._hydrated = asyncio.Event()
+        await self._sio.connect(
+            self.url,
+            namespaces=[EVENT_PATH],
+            socketio_path=EVENT_PATH,
+            transports=["websocket"],
+        )
+        await self._emit(f"{ROOT_STATE}.hydrate")
+        # Runs the page's on_load handlers, then sets is_hydrated.
+        await self._emit(f"{ON_LOAD_STATE}.on_load_internal")
+        await asyncio.wait_for(self._hydrated.wait(), self.timeout)
+
+    async def close(self):
+        """Close the websocket."""
+        await self._sio.disconnect()
+
+    async def set(self, state: str, var: str, value):
+        """Set a var through its setter, like an input does."""
+        await self._emit(f"{state}.set_{var}", value=value)
+
+    async def run(
+        self,
+        state: str,
+        handler: str,
+        busy: str,
+        progress: str | None = None,
+        check: Callable[[dict], bool] | None = None,
+        **payload,
+    ) -> Sample:
+        """Run an event handler and wait for it to finish.
+
+        Args:
+            state: The state of the handler.
+            handler: The handler name.
+            busy: The var that is true while the handler runs.
+            progress: The var whose first change is the first visible update.
+            check: Whether the vars of the state show a success, once done.
+            **payload: The arguments of the handler.
+
+        Returns:
+            The timing of the run.
+        """
+        loop = asyncio.get_running_loop()
+        self._busy = (state, busy)
+        self._progress = (state, progress) if progress else None
+        self._was_busy, self._first = False, None
+        self._done = loop.create_future()
+        started = time.perf_counter()
+        try:
+            await self._emit(f"{state}.{handler}", **payload)
+            await asyncio.wait_for(self._done, self.timeout)
+        except Exception as e:
+            return Sample(time.perf_counter() - started, error=type(e).__name__)
+        finally:
+            self._busy = self._progress = None
+        seconds = time.perf_counter() - started
+        first = self._first - started if self._first is not None else None
+        if check and not check(self.state.get(state, {})):
+            return Sample(seconds, first, error="Failed")
+        return Sample(seconds, first)
+
+    async def _emit(self, name: str, **payload):
+        await self._sio.emit(
+            "event",
+            {
+                "token": self.token,
+                "name": name,
+                "payload": payload,
+                "router_data": {"pathname": "/", "query": {}, "asPath": "/"},
+            },
+            namespace=EVENT_PATH,
+        )
+
+    async def _on_update(self, update: dict):
+        now = time.perf_counter()
+        for name, delta in update.get("delta", {}).items():
+            self.state.setdefault(name, {}).update(delta)
+            if self._progress and self._first is None:
+                state, var = self._progress
+                if name == state and delta.get(var):
+                    self._first = now
+            if self._busy and name == self._busy[0] and self._busy[1] in delta:
+                if delta[self._busy[1]]:
+                    self._was_busy = True
+                elif self._was_busy and not self._done.done():
+                    self._done.set_result(None)
+        if self.state.get(ROOT_STATE, {}).get("is_hydrated"):
+            self._hydrated.set()
+        # Run the events chained by the backend, e.g. the page's on_load, like
+        # the browser does. Names starting with "_" are browser actions.
+        for event in update.get("events", []):
+            if not event["name"].startswith("_"):
+                await self._emit(event["name"], **event.get("payload", {}))
+
+
+async def run_client(
+    session: Session,
+    scenarios: list[str],
+    iterations: int,
+    data_path: str,
+    seed: int,
+    samples: dict[str, list[Sample]],
+):
+    """Run the scenarios of one client.
+
+    Args:
+        session: The connected session.
+        scenarios: The scenarios to run, in order, every iteration.
+        iterations: The number of times to run them.
+        data_path: The CSV file the ``data`` scenario loads.
+        seed: Seed of the questions and prompts.
+        samples: Collects the samples of each scenario.
+    """
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        for scenario in scenarios:
+            samples[scenario].append(await _run(session, scenario, data_path, rng))
+
+
+async def _run(
+    session: Session, scenario: str, data_path: str, rng: random.Random
+) -> Sample:
+    if scenario == "chat":
+        question = " ".join(rng.choices(_WORDS, k=6)) + "?"
+        return await session.run(
+            CHAT_STATE,
+            "process_question",
+            busy="processing",
+            progress="streaming_answer",
+            check=_answered("❌"),
+            form_data={"question": question},
+        )
+    if scenario == "data":
+        await session.set(CHAT_STATE, "data_path", data_path)
+        return await session.run(
+            CHAT_STATE,
+            "load_data",
+            busy="loading",
+            progress="columns",
+            check=_answered("❌", "⏹️"),
+        )
+    if scenario == "image":
+        await session.set(OPTIONS_STATE, "prompt", " ".join(rng.choices(_WORDS, k=5)))
+        return await session.run(
+            GENERATOR_STATE,
+            "generate_image",
+            busy="is_generating",
+            progress="output_list",
+            check=lambda state: bool(state.get("output_list")),
+        )
+    generator = session.state.get(GENERATOR_STATE, {})
+    if generator.get("upscaled_image") or not generator.get("output_list"):
+        # Upscaling needs a new image.
+        await _run(session, "image", data_path, rng)
+    return await session.run(
+        GENERATOR_STATE,
+        "upscale_image",
+        busy="is_upscaling",
+        check=lambda state: bool(state.get("upscaled_image")),
+    )
+
+
+def _answered(*errors: str) -> Callable[[dict], bool]:
+    """Check that the last message of the chat is not an error."""
+
+    def check(state: dict) -> bool:
+        messages = state.get("messages") or [{}]
+        answer = messages[-1].get("answer_html", "").removeprefix("<p>")
+        return not answer.startswith(errors)
+
+    return check
+
+
+def make_dataset(path: str, rows: int, seed: int = 0):
+    """Write a CSV file of random sales data.
+
+    Args:
+        path: The file to write.
+        rows: The number of rows.
+        seed: Seed of the random values.
+    """
+    rng = np.random.default_rng(seed)
+    pd.DataFrame(
+        {
+            "order_id": np.arange(rows),
+            "date": pd.Timestamp("2024-01-01")
+            + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+            "region": rng.choice(["north", "south", "east", "west"], rows),
+            "product": rng.choice([f"product-{i}" for i in range(50)], rows),
+            "quantity": rng.integers(1, 20, rows),
+            "price": rng.gamma(2.0, 30.0, rows).round(2),
+        }
+    ).to_csv(path, index=False)
+
+
+def serve(port: int, workdir: str) -> subprocess.Popen:
+    """Start the backend with the API fakes installed.
+
+    Args:
+        port: The backend port.
+        workdir: Directory for the database and caches of the run.
+
+    Returns:
+        The backend process, the leader of its own process group.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [FAKE_SITE, ROOT, *filter(None, [env.get("PYTHONPATH")])]
+    )
+    # The fakes accept any key; real keys are never used.
+    env.update(
+        GEMINI_API_KEY="benchmark",
+        REPLICATE_API_TOKEN="benchmark",
+        CHAT_LLM_BACKEND="gemini",
+    )
+    # Keep the run's data out of the user's database and caches.
+    env.setdefault("DB_URL", f"sqlite:///{os.path.join(workdir, 'chat.db')}")
+    for name in ("BLOB", "DOWNLOAD_CACHE", "DATASET_CACHE", "DATASET_SPILL"):
+        env.setdefault(f"CHAT_{name}_DIR", os.path.join(workdir, name.lower()))
+    return subprocess.Popen(
+        [sys.executable, "-m", "reflex", "run", "--backend-only"]
+        + ["--backend-port", str(port), "--loglevel", "warning"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+async def wait_ready(url: str, timeout: float = 180):
+    """Wait until the backend answers pings.
+
+    Args:
+        url: The backend URL.
+        timeout: Seconds to wait.
+
+    Raises:
+        TimeoutError: If the backend did not start in time.
+    """
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(f"{url}/ping")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(1)
+    raise TimeoutError(f"The backend at {url} did not start")
+
+
+def rss(pid: int) -> int:
+    """Get the resident memory of a process and its children, in bytes."""
+    process = psutil.Process(pid)
+    total = 0
+    for member in [process, *process.children(recursive=True)]:
+        try:
+            total += member.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def summarize(samples: list[Sample], seconds: float) -> dict:
+    """Get the percentiles and throughput of a scenario.
+
+    Args:
+        samples: The runs of the scenario.
+        seconds: The wall time of the benchmark.
+
+    Returns:
+        The summary, with latencies in seconds.
+    """
+    ok = [sample for sample in samples if sample.error is None]
+    summary = {
+        "runs": len(samples),
+        "errors": len(samples) - len(ok),
+        "throughput": len(ok) / seconds if seconds else 0.0,
+    }
+    for key, values in (
+        ("latency", [sample.seconds for sample in ok]),
+        ("first", [sample.first for sample in ok if sample.first is not None]),
+    ):
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[key] = {"p50": p50, "p95": p95, "p99": p99}
+    return summary
+
+
+async def benchmark(args: argparse.Namespace, pid: int | None) -> Report:
+    """Run the benchmark against a running backend.
+
+    Args:
+        args: The command line arguments.
+        pid: The backend process to measure the memory of, if known.
+
+    Returns:
+        The report.
+    """
+    memory: dict[str, float] = {}
+    if pid:
+        memory["baseline_mb"] = rss(pid) / 2**20
+
+    sessions = [Session(args.url, args.timeout) for _ in range(args.clients)]
+    await asyncio.gather(*(session.connect() for session in sessions))
+    if pid:
+        memory["connected_mb"] = rss(pid) / 2**20
+
+    peak = 0
+    sampling = True
+
+    async def sample_memory():
+        nonlocal peak
+        while sampling:
+            peak = max(peak, rss(pid))
+            await asyncio.sleep(0.5)
+
+    sampler = asyncio.create_task(sample_memory()) if pid else None
+    samples: dict[str, list[Sample]] = {scenario: [] for scenario in args.scenarios}
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            run_client(
+                session,
+                args.scenarios,
+                args.iterations,
+                args.data,
+                args.seed + index,
+                samples,
+            )
+            for index, session in enumerate(sessions)
+        )
+    )
+    seconds = time.perf_counter() - started
+    sampling = False
+    if sampler:
+        await sampler
+        memory["peak_mb"] = peak / 2**20
+        memory["end_mb"] = rss(pid) / 2**20
+        memory["per_session_mb"] = (
+            memory["end_mb"] - memory["baseline_mb"]
+        ) / args.clients
+    await asyncio.gather(*(session.close() for session in sessions))
+
+    report = Report(args.clients, args.iterations, seconds, memory=memory)
+    for scenario, runs in samples.items():
+        report.scenarios[scenario] = summarize(runs, seconds)
+    return report
+
+
+def print_report(report: Report):
+    """Print a report as a table, with latencies in milliseconds."""
+    print(
+        f"\n{report.clients} clients x {report.iterations} iterations "
+        f"in {report.seconds:.1f}s\n"
+    )
+    columns = ("runs", "errors", "ops/s", "p50", "p95", "p99", "first p50", "first p95")
+    print(f"{'scenario':<9}" + "".join(f"{column:>10}" for column in columns))
+    for scenario, summary in report.scenarios.items():
+        cells = [
+            summary["runs"],
+            summary["errors"],
+            f"{summary['throughput']:.2f}",
+            *(_ms(summary, "latency", p) for p in ("p50", "p95", "p99")),
+            *(_ms(summary, "first", p) for p in ("p50", "p95")),
+        ]
+        print(f"{scenario:<9}" + "".join(f"{cell:>10}" for cell in cells))
+    if report.memory:
+        print(
+            "\nBackend memory: "
+            + ", ".join(
+                f"{key.removesuffix('_mb')} {value:.1f} MB"
+                for key, value in report.memory.items()
+            )
+        )
+
+
+def _ms(summary: dict, key: str, percentile: str) -> str:
+    value = summary.get(key, {}).get(percentile)
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    """Parse the command line.
+
+    Args:
+        argv: The arguments, from ``sys.argv`` by default.
+
+    Returns:
+        The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="", help="Backend URL of a running app.")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Start the backend with fake Gemini and Replicate APIs.",
+    )
+    parser.add_argument("--port", type=int, default=8010, help="Port for --serve.")
+    parser.add_argument("--pid", type=int, help="Backend process to measure.")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"Comma separated, from: {', '.join(SCENARIOS)}.",
+    )
+    parser.add_argument("--data", default="", help="CSV file to load.")
+    parser.add_argument(
+        "--rows", type=int, default=100_000, help="Rows of the generated CSV file."
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120, help="Seconds per scenario run."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default="", help="Also write the report here.")
+    args = parser.parse_args(argv)
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if not args.serve and not args.url:
+        parser.error("Pass --url of a running backend, or --serve")
+    return args
+
+
+def main(argv: list[str] | None = None):
+    """Run the benchmark from the command line."""
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="chat-benchmark-") as workdir:
+        if not args.data:
+            args.data = os.path.join(workdir, "sales.csv")
+            make_dataset(args.data, args.rows, args.seed)
+        server = None
+        pid = args.pid
+        if args.serve:
+            args.url = f"http://localhost:{args.port}"
+            server = serve(args.port, workdir)
+            pid = server.pid
+        try:
+            if server:
+                asyncio.run(wait_ready(args.url))
+            report = asyncio.run(benchmark(args, pid))
+        finally:
+            if server:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait(30)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(asdict(report), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""HTTP endpoints served next to the Reflex app.
+
+The routes are mounted in front of the Reflex backend through the app's
+``api_transformer``.
+"""
+
+import json
+import logging
+import os
+
+import httpx
+import replicate
+from replicate.webhook import WebhookSigningSecret, WebhookValidationError
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from .blobs import BLOB_ROUTE, CONTENT_TYPES, NAME_PATTERN, blob_name, blob_store
+from .downloads import (
+    DOWNLOAD_ROUTE,
+    content_disposition,
+    download_cache,
+    is_allowed,
+)
+from .metrics import metrics
+from .predictions import WEBHOOK_SECRET, prediction_watcher
+
+logger = logging.getLogger(__name__)
+
+
+async def replicate_webhook(request: Request) -> Response:
+    """Receive a prediction update from Replicate.
+
+    Args:
+        request: The webhook request.
+
+    Returns:
+        An empty response.
+    """
+    body = await request.body()
+    try:
+        data = json.loads(body)
+        prediction_id = data["id"]
+        status = data["status"]
+    except (ValueError, KeyError, TypeError):
+        return Response(status_code=400)
+    if not isinstance(prediction_id, str) or not isinstance(status, str):
+        return Response(status_code=400)
+
+    if not WEBHOOK_SECRET:
+        # The body cannot be trusted: fetch the prediction from the API instead.
+        prediction_watcher.poke(prediction_id)
+        return Response(status_code=204)
+    try:
+        replicate.webhooks.validate(
+            headers=dict(request.headers),
+            body=body.decode(),
+            secret=WebhookSigningSecret(key=WEBHOOK_SECRET),
+            tolerance=300,
+        )
+    except WebhookValidationError as e:
+        logger.warning("Rejected Replicate webhook: %s", e)
+        return Response(status_code=401)
+    prediction_watcher.notify(data)
+    return Response(status_code=204)
+
+
+async def get_blob(request: Request) -> Response:
+    """Serve a file from the blob store.
+
+    A blob name is the hash of its content, so responses are cached for good.
+
+    Args:
+        request: The request.
+
+    Returns:
+        The file, or an empty response if the client has it already.
+    """
+    name = request.path_params["name"]
+    if not NAME_PATTERN.match(name):
+        return Response(status_code=404)
+    etag = f'"{name.split(".")[0]}"'
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": etag,
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    path = blob_store.path(name)
+    if not os.path.exists(path):
+        return Response(status_code=404)
+    return FileResponse(
+        path, media_type=CONTENT_TYPES[name.rsplit(".", 1)[1]], headers=headers
+    )
+
+
+async def download(request: Request) -> Response:
+    """Download an image as a file.
+
+    Stored images are served from the blob store. Remote images are streamed
+    from the upstream and cached, or served from the cache.
+
+    Args:
+        request: The request, with the ``url`` of the image and the
+            ``filename`` to save it as.
+
+    Returns:
+        The image as an attachment.
+    """
+    url = request.query_params.get("url", "")
+    filename = request.query_params.get("filename") or "image.png"
+    headers = {"Content-Disposition": content_disposition(filename)}
+
+    name = blob_name(url)
+    if name is not None:
+        path = blob_store.path(name)
+        if not os.path.exists(path):
+            return Response(status_code=404)
+        media_type = CONTENT_TYPES[name.rsplit(".", 1)[1]]
+        return FileResponse(path, media_type=media_type, headers=headers)
+    if not is_allowed(url):
+        return Response(status_code=400)
+
+    path = download_cache.cached(url)
+    if path is not None:
+        return FileResponse(path, media_type="image/png", headers=headers)
+    try:
+        upstream = await download_cache.open(url)
+    except httpx.HTTPError as e:
+        logger.warning("Could not download %s: %s", url, e)
+        return Response(status_code=502)
+    for header in ("Content-Type", "Content-Length"):
+        if header in upstream.headers:
+            headers[header] = upstream.headers[header]
+    return StreamingResponse(download_cache.relay(url, upstream), headers=headers)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Serve the metrics in the Prometheus text format.
+
+    Args:
+        request: The scrape request.
+
+    Returns:
+        The metrics.
+    """
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+api = Starlette(
+    routes=[
+        Route("/replicate/webhook", replicate_webhook, methods=["POST"]),
+        Route(f"{BLOB_ROUTE}/{{name}}", get_blob, methods=["GET", "HEAD"]),
+        Route(DOWNLOAD_ROUTE, download, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+    ]
+)
@@ -0,0 +1,185 @@
+"""Content-addressed store of generated files.
+
+Generated images are written here once, named by the SHA-256 of their
+content, and served over HTTP by ``api.py`` with long-lived cache headers
+(a name never changes content). State only holds the URL, instead of
+megabytes of base64 that would be serialized and sent with every update.
+
+Thumbnails for previews are made on demand and stored next to the original.
+The least recently used files are evicted when the store grows past its size
+limit.
+"""
+
+import hashlib
+import io
+import os
+import re
+import uuid
+
+from PIL import Image
+from reflex.config import get_config
+
+# Where the files are written.
+BLOB_DIR = os.getenv(
+    "CHAT_BLOB_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reflex-chat", "blobs"),
+)
+# Total size of the stored files.
+BLOB_STORE_LIMIT = int(os.getenv("CHAT_BLOB_STORE_MB", "2048")) * 2**20
+# Longest side of a thumbnail in pixels.
+THUMBNAIL_SIZE = 256
+
+# The path the files are served under.
+BLOB_ROUTE = "/blobs"
+
+_EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+CONTENT_TYPES = {extension: kind for kind, extension in _EXTENSIONS.items()}
+# A blob name: the content hash, a thumbnail size for thumbnails, an extension.
+NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(_\d+)?\.(png|jpg|webp|gif)$")
+
+
+class BlobStore:
+    """A size-bounded, content-addressed directory of files."""
+
+    def __init__(self, directory: str = BLOB_DIR, limit: int = BLOB_STORE_LIMIT):
+        """Create the store.
+
+        Args:
+            directory: Where the files are written.
+            limit: Total size of the stored files in bytes.
+        """
+        self.directory = directory
+        self.limit = limit
+
+    def put(self, data: bytes, content_type: str = "image/png") -> str:
+        """Store a file, unless the same content is stored already.
+
+        Args:
+            data: The file content.
+            content_type: The MIME type of the content.
+
+        Returns:
+            The name of the stored file.
+        """
+        extension = _EXTENSIONS.get(content_type, "png")
+        name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        path = self.path(name)
+        if os.path.exists(path):
+            os.utime(path)
+            return name
+        self._write(path, data)
+        self.evict()
+        return name
+
+    def thumbnail(self, name: str, size: int = THUMBNAIL_SIZE) -> str:
+        """Get a thumbnail of a stored image, making it if needed.
+
+        Args:
+            name: The name of the stored image.
+            size: The longest side of the thumbnail in pixels.
+
+        Returns:
+            The name of the thumbnail.
+        """
+        key = name.split(".")[0]
+        thumbnail_name = f"{key}_{size}.webp"
+        path = self.path(thumbnail_name)
+        if os.path.exists(path):
+            return thumbnail_name
+        with Image.open(self.path(name)) as image:
+            image.thumbnail((size, size))
+            buffer = io.BytesIO()
+            image.save(buffer, format="WEBP", quality=80)
+        self._write(path, buffer.getvalue())
+        return thumbnail_name
+
+    def path(self, name: str) -> str:
+        """Get the path of a stored file.
+
+        Args:
+            name: The name of the file.
+
+        Returns:
+            The file path.
+
+        Raises:
+            ValueError: If the name is not a blob name.
+        """
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid blob name: {name}")
+        return os.path.join(self.directory, name[:2], name)
+
+    def read(self, name: str) -> bytes:
+        """Read a stored file.
+
+        Args:
+            name: The name of the file.
+
+        Returns:
+            The file content.
+        """
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def evict(self):
+        """Remove the least recently used files beyond the size limit."""
+        entries = []
+        try:
+            for shard in os.scandir(self.directory):
+                if shard.is_dir():
+                    entries.extend(entry for entry in os.scandir(shard.path))
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.limit:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def blob_url(name: str) -> str:
+    """Get the URL a stored file is served at.
+
+    Args:
+        name: The name of the file.
+
+    Returns:
+        The absolute URL on the backend server.
+    """
+    return f"{get_config().api_url}{BLOB_ROUTE}/{name}"
+
+
+def blob_name(url: str) -> str | None:
+    """Get the name of a stored file from its URL.
+
+    Args:
+        url: A URL, which may or may not point into the store.
+
+    Returns:
+        The name of the file, or None if the URL is not a blob URL.
+    """
+    prefix = f"{get_config().api_url}{BLOB_ROUTE}/"
+    if url.startswith(prefix) and NAME_PATTERN.match(url[len(prefix) :]):
+        return url[len(prefix) :]
+    return None
+
+
+# The store shared by all sessions of this process.
+blob_store = BlobStore()
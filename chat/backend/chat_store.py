@@ -0,0 +1,247 @@
+"""Persistent chat history.
+
+Chats and their messages are stored in the app database (SQLite by default,
+see ``db_url`` in rxconfig.py) instead of the session state, so they survive
+restarts and only the parts a client looks at are loaded: the sidebar reads
+chat titles only, and messages are read a page at a time, newest first.
+Messages are indexed on (user, chat, created_at) for these reads.
+"""
+
+import asyncio
+import os
+import time
+
+import reflex as rx
+import sqlalchemy
+from sqlmodel import delete, select
+
+# Number of messages loaded at a time when a chat is opened or scrolled back.
+HISTORY_PAGE_SIZE = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+
+
+class ChatRecord(rx.Model, table=True):
+    """A chat of a user."""
+
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint("user", "title", name="uq_chatrecord_user_title"),
+    )
+
+    user: str
+    title: str
+    created_at: float
+
+
+class MessageRecord(rx.Model, table=True):
+    """A question and its answer in a chat."""
+
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_messagerecord_user_chat_created_at", "user", "chat", "created_at"
+        ),
+    )
+
+    user: str
+    chat: str
+    question: str
+    answer: str
+    created_at: float
+
+
+class ChatStore:
+    """Read and write chats and messages in the app database."""
+
+    def titles(self, user: str) -> list[str]:
+        """Get the titles of a user's chats.
+
+        Args:
+            user: The user id.
+
+        Returns:
+            The titles, oldest chat first.
+        """
+        with rx.session() as session:
+            return list(
+                session.exec(
+                    select(ChatRecord.title)
+                    .where(ChatRecord.user == user)
+                    .order_by(ChatRecord.created_at, ChatRecord.id)
+                )
+            )
+
+    def create_chat(self, user: str, title: str):
+        """Create a chat, unless the user already has one with that title.
+
+        Args:
+            user: The user id.
+            title: The chat title.
+        """
+        with rx.session() as session:
+            exists = session.exec(
+                select(ChatRecord.id).where(
+                    ChatRecord.user == user, ChatRecord.title == title
+                )
+            ).first()
+            if exists is None:
+                session.add(ChatRecord(user=user, title=title, created_at=time.time()))
+                session.commit()
+
+    def delete_chat(self, user: str, title: str):
+        """Delete a chat and its messages.
+
+        Args:
+            user: The user id.
+            title: The chat title.
+        """
+        with rx.session() as session:
+            session.exec(
+                delete(MessageRecord).where(
+                    MessageRecord.user == user, MessageRecord.chat == title
+                )
+            )
+            session.exec(
+                delete(ChatRecord).where(
+                    ChatRecord.user == user, ChatRecord.title == title
+                )
+            )
+            session.commit()
+
+    def messages(
+        self,
+        user: str,
+        chat: str,
+        before: int | None = None,
+        limit: int = HISTORY_PAGE_SIZE,
+    ) -> list[MessageRecord]:
+        """Get a page of messages of a chat.
+
+        Args:
+            user: The user id.
+            chat: The chat title.
+            before: The id of the oldest message already loaded; only older
+                messages are returned. None for the newest page.
+            limit: Maximum number of messages.
+
+        Returns:
+            The newest messages before the given one, oldest first.
+        """
+        query = select(MessageRecord).where(
+            MessageRecord.user == user, MessageRecord.chat == chat
+        )
+        with rx.session() as session:
+            if before is not None:
+                anchor = session.get(MessageRecord, before)
+                if anchor is None:
+                    return []
+                query = query.where(
+                    (MessageRecord.created_at < anchor.created_at)
+                    | (
+                        (MessageRecord.created_at == anchor.created_at)
+                        & (MessageRecord.id < anchor.id)
+                    )
+                )
+            query = query.order_by(
+                MessageRecord.created_at.desc(), MessageRecord.id.desc()
+            ).limit(limit)
+            return list(reversed(session.exec(query).all()))
+
+    def newer_messages(
+        self, user: str, chat: str, after: int, limit: int = HISTORY_PAGE_SIZE
+    ) -> list[MessageRecord]:
+        """Get the page of messages of a chat that follows a message.
+
+        Args:
+            user: The user id.
+            chat: The chat title.
+            after: The id of the newest message loaded; only newer messages
+                are returned.
+            limit: Maximum number of messages.
+
+        Returns:
+            The oldest messages after the given one, oldest first.
+        """
+        with rx.session() as session:
+            anchor = session.get(MessageRecord, after)
+            if anchor is None:
+                return []
+            query = (
+                select(MessageRecord)
+                .where(
+                    MessageRecord.user == user,
+                    MessageRecord.chat == chat,
+                    (MessageRecord.created_at > anchor.created_at)
+                    | (
+                        (MessageRecord.created_at == anchor.created_at)
+                        & (MessageRecord.id > anchor.id)
+                    ),
+                )
+                .order_by(MessageRecord.created_at, MessageRecord.id)
+                .limit(limit)
+            )
+            return list(session.exec(query).all())
+
+    def turns(self, user: str, chat: str) -> list[tuple[str, str]]:
+        """Get the text of all questions and answers of a chat.
+
+        Args:
+            user: The user id.
+            chat: The chat title.
+
+        Returns:
+            The (question, answer) turns, oldest first.
+        """
+        with rx.session() as session:
+            rows = session.exec(
+                select(MessageRecord.question, MessageRecord.answer)
+                .where(MessageRecord.user == user, MessageRecord.chat == chat)
+                .order_by(MessageRecord.created_at, MessageRecord.id)
+            )
+            return [(question, answer) for question, answer in rows]
+
+    def add_message(
+        self, user: str, chat: str, question: str, answer: str
+    ) -> MessageRecord:
+        """Add a message to a chat.
+
+        Args:
+            user: The user id.
+            chat: The chat title.
+            question: The question.
+            answer: The answer.
+
+        Returns:
+            The stored message.
+        """
+        record = MessageRecord(
+            user=user,
+            chat=chat,
+            question=question,
+            answer=answer,
+            created_at=time.time(),
+        )
+        with rx.session() as session:
+            session.add(record)
+            session.commit()
+            session.refresh(record)
+        return record
+
+    def set_answer(self, message_id: int, answer: str):
+        """Replace the answer of a message.
+
+        Args:
+            message_id: The message id.
+            answer: The new answer.
+        """
+        with rx.session() as session:
+            record = session.get(MessageRecord, message_id)
+            if record is not None:
+                record.answer = answer
+                session.commit()
+
+
+async def create_tables():
+    """Create the history tables when the app starts, if they do not exist."""
+    await asyncio.to_thread(rx.Model.create_all)
+
+
+# The store shared by all sessions of this process.
+chat_store = ChatStore()
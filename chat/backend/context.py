@@ -0,0 +1,245 @@
+"""Incremental, token-budgeted prompt construction for chats.
+
+The prompt for a chat is the system prompt, the most recent turns that fit in
+the token budget, and the new question. The joined text of the included turns
+is cached per chat, so a new question only has to encode the turns added since
+the last one instead of the whole history.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Sequence
+
+SYSTEM_PROMPT = "You are a friendly chatbot named Reflex."
+
+# Maximum number of (estimated) tokens in a prompt.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "8000"))
+# How to handle turns that no longer fit: "window" drops them, "summary" keeps
+# a short digest of the dropped turns.
+CONTEXT_STRATEGY = os.getenv("CHAT_CONTEXT_STRATEGY", "window")
+# Share of the budget reserved for the digest of dropped turns.
+SUMMARY_BUDGET_RATIO = 0.15
+# When the window slides, drop turns down to this share of the budget so the
+# cached prefix does not have to be rebuilt on every following turn.
+SLIDE_LOW_WATER = 0.8
+# Number of chats whose prefix is kept in memory.
+MAX_CACHED_CHATS = 1024
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text.
+
+    Args:
+        text: The text.
+
+    Returns:
+        The estimated token count, assuming about four characters per token.
+    """
+    return (len(text) + 3) // 4
+
+
+@dataclass
+class PromptMetrics:
+    """Size metrics for a built prompt."""
+
+    prompt_chars: int
+    prompt_tokens: int
+    turns_total: int
+    turns_included: int
+    turns_summarized: int
+    # Whether the cached prefix from the previous prompt was reused.
+    cache_hit: bool
+    build_ms: float
+
+
+@dataclass
+class _Turn:
+    key: int
+    text: str
+    tokens: int
+
+
+@dataclass
+class _ChatContext:
+    turns: list[_Turn] = field(default_factory=list)
+    # Index of the first turn inside the window.
+    start: int = 0
+    # Joined text of the turns inside the window.
+    prefix: str = ""
+    prefix_tokens: int = 0
+    # Digest of the turns before the window, for the "summary" strategy.
+    summary: str = ""
+    # Whether the last extension of the prefix started from a cached one.
+    cache_hit: bool = False
+
+
+class ContextBuilder:
+    """Build prompts from chat history within a token budget."""
+
+    def __init__(
+        self,
+        system_prompt: str = SYSTEM_PROMPT,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        strategy: str = CONTEXT_STRATEGY,
+    ):
+        """Create the builder.
+
+        Args:
+            system_prompt: The text the prompt starts with.
+            token_budget: Maximum number of tokens in a prompt.
+            strategy: "window" or "summary".
+        """
+        if strategy not in ("window", "summary"):
+            raise ValueError(f"Unknown context strategy: {strategy}")
+        self.system_prompt = system_prompt
+        self.token_budget = token_budget
+        self.strategy = strategy
+        self._chats: OrderedDict[str, _ChatContext] = OrderedDict()
+
+    def window(
+        self,
+        key: str,
+        history: Sequence[tuple[str, str]],
+        question: str,
+        reserve: int = 0,
+    ) -> int:
+        """Fit the recent turns of a chat into the budget, ahead of ``build``.
+
+        Args:
+            key: Identifies the chat the prompt is for.
+            history: The earlier (question, answer) turns, oldest first.
+            question: The new question.
+            reserve: Tokens kept free for the context passed to ``build``.
+
+        Returns:
+            The number of old turns left out of the window, e.g. to retrieve
+            snippets of them.
+        """
+        return self._fit(key, history, question, reserve).start
+
+    def build(
+        self,
+        key: str,
+        history: Sequence[tuple[str, str]],
+        question: str,
+        context: str = "",
+        reserve: int = 0,
+    ) -> tuple[str, PromptMetrics]:
+        """Build the prompt for a new question.
+
+        Args:
+            key: Identifies the chat the prompt is for.
+            history: The earlier (question, answer) turns, oldest first.
+            question: The new question.
+            context: Retrieved snippets to put before the recent turns.
+            reserve: Tokens kept free for the context, as given to ``window``.
+                A context that fits in it leaves the window as it was.
+
+        Returns:
+            The prompt text and its size metrics.
+        """
+        started = time.perf_counter()
+        ctx = self._fit(
+            key, history, question, max(reserve, estimate_tokens(context))
+        )
+        parts = [self.system_prompt, ctx.summary, context, ctx.prefix, question]
+        prompt = "\n".join(part for part in parts if part)
+        metrics = PromptMetrics(
+            prompt_chars=len(prompt),
+            prompt_tokens=estimate_tokens(prompt),
+            turns_total=len(ctx.turns),
+            turns_included=len(ctx.turns) - ctx.start,
+            turns_summarized=ctx.start if ctx.summary else 0,
+            cache_hit=ctx.cache_hit,
+            build_ms=(time.perf_counter() - started) * 1000,
+        )
+        return prompt, metrics
+
+    def forget(self, key: str):
+        """Drop the cached prefix of a chat.
+
+        Args:
+            key: Identifies the chat.
+        """
+        self._chats.pop(key, None)
+
+    def _fit(
+        self,
+        key: str,
+        history: Sequence[tuple[str, str]],
+        question: str,
+        reserve: int,
+    ) -> _ChatContext:
+        """Extend the cached window of a chat and slide it to fit the budget."""
+        ctx, cache_hit = self._context(key, history)
+        new_turns = history[len(ctx.turns) :]
+        if new_turns or not cache_hit:
+            # A call that finds the prefix already extended keeps the flag of
+            # the call that extended it.
+            ctx.cache_hit = cache_hit
+
+        for question_, answer in new_turns:
+            text = f"{question_}\n{answer}"
+            turn = _Turn(hash((question_, answer)), text, estimate_tokens(text))
+            ctx.turns.append(turn)
+            ctx.prefix = f"{ctx.prefix}\n{text}" if ctx.prefix else text
+            ctx.prefix_tokens += turn.tokens
+
+        available = (
+            self.token_budget
+            - estimate_tokens(self.system_prompt)
+            - estimate_tokens(question)
+            - reserve
+        )
+        if self.strategy == "summary":
+            available -= int(self.token_budget * SUMMARY_BUDGET_RATIO)
+        if ctx.prefix_tokens > available:
+            self._slide(ctx, int(available * SLIDE_LOW_WATER))
+        return ctx
+
+    def _context(
+        self, key: str, history: Sequence[tuple[str, str]]
+    ) -> tuple[_ChatContext, bool]:
+        """Get the cached context of a chat, if it still matches the history."""
+        ctx = self._chats.get(key)
+        if ctx is not None:
+            self._chats.move_to_end(key)
+            cached = len(ctx.turns)
+            # The history only grows by appending, so comparing the first and
+            # last cached turns is enough to tell whether the prefix is valid.
+            if cached == 0 or (
+                cached <= len(history)
+                and ctx.turns[0].key == hash(tuple(history[0]))
+                and ctx.turns[-1].key == hash(tuple(history[cached - 1]))
+            ):
+                return ctx, cached > 0
+
+        ctx = self._chats[key] = _ChatContext()
+        while len(self._chats) > MAX_CACHED_CHATS:
+            self._chats.popitem(last=False)
+        return ctx, False
+
+    def _slide(self, ctx: _ChatContext, target_tokens: int):
+        """Drop the oldest turns from the window until it fits the target."""
+        while ctx.prefix_tokens > target_tokens and ctx.start < len(ctx.turns):
+            ctx.prefix_tokens -= ctx.turns[ctx.start].tokens
+            ctx.start += 1
+        ctx.prefix = "\n".join(turn.text for turn in ctx.turns[ctx.start :])
+        if self.strategy == "summary":
+            ctx.summary = self._summarize(ctx.turns[: ctx.start])
+
+    def _summarize(self, turns: list[_Turn]) -> str:
+        """Digest dropped turns into a list of the questions asked, newest first."""
+        budget = int(self.token_budget * SUMMARY_BUDGET_RATIO)
+        lines = ["Earlier in this conversation the user asked:"]
+        used = estimate_tokens(lines[0])
+        for turn in reversed(turns):
+            question = turn.text.split("\n", 1)[0]
+            line = f"- {question[:120]}"
+            used += estimate_tokens(line)
+            if used > budget:
+                break
+            lines.append(line)
+        return "\n".join(lines) if len(lines) > 1 else ""
@@ -0,0 +1,191 @@
+"""Content-addressed on-disk cache of parsed CSV and Excel files.
+
+Parsing text formats is the slowest part of loading a dataset, so the first
+load of a CSV/XLSX file also writes the parsed data to an Arrow IPC file keyed
+by the source path, modification time and size. Later loads of the unchanged
+file memory-map the cached copy instead of parsing it again. The least
+recently used entries are evicted when the cache grows past its size limit.
+"""
+
+import hashlib
+import logging
+import os
+import uuid
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+CACHED_EXTENSIONS = (".csv", ".xlsx")
+
+# Where the cached files are written.
+DATASET_CACHE_DIR = os.getenv(
+    "CHAT_DATASET_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reflex-chat", "datasets"),
+)
+# Total size of the cached files.
+DATASET_CACHE_LIMIT = int(os.getenv("CHAT_DATASET_CACHE_MB", "20480")) * 2**20
+
+
+def cache_key(path: str) -> str:
+    """Get the cache key of a source file.
+
+    Args:
+        path: The source file path.
+
+    Returns:
+        A digest of the absolute path, modification time and size.
+    """
+    stat = os.stat(path)
+    source = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+class CacheWriter:
+    """Write a parsed dataset to the cache piece by piece.
+
+    The file is written under a temporary name and only becomes visible to
+    lookups once it is committed. If a piece does not match the schema of the
+    first one (e.g. a column parsed as integers in one chunk and as floats in
+    the next) the entry is abandoned and the load carries on uncached.
+    """
+
+    def __init__(self, cache: "DatasetCache", path: str):
+        self._cache = cache
+        self._path = path
+        self._tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        self._writer: pa.ipc.RecordBatchFileWriter | None = None
+        self._schema: pa.Schema | None = None
+        self._failed = False
+
+    def write(self, df: pd.DataFrame):
+        """Append a piece of the dataset.
+
+        Args:
+            df: The piece.
+        """
+        if self._failed:
+            return
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                self._schema = table.schema
+                self._writer = pa.ipc.new_file(self._tmp_path, self._schema)
+            elif table.schema != self._schema:
+                table = table.cast(self._schema)
+            self._writer.write_table(table)
+        except (pa.ArrowException, OSError) as e:
+            logger.info("Not caching %s: %s", self._path, e)
+            self.abort()
+            self._failed = True
+
+    def commit(self):
+        """Make the written file available to lookups."""
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        os.replace(self._tmp_path, self._path)
+        self._cache.evict()
+
+    def abort(self):
+        """Discard the written file."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class DatasetCache:
+    """A size-bounded directory of Arrow IPC files."""
+
+    def __init__(
+        self, directory: str = DATASET_CACHE_DIR, limit: int = DATASET_CACHE_LIMIT
+    ):
+        """Create the cache.
+
+        Args:
+            directory: Where the cached files are written.
+            limit: Total size of the cached files in bytes.
+        """
+        self.directory = directory
+        self.limit = limit
+
+    def lookup(self, path: str) -> str | None:
+        """Find the cached copy of a source file.
+
+        Args:
+            path: The source file path.
+
+        Returns:
+            The path of the cached copy, or None if it is not cached.
+        """
+        cached = self._entry_path(path)
+        if not os.path.exists(cached):
+            return None
+        # The modification time of an entry records when it was last used.
+        os.utime(cached)
+        return cached
+
+    def writer(self, path: str) -> CacheWriter:
+        """Start caching a source file.
+
+        Args:
+            path: The source file path.
+
+        Returns:
+            A writer for the parsed pieces of the file.
+        """
+        return CacheWriter(self, self._entry_path(path))
+
+    def evict(self):
+        """Remove the least recently used entries beyond the size limit."""
+        try:
+            entries = [
+                entry
+                for entry in os.scandir(self.directory)
+                if entry.name.endswith(".arrow")
+            ]
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.limit:
+                break
+            logger.info("Evicting cached dataset %s", entry.path)
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _entry_path(self, path: str) -> str:
+        return os.path.join(self.directory, cache_key(path) + ".arrow")
+
+
+def iter_cached(path: str) -> Iterator[tuple[pd.DataFrame, int]]:
+    """Read a cached dataset from a memory-mapped file.
+
+    The data is converted in one piece: the Arrow table only maps the file, so
+    the frame is the one copy in memory, with no pieces to concatenate.
+
+    Args:
+        path: The path of the cached copy.
+
+    Yields:
+        The data and the number of bytes read.
+    """
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+        yield table.to_pandas(self_destruct=True, split_blocks=True), source.size()
+
+
+# The cache shared by all sessions of this process.
+dataset_cache = DatasetCache()
@@ -0,0 +1,269 @@
+"""Server-side registry of loaded datasets.
+
+DataFrames never go into Reflex state: the state only keeps an opaque handle
+and a small preview, and the frame itself lives in this process. Recently used
+datasets are kept in memory up to a size cap; the rest are spilled to disk and
+read back when they are used again.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Total size of the datasets kept in memory.
+DATASET_MEMORY_LIMIT = int(os.getenv("CHAT_DATASET_MEMORY_MB", "1024")) * 2**20
+# Total size of the datasets spilled to disk; the oldest are dropped beyond it.
+DATASET_DISK_LIMIT = int(os.getenv("CHAT_DATASET_DISK_MB", "10240")) * 2**20
+# Where spilled datasets are written.
+DATASET_SPILL_DIR = os.getenv(
+    "CHAT_DATASET_SPILL_DIR",
+    os.path.join(tempfile.gettempdir(), "reflex-chat", "datasets"),
+)
+
+
+@dataclass
+class Dataset:
+    """A registered dataset."""
+
+    handle: str
+    # The prompt digest computed when the dataset was loaded.
+    digest: str
+    # In-memory size of the frame.
+    nbytes: int
+    # The frame, or None while it is spilled to disk.
+    frame: pd.DataFrame | None = None
+    spill_path: str | None = None
+    # Path and format ("parquet" or "arrow") of a columnar file with the same
+    # data, which queries can scan without loading the frame.
+    source: tuple[str, str] | None = None
+    # Whether the frame is being written to disk, to be released after.
+    spilling: bool = False
+
+
+class DatasetStore:
+    """An in-process LRU store of DataFrames that spills to disk.
+
+    The lock only guards the registry: frames are written to and read from
+    disk outside of it, so other sessions are not held up by the file I/O.
+    """
+
+    def __init__(
+        self,
+        memory_limit: int = DATASET_MEMORY_LIMIT,
+        disk_limit: int = DATASET_DISK_LIMIT,
+        spill_dir: str = DATASET_SPILL_DIR,
+    ):
+        """Create the store.
+
+        Args:
+            memory_limit: Bytes of DataFrames to keep in memory.
+            disk_limit: Bytes of DataFrames to keep on disk.
+            spill_dir: The directory spilled datasets are written to.
+        """
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.spill_dir = spill_dir
+        self._datasets: OrderedDict[str, Dataset] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def put(
+        self,
+        df: pd.DataFrame,
+        digest: str = "",
+        source: tuple[str, str] | None = None,
+    ) -> str:
+        """Register a dataset.
+
+        Args:
+            df: The data.
+            digest: The prompt digest of the data.
+            source: The path and format of a columnar file with the same data.
+
+        Returns:
+            The handle to look the dataset up with.
+        """
+        dataset = Dataset(
+            handle=uuid.uuid4().hex,
+            digest=digest,
+            nbytes=int(df.memory_usage(deep=True).sum()),
+            frame=df,
+            source=source,
+        )
+        with self._lock:
+            self._datasets[dataset.handle] = dataset
+            victims = self._evict()
+        self._spill(victims)
+        return dataset.handle
+
+    def get(self, handle: str) -> pd.DataFrame:
+        """Get the data of a dataset, reading it back from disk if needed.
+
+        Args:
+            handle: The dataset handle.
+
+        Returns:
+            The data.
+
+        Raises:
+            KeyError: If the handle is unknown or the dataset was dropped.
+        """
+        with self._lock:
+            dataset = self._datasets[handle]
+            self._datasets.move_to_end(handle)
+            frame, spill_path = dataset.frame, dataset.spill_path
+        if frame is not None:
+            return frame
+        try:
+            frame = _read_spilled(spill_path)
+        except OSError:
+            # Dropped while it was read.
+            raise KeyError(handle) from None
+        with self._lock:
+            if dataset.frame is None:
+                dataset.frame = frame
+            frame = dataset.frame
+            victims = self._evict()
+        self._spill(victims)
+        return frame
+
+    def digest(self, handle: str) -> str:
+        """Get the prompt digest of a dataset without loading its data.
+
+        Args:
+            handle: The dataset handle.
+
+        Returns:
+            The digest.
+
+        Raises:
+            KeyError: If the handle is unknown or the dataset was dropped.
+        """
+        with self._lock:
+            return self._datasets[handle].digest
+
+    def source(self, handle: str) -> tuple[str, str] | None:
+        """Get the columnar file of a dataset.
+
+        Args:
+            handle: The dataset handle.
+
+        Returns:
+            The path and format of the file, or None if there is none.
+
+        Raises:
+            KeyError: If the handle is unknown or the dataset was dropped.
+        """
+        with self._lock:
+            return self._datasets[handle].source
+
+    def drop(self, handle: str):
+        """Remove a dataset from memory and disk.
+
+        Args:
+            handle: The dataset handle.
+        """
+        with self._lock:
+            dataset = self._datasets.pop(handle, None)
+        if dataset is not None and dataset.spill_path:
+            _remove(dataset.spill_path)
+
+    def _evict(self) -> list[Dataset]:
+        """Pick the least recently used frames to spill until memory fits.
+
+        Drops the oldest spilled datasets until the disk fits. Must be called
+        with the lock held; the picked frames are then written with
+        ``_spill`` after releasing it.
+
+        Returns:
+            The datasets to spill.
+        """
+        datasets = self._datasets.values()
+        in_memory = sum(
+            d.nbytes for d in datasets if d.frame is not None and not d.spilling
+        )
+        victims = []
+        # Never spill the most recently used dataset: it is about to be used.
+        for dataset in list(self._datasets.values())[:-1]:
+            if in_memory <= self.memory_limit:
+                break
+            if dataset.frame is not None and not dataset.spilling:
+                dataset.spilling = True
+                victims.append(dataset)
+                in_memory -= dataset.nbytes
+
+        on_disk = sum(d.nbytes for d in datasets if d.frame is None)
+        for dataset in list(self._datasets.values()):
+            if on_disk <= self.disk_limit:
+                break
+            if dataset.frame is None:
+                logger.info("Dropping spilled dataset %s", dataset.handle)
+                self.drop(dataset.handle)
+                on_disk -= dataset.nbytes
+        return victims
+
+    def _spill(self, victims: list[Dataset]):
+        """Write frames to disk and release them from memory.
+
+        A frame that cannot be written stays in memory, to be picked again by
+        the next eviction.
+        """
+        for dataset in victims:
+            path = os.path.join(self.spill_dir, dataset.handle)
+            try:
+                spill_path = dataset.spill_path or _write_spill(dataset.frame, path)
+            except Exception:
+                # E.g. the disk is full: keep the frame rather than fail the
+                # caller, whose own dataset is already registered.
+                logger.exception("Could not spill dataset %s", dataset.handle)
+                _remove(path + ".parquet")
+                _remove(path + ".pkl")
+                with self._lock:
+                    dataset.spilling = False
+                continue
+            with self._lock:
+                dataset.spill_path, dataset.spilling = spill_path, False
+                dropped = dataset.handle not in self._datasets
+                if not dropped:
+                    dataset.frame = None
+            if dropped:
+                _remove(spill_path)
+            else:
+                logger.info("Spilled dataset %s to %s", dataset.handle, spill_path)
+
+
+def _write_spill(frame: pd.DataFrame, path: str) -> str:
+    """Write a frame to disk, as Parquet if it can be."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        frame.to_parquet(path + ".parquet", engine="pyarrow")
+        return path + ".parquet"
+    except (ValueError, TypeError, ImportError):
+        # Mixed-type object columns cannot be written as Parquet.
+        _remove(path + ".parquet")
+        frame.to_pickle(path + ".pkl")
+        return path + ".pkl"
+
+
+def _read_spilled(path: str) -> pd.DataFrame:
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, engine="pyarrow")
+    return pd.read_pickle(path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# The registry shared by all sessions of this process.
+dataset_store = DatasetStore()
@@ -0,0 +1,256 @@
+"""Streaming downloads of generated images.
+
+Downloads are served by the backend (see ``api.py``) instead of being fetched
+and buffered inside an event handler. Remote images (upscales hosted by
+Replicate) are streamed from the upstream through a pooled HTTP client and
+relayed to the browser chunk by chunk, while being written to a local cache.
+Later downloads of the same image are served from the cache.
+
+Only images on ``CHAT_DOWNLOAD_HOSTS`` are proxied, so the route cannot be
+used to make the server fetch arbitrary URLs. Redirects are followed only to
+allowed hosts as well.
+"""
+
+import asyncio
+import hashlib
+import os
+import urllib.parse
+import uuid
+from typing import AsyncIterator, BinaryIO
+
+import httpx
+from reflex.config import get_config
+
+# Where downloaded images are cached.
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "CHAT_DOWNLOAD_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reflex-chat", "downloads"),
+)
+# Total size of the cached downloads.
+DOWNLOAD_CACHE_LIMIT = int(os.getenv("CHAT_DOWNLOAD_CACHE_MB", "1024")) * 2**20
+# Comma separated hosts (and their subdomains) that images may be proxied from.
+DOWNLOAD_HOSTS = tuple(
+    host.strip()
+    for host in os.getenv("CHAT_DOWNLOAD_HOSTS", "replicate.delivery").split(",")
+    if host.strip()
+)
+# Maximum number of pooled connections to the upstreams.
+DOWNLOAD_CONNECTIONS = int(os.getenv("CHAT_DOWNLOAD_CONNECTIONS", "20"))
+# Size of the chunks relayed to the browser.
+CHUNK_SIZE = 64 * 1024
+# Maximum number of redirects followed to fetch an image.
+MAX_REDIRECTS = 5
+
+# The path downloads are served under.
+DOWNLOAD_ROUTE = "/downloads"
+
+
+def is_allowed(url: str) -> bool:
+    """Whether an image may be proxied from a URL.
+
+    Args:
+        url: The URL of the image.
+
+    Returns:
+        True for https URLs on an allowed host.
+    """
+    parts = urllib.parse.urlsplit(url)
+    host = parts.hostname or ""
+    return parts.scheme == "https" and any(
+        host == allowed or host.endswith(f".{allowed}") for allowed in DOWNLOAD_HOSTS
+    )
+
+
+def download_url(url: str, filename: str) -> str:
+    """Get the URL that downloads an image as a file.
+
+    Args:
+        url: The URL of the image, remote or in the blob store.
+        filename: The name the file is saved as.
+
+    Returns:
+        The absolute URL on the backend server.
+    """
+    query = urllib.parse.urlencode({"url": url, "filename": filename})
+    return f"{get_config().api_url}{DOWNLOAD_ROUTE}?{query}"
+
+
+def content_disposition(filename: str) -> str:
+    """Get the header value that makes the browser save a response as a file.
+
+    Args:
+        filename: The name the file is saved as.
+
+    Returns:
+        The Content-Disposition header value.
+    """
+    quoted = urllib.parse.quote(filename)
+    if quoted == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename*=utf-8''{quoted}"
+
+
+class DownloadCache:
+    """Proxy remote images, keeping the recently downloaded ones on disk."""
+
+    def __init__(
+        self,
+        directory: str = DOWNLOAD_CACHE_DIR,
+        limit: int = DOWNLOAD_CACHE_LIMIT,
+        max_connections: int = DOWNLOAD_CONNECTIONS,
+    ):
+        """Create the cache.
+
+        Args:
+            directory: Where downloaded images are cached.
+            limit: Total size of the cached downloads in bytes.
+            max_connections: Maximum number of pooled upstream connections.
+        """
+        self.directory = directory
+        self.limit = limit
+        self.max_connections = max_connections
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled HTTP client, created on first use."""
+        if self._client is None or self._client.is_closed:
+            # Redirects are followed by open, which checks every hop.
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(max_connections=self.max_connections),
+            )
+        return self._client
+
+    def path(self, url: str) -> str:
+        """Get the cache path of a remote image.
+
+        Args:
+            url: The URL of the image.
+
+        Returns:
+            The path the image is cached at, whether it is cached or not.
+        """
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def cached(self, url: str) -> str | None:
+        """Get the cached copy of a remote image.
+
+        Args:
+            url: The URL of the image.
+
+        Returns:
+            The path of the cached copy, or None if it is not cached.
+        """
+        path = self.path(url)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    async def open(self, url: str) -> httpx.Response:
+        """Start fetching a remote image.
+
+        Args:
+            url: The URL of the image.
+
+        Returns:
+            The upstream response, with the body not read yet. Pass it to
+            ``relay`` and the connection is released when the body is done.
+
+        Raises:
+            httpx.HTTPError: If the upstream fails, or redirects too often or
+                to a host that is not allowed.
+        """
+        request = self.client.build_request("GET", url)
+        response = await self.client.send(request, stream=True)
+        for _ in range(MAX_REDIRECTS):
+            next_request = response.next_request
+            if next_request is None or not is_allowed(str(next_request.url)):
+                break
+            await response.aclose()
+            response = await self.client.send(next_request, stream=True)
+        try:
+            # A redirect that was not followed fails here too.
+            response.raise_for_status()
+        except httpx.HTTPError:
+            await response.aclose()
+            raise
+        return response
+
+    async def relay(self, url: str, response: httpx.Response) -> AsyncIterator[bytes]:
+        """Relay an upstream response, caching the image once it is complete.
+
+        Args:
+            url: The URL of the image.
+            response: The upstream response, see ``open``.
+
+        Yields:
+            Chunks of the image.
+        """
+        path = self.path(url)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        complete = False
+        try:
+            # Keep the disk writes off the event loop.
+            f = await asyncio.to_thread(_create, tmp_path)
+            try:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+                    yield chunk
+            finally:
+                await asyncio.to_thread(f.close)
+            complete = True
+        finally:
+            await response.aclose()
+            if complete:
+                await asyncio.to_thread(os.replace, tmp_path, path)
+                await asyncio.to_thread(self.evict)
+            else:
+                # The browser or the upstream went away: drop the partial file.
+                await asyncio.to_thread(_remove, tmp_path)
+
+    def evict(self):
+        """Remove the least recently used downloads beyond the size limit."""
+        entries = []
+        try:
+            for shard in os.scandir(self.directory):
+                if shard.is_dir():
+                    entries.extend(
+                        entry
+                        for entry in os.scandir(shard.path)
+                        if not entry.name.endswith(".tmp")
+                    )
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.limit:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def _create(path: str) -> BinaryIO:
+    """Open a new file for writing, creating its directory if needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, "wb")
+
+
+def _remove(path: str):
+    """Remove a file if it exists."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# The download cache shared by all sessions of this process.
+download_cache = DownloadCache()
@@ -1,22 +1,48 @@
 import asyncio
+import base64
 import datetime
+import io
+import json
+import logging
 import os
-import traceback
+import time
 from enum import Enum
 
 import reflex as rx
 import replicate
-import requests
+from PIL import Image, ImageOps
 
+from .blobs import CONTENT_TYPES, blob_name, blob_store, blob_url
+from .downloads import download_url
+from .llm import model_registry
+from .metrics import metrics
 from .options import OptionsState
+from .predictions import prediction_watcher
+from .resilience import (
+    CircuitOpenError,
+    gemini_resilience,
+    is_unsent,
+    replicate_resilience,
+)
+from .scheduler import scheduler
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_IMAGE = "/default.webp"
+IMAGE_MODEL = "gemini-1.5-flash"
 API_TOKEN_ENV_VAR = os.getenv("GEMINI_API_KEY")
+# Maximum number of images of one batch requested at once.
+IMAGE_PARALLELISM = int(os.getenv("CHAT_IMAGE_PARALLELISM", "4"))
 
 
 CopyLocalState = rx._x.client_state(default=False, var_name="copying")
 
 
+# The tasks of the image batches being generated, by client token, so that
+# cancel_generation can stop them.
+_batches: dict[str, list[asyncio.Task]] = {}
+
+
 class ResponseStatus(Enum):
     STARTING = "starting"
     PROCESSING = "processing"
@@ -29,19 +55,22 @@ class GeneratorState(rx.State):
     is_generating: bool = False
     is_upscaling: bool = False
     _request_id: str = None
+    # URL of the generated image; the image data itself is kept in the blob
+    # store.
     output_image: str = DEFAULT_IMAGE
+    # The images of the last batch, in the order they finished.
     output_list: list[str] = []
     upscaled_image: str = ""
     is_downloading: bool = False
+    # The user id cookie set by the chat state; model requests are scheduled
+    # per user.
+    user_id: str = rx.Cookie("", name="chat_user_id")
 
     @rx.event(background=True)
     async def generate_image(self):
         try:
-            import google.generativeai as genai
-
             # Check if the env variable is set
-            api_key = ""
-            if not api_key:
+            if not model_registry.api_key:
                 yield rx.toast.warning("No Google Gemini API key found")
                 return
             if self.is_upscaling:
@@ -54,72 +83,98 @@ class GeneratorState(rx.State):
                 yield rx.toast.warning("Please enter a prompt")
                 return
 
-            # Configure Gemini API
-            genai.configure(api_key=api_key)
-            # Use the updated model name as per deprecation notice
-
-            model = genai.GenerativeModel("gemini-1.5-flash")
-
-            # yield rx.toast.warning(f"line 61. model = {model}")
-            # Compose the prompt
-            prompt = Options.prompt + Options.selected_style_prompt
-
-            # Gemini API expects a single prompt string
-            response = await asyncio.to_thread(
-                lambda: model.generate_content(prompt, stream=False)
-            )
+            # Reuse the pooled, already configured model.
+            model = model_registry.model(IMAGE_MODEL)
+            prompts = _image_prompts(Options)
+            size = Options.selected_dimensions
+            user = self._scheduler_user()
 
-            # Extract image from response
-            if (
-                not response
-                or not hasattr(response, "candidates")
-                or not response.candidates
-            ):
-                async with self:
-                    self._reset_state()
-                yield rx.toast.error("Error generating image")
-                return
+            async with self:
+                self.is_generating = True
+                self.upscaled_image = ""
+                self.output_list = []
 
-            # Find the first image in the response
-            image_url = None
-            for candidate in response.candidates:
-                if hasattr(candidate, "content") and hasattr(
-                    candidate.content, "parts"
-                ):
-                    for part in candidate.content.parts:
-                        if hasattr(part, "inline_data") and hasattr(
-                            part.inline_data, "data"
-                        ):
-                            # Gemini returns base64 image data
-                            if isinstance(part.inline_data.data, bytes):
-                                image_url = (
-                                    "data:image/png;base64,"
-                                    + part.inline_data.data.decode("utf-8")
-                                )
-                            else:
-                                image_url = (
-                                    "data:image/png;base64," + part.inline_data.data
-                                )
+            # Request all images at once, a few at a time, and show each one
+            # as soon as it is stored.
+            parallelism = asyncio.Semaphore(IMAGE_PARALLELISM)
+            tasks = [
+                asyncio.create_task(
+                    _generate_one(model, prompt, size, user, parallelism)
+                )
+                for prompt in prompts
+            ]
+            token = self.router.session.client_token
+            _batches[token] = tasks
+
+            def cancelled() -> bool:
+                return _batches.get(token) is not tasks
+
+            errors = []
+            try:
+                with metrics.span("chat_image_batch_seconds"):
+                    for next_image in asyncio.as_completed(tasks):
+                        try:
+                            image = await next_image
+                        except asyncio.CancelledError:
+                            if not cancelled():
+                                raise
                             break
-                if image_url:
-                    break
-
-            if not image_url:
-                async with self:
-                    self._reset_state()
-                yield rx.toast.error("No image returned by Gemini API")
+                        except Exception as e:
+                            errors.append(e)
+                            metrics.inc(
+                                "chat_images_total", kind="generate", outcome="error"
+                            )
+                            continue
+                        if image is None:
+                            errors.append(None)
+                            metrics.inc(
+                                "chat_images_total", kind="generate", outcome="empty"
+                            )
+                            continue
+                        if cancelled():
+                            break
+                        name, latency = image
+                        logger.info("Generated image %s in %.2fs", name, latency)
+                        metrics.inc("chat_images_total", kind="generate", outcome="ok")
+                        metrics.observe("chat_image_seconds", latency)
+                        async with self:
+                            if not self.output_list:
+                                self.output_image = blob_url(name)
+                            self.output_list.append(blob_url(name))
+            finally:
+                was_cancelled = cancelled()
+                if not was_cancelled:
+                    del _batches[token]
+                for task in tasks:
+                    task.cancel()
+            if was_cancelled:
+                # cancel_generation already reset the state.
                 return
 
             async with self:
-                self.upscaled_image = ""
-                self.output_image = image_url
-                self.output_list = []
+                generated = len(self.output_list)
                 self._reset_state()
-
+            failures = [e for e in errors if e is not None]
+            if not generated:
+                if failures:
+                    raise failures[0]
+                yield rx.toast.error("No image returned by Gemini API")
+            elif errors:
+                for e in failures:
+                    logger.error("Error generating image", exc_info=e)
+                yield rx.toast.warning(
+                    f"{len(errors)} of {len(prompts)} images could not be generated"
+                )
+
+        except CircuitOpenError:
+            async with self:
+                self._reset_state()
+            yield rx.toast.error("Image generation is unavailable, try again later")
         except Exception as e:
+            logger.exception("Error generating image")
             async with self:
                 self._reset_state()
-            yield rx.toast.error(f"Error, please try again: {traceback.format_exc()}")
+            yield rx.toast.error(f"Error, please try again: {e}")
 
     @rx.event(background=True)
     async def upscale_image(self):
@@ -143,7 +198,7 @@ class GeneratorState(rx.State):
                 "negative_prompt": "(worst quality, low quality, normal quality:2) JuggernautNegative-neg",
                 "num_inference_steps": 18,
                 "scheduler": "DPM++ 3M SDE Karras",
-                "image": self.output_image,
+                "image": self._image_input(),
                 "dynamic": 6,
                 "handfix": "disabled",
                 "sharpen": 0,
@@ -164,10 +219,19 @@ class GeneratorState(rx.State):
                 input["seed"] = Options.seed
 
             # Await the output from the replicate API
-            response = await replicate.predictions.async_create(
-                "029d48aa21712d6769d7a46729c1edf0e4d41919c70b270785f10abb82989ba5",
-                input=input,
-            )
+            started = time.perf_counter()
+            async with scheduler.slot(self._scheduler_user()):
+                # A duplicate prediction would run (and bill) twice: never hedge,
+                # and only retry when the request surely created nothing.
+                response = await replicate_resilience.call(
+                    lambda: replicate.predictions.async_create(
+                        "029d48aa21712d6769d7a46729c1edf0e4d41919c70b270785f10abb82989ba5",
+                        input=input,
+                        **prediction_watcher.create_params(),
+                    ),
+                    hedge=False,
+                    retryable=is_unsent,
+                )
 
             if response.status != ResponseStatus.STARTING.value or not response:
                 async with self:
@@ -180,33 +244,39 @@ class GeneratorState(rx.State):
                 self._request_id = response.id
                 yield
 
-            while True:
-                response = await replicate.predictions.async_get(response.id)
-                async with self:
-                    if response.status in (
-                        ResponseStatus.CANCELED.value,
-                        ResponseStatus.FAILED.value,
-                    ):
-                        self._reset_state()
-                        if response.status == ResponseStatus.FAILED.value:
-                            yield rx.toast.warning(
-                                f"Error upscaling image: {response.error}"
-                            )
-                        return
-                    elif response.status == ResponseStatus.SUCCEEDED.value:
-                        break
-                await asyncio.sleep(0.15)
+            # Sleep until the prediction finishes; the shared watcher wakes us.
+            response = await prediction_watcher.wait(response)
+            metrics.observe("chat_upscale_seconds", time.perf_counter() - started)
+            metrics.inc("chat_images_total", kind="upscale", outcome=response.status)
             async with self:
+                if response.status in (
+                    ResponseStatus.CANCELED.value,
+                    ResponseStatus.FAILED.value,
+                ):
+                    self._reset_state()
+                    if response.status == ResponseStatus.FAILED.value:
+                        yield rx.toast.warning(
+                            f"Error upscaling image: {response.error}"
+                        )
+                    return
                 self.upscaled_image = response.output[0]
                 self.output_list = []
                 self._request_id, self.is_upscaling = None, False
 
         except Exception as e:
+            metrics.inc("chat_images_total", kind="upscale", outcome="error")
             async with self:
                 self._reset_state()
             yield rx.toast.error(f"Error, please try again: {e}")
 
     def cancel_generation(self):
+        tasks = _batches.pop(self.router.session.client_token, None)
+        if tasks is not None:
+            # A batch of images: stop the ones still being generated.
+            for task in tasks:
+                task.cancel()
+            self._reset_state()
+            return
         if self._request_id is None:
             return
         try:
@@ -223,6 +293,18 @@ class GeneratorState(rx.State):
         self.is_generating = False
         self.is_upscaling = False
 
+    def _scheduler_user(self) -> str:
+        return self.user_id or self.router.session.client_token
+
+    def _image_input(self) -> str:
+        # The blob URL is not reachable by Replicate, so send the data inline.
+        name = blob_name(self.output_image)
+        if name is None:
+            return self.output_image
+        content_type = CONTENT_TYPES[name.rsplit(".", 1)[1]]
+        data = base64.b64encode(blob_store.read(name)).decode()
+        return f"data:{content_type};base64,{data}"
+
     def _check_api_token(self):
         if os.getenv(API_TOKEN_ENV_VAR) is None:
             yield rx.toast.warning("No API key found")
@@ -238,13 +320,11 @@ class GeneratorState(rx.State):
         )
 
         try:
-            if image_url.startswith("http"):
-                response = requests.get(image_url)
-                response.raise_for_status()
-                image_data = response.content
-                return rx.download(data=image_data, filename=filename)
-            else:
-                return rx.download(url=image_url, filename=filename)
+            if blob_name(image_url) is not None or image_url.startswith("http"):
+                # The backend streams the file to the browser as an attachment,
+                # so the image never passes through this handler.
+                return _download(download_url(image_url, filename))
+            return rx.download(url=image_url, filename=filename)
         except Exception as e:
             yield rx.toast.error(f"Error downloading image: {e}")
         finally:
@@ -264,6 +344,127 @@ class GeneratorState(rx.State):
             yield rx.toast.error(f"Error copying image URL: {e}")
 
 
+def _image_prompts(options: OptionsState) -> list[str]:
+    """Compose the prompts of a batch from the generation options.
+
+    Gemini takes no seed or size parameters, so they are part of the prompt:
+    each image of a seeded batch gets its own seed, which makes the batch
+    images differ and the same seed ask for the same images.
+
+    Args:
+        options: The generation options.
+
+    Returns:
+        One prompt per image.
+    """
+    width, height = options.selected_dimensions
+    prompt = (
+        f"{options.prompt}{options.selected_style_prompt}\n"
+        f"Image size: {width}x{height} pixels."
+    )
+    if options.negative_prompt:
+        prompt += f"\nAvoid: {options.negative_prompt}"
+    prompts = []
+    for index in range(max(1, options.num_outputs)):
+        if options.seed:
+            prompts.append(f"{prompt}\nSeed: {options.seed + index}")
+        elif options.num_outputs > 1:
+            prompts.append(f"{prompt}\nVariation {index + 1}")
+        else:
+            prompts.append(prompt)
+    return prompts
+
+
+async def _generate_one(
+    model,
+    prompt: str,
+    size: tuple[int, int],
+    user: str,
+    parallelism: asyncio.Semaphore,
+) -> tuple[str, float] | None:
+    """Generate and store one image of a batch.
+
+    Args:
+        model: The image model.
+        prompt: The prompt of the image.
+        size: The width and height of the image.
+        user: The user the request is scheduled for.
+        parallelism: Bounds the requests of the batch in flight.
+
+    Returns:
+        The name of the image and the seconds it took, or None if the model
+        returned no image.
+    """
+    async with parallelism, scheduler.slot(user):
+        start = time.perf_counter()
+        # Retry transient failures; images are too costly to hedge.
+        response = await gemini_resilience.call(
+            lambda: asyncio.to_thread(
+                lambda: model.generate_content(prompt, stream=False)
+            ),
+            hedge=False,
+        )
+    image = _first_image(response)
+    if image is None:
+        return None
+    # Keep the image out of the state: store it once and hold its URL.
+    name = await asyncio.to_thread(
+        _store_image, image.data, image.mime_type or "image/png", size
+    )
+    return name, time.perf_counter() - start
+
+
+def _first_image(response):
+    """Get the first image of a Gemini response, or None."""
+    for candidate in getattr(response, "candidates", None) or []:
+        if hasattr(candidate, "content") and hasattr(candidate.content, "parts"):
+            for part in candidate.content.parts:
+                if hasattr(part, "inline_data") and getattr(
+                    part.inline_data, "data", None
+                ):
+                    return part.inline_data
+    return None
+
+
+def _store_image(
+    data: bytes | str, content_type: str, size: tuple[int, int] | None = None
+) -> str:
+    """Store a generated image in the blob store.
+
+    Args:
+        data: The image, or the image encoded as base64 text.
+        content_type: The MIME type of the image.
+        size: The width and height to crop and scale the image to, if any.
+
+    Returns:
+        The name of the image.
+    """
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    if size is not None:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.size != tuple(size):
+                buffer = io.BytesIO()
+                ImageOps.fit(image, tuple(size)).save(buffer, format="PNG")
+                data, content_type = buffer.getvalue(), "image/png"
+    return blob_store.put(data, content_type)
+
+
+def _download(url: str) -> rx.event.EventSpec:
+    """Make the browser save the response of a backend URL.
+
+    ``rx.download`` only takes URLs on the frontend; a download from another
+    origin has to be an attachment, which is saved without leaving the page.
+    """
+    return rx.call_script(
+        f"""
+        const a = document.createElement("a");
+        a.href = {json.dumps(url)};
+        a.click();
+        """
+    )
+
+
 def copy_script():
     return rx.call_script(
         """
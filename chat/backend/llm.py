@@ -0,0 +1,454 @@
+"""Async client layer for LLM calls.
+
+The provider SDKs are blocking, so every call runs on a bounded thread pool
+instead of the event loop. Each request gets a timeout and the number of
+requests in flight is capped per process.
+
+Gemini models are configured once per process and pooled by the model
+registry, so requests reuse open connections instead of setting up a new
+client (and handshake) every time.
+"""
+
+import asyncio
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from typing import AsyncIterator, Iterator, Protocol
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+from .resilience import Resilience, TransientError, gemini_resilience
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+# Which backend to use: "gemini" for the real API, "fake" for a local stand-in.
+LLM_BACKEND = os.getenv("CHAT_LLM_BACKEND", "gemini")
+# Maximum number of LLM requests in flight at once in this process.
+LLM_MAX_CONCURRENCY = int(os.getenv("CHAT_LLM_MAX_CONCURRENCY", "16"))
+# Seconds a single request may take, including time spent waiting for a slot.
+LLM_TIMEOUT = float(os.getenv("CHAT_LLM_TIMEOUT", "60"))
+# Number of clients, each with its own connection, pooled per Gemini model.
+LLM_POOL_SIZE = int(os.getenv("CHAT_LLM_POOL_SIZE", "4"))
+# Seconds before the first chunk of a fake backend answer.
+FAKE_LATENCY = float(os.getenv("CHAT_FAKE_LATENCY", "0.2"))
+# Seconds between the streamed chunks of a fake backend answer.
+FAKE_CHUNK_DELAY = float(os.getenv("CHAT_FAKE_CHUNK_DELAY", "0.02"))
+# Number of words in each fake backend answer, and in each streamed chunk.
+FAKE_WORDS = int(os.getenv("CHAT_FAKE_WORDS", "60"))
+FAKE_WORDS_PER_CHUNK = int(os.getenv("CHAT_FAKE_WORDS_PER_CHUNK", "3"))
+# Share of fake backend calls that fail with a transient error, to exercise the
+# retry and circuit breaking paths locally.
+FAKE_FAILURE_RATE = float(os.getenv("CHAT_FAKE_FAILURE_RATE", "0"))
+# Share of fake backend calls that are ten times slower, to exercise hedging.
+FAKE_SLOW_RATE = float(os.getenv("CHAT_FAKE_SLOW_RATE", "0"))
+# Versions of google-generativeai whose private client internals are known,
+# see _own_client.
+OWN_CLIENT_SDK_VERSIONS = ("0.7.", "0.8.")
+# Models whose connections are opened when the app starts.
+WARM_UP_MODELS = [
+    name for name in os.getenv("CHAT_LLM_WARM_UP", DEFAULT_MODEL).split(",") if name
+]
+
+
+class ModelRegistry:
+    """A process-wide pool of configured Gemini models.
+
+    The API is configured once, and every model name gets a fixed pool of
+    GenerativeModel instances that are handed out round robin. Each instance
+    has its own client where the SDK allows it (see ``_own_client``), so the
+    pool keeps that many connections open.
+    """
+
+    def __init__(
+        self,
+        api_key: str = os.getenv("GEMINI_API_KEY", ""),
+        pool_size: int = LLM_POOL_SIZE,
+    ):
+        """Create the registry.
+
+        Args:
+            api_key: The Gemini API key.
+            pool_size: Number of clients per model.
+        """
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self._configured = False
+        self._pools: dict[str, Iterator[genai.GenerativeModel]] = {}
+        self._lock = threading.Lock()
+
+    def model(self, name: str) -> genai.GenerativeModel:
+        """Get a configured model from the pool.
+
+        Args:
+            name: The model name.
+
+        Returns:
+            The next model instance in the pool.
+        """
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                self._configure()
+                pool = self._pools[name] = itertools.cycle(
+                    [self._make_model(name) for _ in range(self.pool_size)]
+                )
+            return next(pool)
+
+    def warm_up(self, names: list[str]):
+        """Open the connections of the pooled models ahead of the first request.
+
+        Args:
+            names: The model names.
+        """
+        for name in names:
+            for _ in range(self.pool_size):
+                try:
+                    self.model(name).count_tokens("ping")
+                except Exception as e:
+                    logger.warning("Could not warm up %s: %s", name, e)
+                    break
+
+    def _configure(self):
+        if not self._configured:
+            genai.configure(api_key=self.api_key or None)
+            self._configured = True
+
+    def _make_model(self, name: str) -> genai.GenerativeModel:
+        model = genai.GenerativeModel(name)
+        _own_client(model)
+        return model
+
+
+def _own_client(model: genai.GenerativeModel):
+    """Give a model its own API client, and so its own connections.
+
+    Models share one default client and the SDK has no public way to give one
+    its own, so this sets the model's private client, made by the SDK's
+    private client manager. It is only done on the SDK versions known to have
+    both; on others the pooled models keep sharing the default client, which
+    works but without connections of their own.
+
+    Args:
+        model: A new model.
+    """
+    if _own_clients_supported():
+        model._client = genai_client._client_manager.make_client("generative")
+
+
+@functools.cache
+def _own_clients_supported() -> bool:
+    """Whether the installed SDK has the internals used by ``_own_client``."""
+    supported = (
+        genai.__version__.startswith(OWN_CLIENT_SDK_VERSIONS)
+        and hasattr(genai_client, "_client_manager")
+        and hasattr(genai.GenerativeModel(DEFAULT_MODEL), "_client")
+    )
+    if not supported:
+        logger.warning(
+            "google-generativeai %s is not known to support a client per model; "
+            "pooled models share one client",
+            genai.__version__,
+        )
+    return supported
+
+
+# The registry shared by the chat and image generation.
+model_registry = ModelRegistry()
+
+
+async def warm_up_models():
+    """Warm up the pooled models when the app starts."""
+    if LLM_BACKEND != "gemini" or not model_registry.api_key:
+        return
+    await asyncio.to_thread(model_registry.warm_up, WARM_UP_MODELS)
+
+
+class Backend(Protocol):
+    """A blocking LLM backend."""
+
+    def generate(self, model: str, prompt: str) -> str:
+        """Generate the full answer to a prompt."""
+        ...
+
+    def stream(self, model: str, prompt: str) -> Iterator[str]:
+        """Generate the answer to a prompt chunk by chunk."""
+        ...
+
+
+class GeminiBackend:
+    """The Google Gemini API."""
+
+    def generate(self, model: str, prompt: str) -> str:
+        response = model_registry.model(model).generate_content(contents=prompt)
+        return response.text
+
+    def stream(self, model: str, prompt: str) -> Iterator[str]:
+        response = model_registry.model(model).generate_content(
+            contents=prompt, stream=True
+        )
+        for chunk in response:
+            text = chunk_text(chunk)
+            if text:
+                yield text
+
+
+class FakeBackend:
+    """A deterministic local backend for development and load testing.
+
+    Answers are derived from a hash of the prompt, so the same prompt always
+    gets the same answer, and no network access is needed. Faults can be
+    injected: a share of the calls fail with a transient error before the
+    first chunk, and a share are slow.
+    """
+
+    def __init__(
+        self,
+        latency: float = FAKE_LATENCY,
+        chunk_delay: float = FAKE_CHUNK_DELAY,
+        words: int = FAKE_WORDS,
+        words_per_chunk: int = FAKE_WORDS_PER_CHUNK,
+        failure_rate: float = FAKE_FAILURE_RATE,
+        slow_rate: float = FAKE_SLOW_RATE,
+        seed: int | None = None,
+    ):
+        """Create the backend.
+
+        Args:
+            latency: Seconds before the first chunk is produced.
+            chunk_delay: Seconds between streamed chunks.
+            words: Number of words in each answer.
+            words_per_chunk: Number of words in each streamed chunk.
+            failure_rate: Share of calls that fail with a TransientError.
+            slow_rate: Share of calls whose latency is ten times longer.
+            seed: Seed of the fault injection, for repeatable runs.
+        """
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.words = words
+        self.words_per_chunk = words_per_chunk
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self._random = random.Random(seed)
+
+    def generate(self, model: str, prompt: str) -> str:
+        time.sleep(self._latency() + self.chunk_delay * self._num_chunks())
+        return "".join(self._chunks(model, prompt))
+
+    def stream(self, model: str, prompt: str) -> Iterator[str]:
+        time.sleep(self._latency())
+        for chunk in self._chunks(model, prompt):
+            yield chunk
+            time.sleep(self.chunk_delay)
+
+    def _latency(self) -> float:
+        """Get the latency of a call, failing it if a fault is injected."""
+        if self._random.random() < self.failure_rate:
+            time.sleep(self.latency)
+            raise TransientError("Injected failure")
+        if self._random.random() < self.slow_rate:
+            return self.latency * 10
+        return self.latency
+
+    def _num_chunks(self) -> int:
+        return -(-self.words // self.words_per_chunk)
+
+    def _chunks(self, model: str, prompt: str) -> Iterator[str]:
+        digest = hashlib.sha256(f"{model}\n{prompt}".encode()).hexdigest()
+        words = [digest[i % 60 : i % 60 + 4] for i in range(self.words)]
+        for i in range(0, len(words), self.words_per_chunk):
+            yield " ".join(words[i : i + self.words_per_chunk]) + " "
+
+
+class LLMClient:
+    """Run blocking backend calls off the event loop.
+
+    Calls run on a thread pool with one worker per concurrency slot. A request
+    that cannot finish within its timeout raises ``TimeoutError``; the worker
+    thread is left to finish on its own since blocking SDK calls cannot be
+    interrupted.
+
+    Transient failures are retried within the timeout, and slow calls may be
+    hedged, as set by the resilience policy. A stream is only retried if it
+    fails before its first chunk, and is never hedged.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        timeout: float = LLM_TIMEOUT,
+        resilience: Resilience = gemini_resilience,
+    ):
+        """Create the client.
+
+        Args:
+            backend: The backend to send requests to.
+            max_concurrency: Maximum number of requests in flight at once.
+            timeout: Default per-request timeout in seconds.
+            resilience: The retry, hedging and circuit breaking policy.
+        """
+        self.backend = backend
+        self.timeout = timeout
+        self.resilience = resilience
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="llm"
+        )
+
+    async def generate(
+        self, prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None
+    ) -> str:
+        """Generate the full answer to a prompt.
+
+        Args:
+            prompt: The prompt text.
+            model: The model name.
+            timeout: Seconds to wait, defaults to the client timeout.
+
+        Returns:
+            The answer text.
+
+        Raises:
+            CircuitOpenError: If the provider is failing.
+        """
+        return await asyncio.wait_for(
+            self.resilience.call(lambda: self._generate(prompt, model)),
+            timeout or self.timeout,
+        )
+
+    async def _generate(self, prompt: str, model: str) -> str:
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, self.backend.generate, model, prompt
+            )
+
+    async def stream(
+        self, prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None
+    ) -> AsyncIterator[str]:
+        """Generate the answer to a prompt chunk by chunk.
+
+        The timeout applies to the whole stream, not to each chunk.
+
+        Args:
+            prompt: The prompt text.
+            model: The model name.
+            timeout: Seconds to wait, defaults to the client timeout.
+
+        Yields:
+            The answer text chunks.
+
+        Raises:
+            CircuitOpenError: If the provider is failing.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        retry = 0
+        while True:
+            self.resilience.check()
+            started = False
+            try:
+                # Close the attempt right away if the caller stops reading.
+                async with aclosing(self._stream(prompt, model, deadline)) as chunks:
+                    async for text in chunks:
+                        if not started:
+                            started = True
+                            self.resilience.record_success()
+                        yield text
+            except Exception as e:
+                retryable = self.resilience.record_failure(e)
+                # Chunks already shown cannot be taken back, so only a stream
+                # that has not started is retried.
+                if (
+                    started
+                    or not retryable
+                    or retry >= self.resilience.retries
+                    or loop.time() >= deadline
+                ):
+                    raise
+                await asyncio.wait_for(
+                    self.resilience.backoff(retry, e), max(deadline - loop.time(), 0)
+                )
+                retry += 1
+            else:
+                if not started:
+                    self.resilience.record_success()
+                return
+
+    async def _stream(
+        self, prompt: str, model: str, deadline: float
+    ) -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(self._semaphore.acquire(), deadline - loop.time())
+
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            # Runs on a worker thread: hand each chunk back to the event loop.
+            try:
+                for text in self.backend.stream(model, prompt):
+                    if stop.is_set():
+                        return
+                    loop.call_soon_threadsafe(queue.put_nowait, (text, None))
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, (None, None))
+
+        try:
+            loop.run_in_executor(self._executor, produce)
+            while True:
+                text, error = await asyncio.wait_for(
+                    queue.get(), max(deadline - loop.time(), 0)
+                )
+                if error is not None:
+                    raise error
+                if text is None:
+                    return
+                yield text
+        finally:
+            stop.set()
+            self._semaphore.release()
+
+
+def chunk_text(chunk) -> str:
+    """Get the text of a streamed response chunk.
+
+    Args:
+        chunk: A streamed Gemini response chunk.
+
+    Returns:
+        The chunk text, or an empty string if the chunk has no text parts.
+    """
+    try:
+        return chunk.text
+    except ValueError:
+        # Chunks without parts (e.g. the final safety/usage chunk) have no text.
+        return ""
+
+
+_client: LLMClient | None = None
+
+
+def get_client() -> LLMClient:
+    """Get the process-wide LLM client.
+
+    Returns:
+        The shared client, created on first use.
+    """
+    global _client
+    if _client is None:
+        backend = FakeBackend() if LLM_BACKEND == "fake" else GeminiBackend()
+        _client = LLMClient(backend)
+    return _client
@@ -0,0 +1,132 @@
+"""Incremental readers for dataset files.
+
+Files are read piece by piece so that loading can report progress, show a
+preview early and be cancelled between pieces: CSV files in chunks of rows and
+Parquet (.ldb) files by row group. Excel files cannot be read incrementally and
+are read in one piece.
+
+Parsed CSV and Excel files are written to the dataset cache as they are read,
+and later loads of the same file read the cached copy instead.
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Iterator
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from .dataset_cache import CACHED_EXTENSIONS, dataset_cache, iter_cached
+
+SUPPORTED_EXTENSIONS = (".csv", ".xlsx", ".ldb")
+
+# Number of CSV rows parsed per chunk.
+CHUNK_ROWS = int(os.getenv("CHAT_LOAD_CHUNK_ROWS", "100000"))
+
+
+@dataclass
+class LoadProgress:
+    """How much of a file has been read so far."""
+
+    rows: int
+    bytes_read: int
+    total_bytes: int
+
+    def __str__(self) -> str:
+        return (
+            f"{self.rows:,} rows read "
+            f"({self.bytes_read / 2**20:.1f} MB of {self.total_bytes / 2**20:.1f} MB)"
+        )
+
+
+def iter_chunks(
+    path: str, chunk_rows: int = CHUNK_ROWS
+) -> Iterator[tuple[pd.DataFrame, LoadProgress]]:
+    """Read a dataset file piece by piece.
+
+    Args:
+        path: The file path.
+        chunk_rows: Number of CSV rows per chunk.
+
+    Yields:
+        Each piece of the data and the progress after reading it.
+
+    Raises:
+        ValueError: If the file type is not supported.
+    """
+    if path.endswith(CACHED_EXTENSIONS):
+        cached = dataset_cache.lookup(path)
+        if cached is not None:
+            yield from _iter_arrow(cached)
+            return
+        writer = dataset_cache.writer(path)
+        try:
+            for chunk, progress in _iter_source(path, chunk_rows):
+                writer.write(chunk)
+                yield chunk, progress
+        except BaseException:
+            # Failed or cancelled (the generator was closed): drop the partial copy.
+            writer.abort()
+            raise
+        writer.commit()
+    else:
+        yield from _iter_source(path, chunk_rows)
+
+
+def columnar_source(path: str) -> tuple[str, str] | None:
+    """Find a columnar file with the same data as a dataset file.
+
+    Args:
+        path: The dataset file path.
+
+    Returns:
+        The path and format ("parquet" or "arrow") of the columnar file, or
+        None if there is none.
+    """
+    if path.endswith(".ldb"):
+        return path, "parquet"
+    if path.endswith(CACHED_EXTENSIONS):
+        cached = dataset_cache.lookup(path)
+        if cached is not None:
+            return cached, "arrow"
+    return None
+
+
+def _iter_source(
+    path: str, chunk_rows: int
+) -> Iterator[tuple[pd.DataFrame, LoadProgress]]:
+    """Parse a dataset file piece by piece."""
+    total = os.path.getsize(path)
+    rows = 0
+    if path.endswith(".csv"):
+        with open(path, "rb") as f:
+            for chunk in pd.read_csv(f, chunksize=chunk_rows):
+                rows += len(chunk)
+                # The parser reads ahead, so this is where it is in the file
+                # rather than exactly where the chunk ends.
+                yield chunk, LoadProgress(rows, min(f.tell(), total), total)
+    elif path.endswith(".ldb"):
+        parquet = pq.ParquetFile(path)
+        bytes_read = 0
+        for i in range(parquet.num_row_groups):
+            chunk = parquet.read_row_group(i).to_pandas()
+            group = parquet.metadata.row_group(i)
+            bytes_read += sum(
+                group.column(j).total_compressed_size for j in range(group.num_columns)
+            )
+            rows += len(chunk)
+            yield chunk, LoadProgress(rows, min(bytes_read, total), total)
+    elif path.endswith(".xlsx"):
+        df = pd.read_excel(path)
+        yield df, LoadProgress(len(df), total, total)
+    else:
+        raise ValueError("Unsupported file type. Use CSV, XLSX, or LDB.")
+
+
+def _iter_arrow(path: str) -> Iterator[tuple[pd.DataFrame, LoadProgress]]:
+    """Read a cached copy of a dataset piece by piece."""
+    total = os.path.getsize(path)
+    rows = 0
+    for chunk, bytes_read in iter_cached(path):
+        rows += len(chunk)
+        yield chunk, LoadProgress(rows, bytes_read, total)
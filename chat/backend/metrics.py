@@ -0,0 +1,301 @@
+"""Latency and throughput metrics of the chat and image pipelines.
+
+The pipelines time their steps with ``span`` and count outcomes with ``inc``.
+Durations and sizes go into histograms, which are served in the Prometheus
+text format at ``/metrics`` (see ``api.py``), together with the counters of
+the caches, the scheduler and the provider policies. When a log file is set
+up with ``setup_logging``, every span is also written to it as one JSON line.
+
+With ``CHAT_METRICS=0`` spans and counters do nothing, so instrumented code
+only pays for a function call.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterator
+
+# Whether metrics are recorded.
+METRICS_ENABLED = os.getenv("CHAT_METRICS", "1") != "0"
+# File that spans and logs are written to as JSON lines; empty for none.
+LOG_FILE = os.getenv("CHAT_LOG_FILE", "")
+
+# Upper bounds of the histogram buckets of durations, in seconds.
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+)  # fmt: skip
+# Upper bounds of the histogram buckets of sizes, in bytes.
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+span_logger = logging.getLogger("chat.spans")
+
+_Labels = tuple[tuple[str, str], ...]
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """A registry of counters and histograms."""
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        """Create the registry.
+
+        Args:
+            enabled: Whether metrics are recorded.
+        """
+        self.enabled = enabled
+        self._help: dict[str, tuple[str, str]] = {}
+        self._buckets: dict[str, tuple[float, ...]] = {}
+        self._counters: dict[str, dict[_Labels, float]] = defaultdict(dict)
+        self._histograms: dict[str, dict[_Labels, _Histogram]] = defaultdict(dict)
+        self._collectors: list[tuple[str, Callable[[], dict], _Labels]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str):
+        """Declare a counter.
+
+        Args:
+            name: The metric name.
+            help: What it counts.
+        """
+        self._help[name] = ("counter", help)
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = SECONDS_BUCKETS
+    ):
+        """Declare a histogram.
+
+        Args:
+            name: The metric name.
+            help: What it measures.
+            buckets: The upper bounds of its buckets.
+        """
+        self._help[name] = ("histogram", help)
+        self._buckets[name] = buckets
+
+    def collect(self, prefix: str, stats: Callable[[], dict], **labels: str):
+        """Export the counters of a component on every scrape.
+
+        Args:
+            prefix: Prefix of the metric names.
+            stats: Returns the counters. Numbers are exported as gauges named
+                ``<prefix>_<key>``; strings as a gauge of 1 with the string in
+                a label, e.g. the state of a circuit.
+            **labels: Labels of the exported gauges.
+        """
+        self._collectors.append((prefix, stats, _labels(labels)))
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        """Add to a counter.
+
+        Args:
+            name: The declared counter.
+            value: The amount to add.
+            **labels: The labels of the series.
+        """
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        """Record a value in a histogram.
+
+        Args:
+            name: The declared histogram.
+            value: The value, e.g. a duration in seconds.
+            **labels: The labels of the series.
+        """
+        if not self.enabled:
+            return
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(self._buckets[name])
+            histogram.observe(value)
+
+    def span(self, name: str, **labels: str):
+        """Time a block into a histogram and the structured log.
+
+        Args:
+            name: The declared histogram of the durations.
+            **labels: The labels of the series.
+
+        Returns:
+            A context manager timing its body.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, labels)
+
+    @contextmanager
+    def _span(self, name: str, labels: dict[str, str]) -> Iterator[None]:
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe(name, seconds, **labels)
+            if span_logger.isEnabledFor(logging.INFO):
+                span_logger.info(
+                    "span",
+                    extra={
+                        "span": name,
+                        "seconds": round(seconds, 6),
+                        "error": error,
+                        **labels,
+                    },
+                )
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format.
+
+        Returns:
+            The exposition text.
+        """
+        lines = []
+        with self._lock:
+            for name, series in self._counters.items():
+                self._header(lines, name)
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format(labels)} {value}")
+            for name, series in self._histograms.items():
+                self._header(lines, name)
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(
+                        (*histogram.buckets, "+Inf"), histogram.counts
+                    ):
+                        cumulative += count
+                        bucket_labels = (*labels, ("le", str(bound)))
+                        lines.append(
+                            f"{name}_bucket{_format(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format(labels)} {histogram.count}")
+        for prefix, stats, labels in self._collectors:
+            for key, value in stats().items():
+                name = f"{prefix}_{key}"
+                if isinstance(value, str):
+                    lines.append(f"{name}{_format((*labels, (key, value)))} 1")
+                elif value is not None:
+                    lines.append(f"{name}{_format(labels)} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines: list[str], name: str):
+        kind, help = self._help.get(name, ("untyped", ""))
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines, with the fields passed in ``extra``."""
+
+    _RESERVED = set(vars(logging.makeLogRecord({})))
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a record.
+
+        Args:
+            record: The log record.
+
+        Returns:
+            One line of JSON.
+        """
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in self._RESERVED and not key.startswith("_")
+        )
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def setup_logging(log_filepath: str = LOG_FILE):
+    """Write the app's logs and spans to a file as JSON lines.
+
+    Errors also go to a file next to it with the ``.err`` extension.
+
+    Args:
+        log_filepath: The log file path, or empty to leave logging alone.
+    """
+    if not log_filepath:
+        return
+    root, _ = os.path.splitext(log_filepath)
+    file_handler = logging.FileHandler(log_filepath, "a")
+    file_handler.setLevel(logging.INFO)
+    error_handler = logging.FileHandler(f"{root}.err", "a")
+    error_handler.setLevel(logging.ERROR)
+    formatter = JsonFormatter()
+    for handler in (file_handler, error_handler):
+        handler.setFormatter(formatter)
+    logger = logging.getLogger("chat")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    logger.addHandler(error_handler)
+
+
+def _labels(labels: dict[str, str]) -> _Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format(labels: _Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# The registry shared by all sessions of this process.
+metrics = Metrics()
+
+metrics.counter("chat_questions_total", "Questions answered, by outcome.")
+metrics.histogram("chat_prompt_build_seconds", "Time to build the prompt.")
+metrics.histogram("chat_retrieval_seconds", "Time to retrieve prompt context.")
+metrics.histogram("chat_queue_wait_seconds", "Time waiting for a model slot.")
+metrics.histogram("chat_time_to_first_token_seconds", "Time to the first chunk.")
+metrics.histogram("chat_llm_seconds", "Time the model took to answer.")
+metrics.histogram("chat_render_seconds", "Time to render a message to HTML.")
+metrics.histogram(
+    "chat_state_delta_bytes",
+    "Size of a sample of the streamed state updates.",
+    BYTES_BUCKETS,
+)
+metrics.counter("chat_images_total", "Image requests, by kind and outcome.")
+metrics.histogram("chat_image_seconds", "Time to generate one image.")
+metrics.histogram("chat_image_batch_seconds", "Time to generate a batch.")
+metrics.histogram("chat_upscale_seconds", "Time to upscale an image.")
@@ -0,0 +1,255 @@
+"""Completion notifications for Replicate predictions.
+
+Instead of every waiting task polling its own prediction, one watcher tracks
+all pending predictions of the process and wakes a waiting task only when the
+status of its prediction changes.
+
+Updates come from Replicate's webhooks when ``CHAT_REPLICATE_WEBHOOK_URL`` is
+set to the public URL of the receiver (see ``api.py``). A single poller is the
+fallback: it polls each pending prediction with an interval that grows while
+the status stays the same, and only as a slow safety net when webhooks are
+enabled.
+
+Webhook bodies are trusted only when their signature is checked against
+``CHAT_REPLICATE_WEBHOOK_SECRET``. Without a secret a webhook only makes the
+poller fetch that prediction right away.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+import replicate
+
+from .resilience import replicate_resilience
+
+logger = logging.getLogger(__name__)
+
+# Public URL of the webhook receiver, e.g. https://host/replicate/webhook.
+# Empty to rely on polling.
+WEBHOOK_URL = os.getenv("CHAT_REPLICATE_WEBHOOK_URL", "")
+# The signing secret of the webhooks (whsec_...). Empty to not trust bodies.
+WEBHOOK_SECRET = os.getenv("CHAT_REPLICATE_WEBHOOK_SECRET", "")
+# Seconds between polls of a prediction, growing by POLL_BACKOFF while its
+# status does not change.
+POLL_MIN = float(os.getenv("CHAT_PREDICTION_POLL_MIN", "0.5"))
+POLL_MAX = float(os.getenv("CHAT_PREDICTION_POLL_MAX", "5"))
+POLL_BACKOFF = 1.5
+# Seconds between safety-net polls when webhooks are enabled.
+WEBHOOK_POLL_INTERVAL = 30.0
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+@dataclass
+class PredictionUpdate:
+    """The state of a prediction."""
+
+    id: str
+    status: str
+    output: Any = None
+    error: Any = None
+
+    @property
+    def finished(self) -> bool:
+        """Whether the prediction will not change anymore."""
+        return self.status in TERMINAL_STATUSES
+
+
+@dataclass(eq=False)
+class _Watch:
+    status: str
+    interval: float
+    next_poll: float
+    queues: list[asyncio.Queue] = field(default_factory=list)
+
+
+class PredictionWatcher:
+    """Track pending predictions and notify their waiters of status changes."""
+
+    def __init__(
+        self,
+        webhook_url: str = WEBHOOK_URL,
+        poll_min: float = POLL_MIN,
+        poll_max: float = POLL_MAX,
+    ):
+        """Create the watcher.
+
+        Args:
+            webhook_url: Public URL of the webhook receiver, or empty.
+            poll_min: Seconds between polls of a prediction that just changed.
+            poll_max: Most seconds between polls of a prediction.
+        """
+        self.webhook_url = webhook_url
+        self.poll_min = poll_min
+        self.poll_max = WEBHOOK_POLL_INTERVAL if webhook_url else poll_max
+        self._watches: dict[str, _Watch] = {}
+        self._wakeup = asyncio.Event()
+        self._poller: asyncio.Task | None = None
+
+    def create_params(self) -> dict[str, Any]:
+        """Get the parameters that make a new prediction report to the receiver.
+
+        Returns:
+            Keyword arguments for ``predictions.create``.
+        """
+        if not self.webhook_url:
+            return {}
+        return {
+            "webhook": self.webhook_url,
+            "webhook_events_filter": ["start", "completed"],
+        }
+
+    async def watch(self, prediction) -> AsyncIterator[PredictionUpdate]:
+        """Follow a prediction until it finishes.
+
+        Args:
+            prediction: The prediction, as returned when it was created.
+
+        Yields:
+            The prediction every time its status changes, ending with the
+            finished prediction.
+        """
+        update = _update(prediction)
+        if update.finished:
+            yield update
+            return
+        watch = self._watches.get(update.id)
+        if watch is None:
+            poll_in = self.poll_max if self.webhook_url else self.poll_min
+            watch = self._watches[update.id] = _Watch(
+                update.status, self.poll_min, time.monotonic() + poll_in
+            )
+        queue: asyncio.Queue = asyncio.Queue()
+        watch.queues.append(queue)
+        self._start_poller()
+        try:
+            while True:
+                update = await queue.get()
+                yield update
+                if update.finished:
+                    return
+        finally:
+            watch.queues.remove(queue)
+            if not watch.queues:
+                self._watches.pop(update.id, None)
+
+    async def wait(self, prediction) -> PredictionUpdate:
+        """Wait for a prediction to finish.
+
+        Args:
+            prediction: The prediction, as returned when it was created.
+
+        Returns:
+            The finished prediction.
+        """
+        async for update in self.watch(prediction):
+            pass
+        return update
+
+    def notify(self, data: dict[str, Any]):
+        """Take in a prediction sent by a trusted webhook.
+
+        Args:
+            data: The prediction, as sent in the webhook body.
+        """
+        self._update(_update(data))
+
+    def poke(self, prediction_id: str):
+        """Poll a prediction right away, e.g. after an unverified webhook.
+
+        Args:
+            prediction_id: The prediction id.
+        """
+        watch = self._watches.get(prediction_id)
+        if watch is not None:
+            watch.next_poll = 0.0
+            self._wakeup.set()
+
+    def _update(self, update: PredictionUpdate):
+        watch = self._watches.get(update.id)
+        if watch is None:
+            return
+        now = time.monotonic()
+        if update.status == watch.status and not update.finished:
+            # Nothing new: poll less often.
+            watch.interval = min(watch.interval * POLL_BACKOFF, self.poll_max)
+            watch.next_poll = now + watch.interval
+            return
+        watch.status = update.status
+        watch.interval = self.poll_min
+        watch.next_poll = now + (self.poll_max if self.webhook_url else self.poll_min)
+        for queue in watch.queues:
+            queue.put_nowait(update)
+
+    def _start_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        self._wakeup.set()
+
+    async def _poll(self):
+        """Poll the pending predictions that are due, until none are left."""
+        while True:
+            pending = {
+                prediction_id: watch
+                for prediction_id, watch in self._watches.items()
+                if watch.status not in TERMINAL_STATUSES
+            }
+            if not pending:
+                return
+            now = time.monotonic()
+            due = [
+                prediction_id
+                for prediction_id, watch in pending.items()
+                if watch.next_poll <= now
+            ]
+            if not due:
+                next_poll = min(watch.next_poll for watch in pending.values())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_poll - now)
+                except TimeoutError:
+                    pass
+                continue
+
+            results = await asyncio.gather(
+                *(self._fetch(prediction_id) for prediction_id in due),
+                return_exceptions=True,
+            )
+            for prediction_id, result in zip(due, results):
+                if not isinstance(result, Exception):
+                    self._update(result)
+                    continue
+                logger.warning(
+                    "Could not poll prediction %s: %s", prediction_id, result
+                )
+                watch = self._watches.get(prediction_id)
+                if watch is not None:
+                    watch.next_poll = time.monotonic() + self.poll_max
+
+    async def _fetch(self, prediction_id: str) -> PredictionUpdate:
+        prediction = await replicate_resilience.call(
+            lambda: replicate.predictions.async_get(prediction_id)
+        )
+        return _update(prediction)
+
+
+def _update(prediction) -> PredictionUpdate:
+    """Get the state of a prediction object or webhook body."""
+    if isinstance(prediction, dict):
+        return PredictionUpdate(
+            prediction["id"],
+            prediction["status"],
+            prediction.get("output"),
+            prediction.get("error"),
+        )
+    return PredictionUpdate(
+        prediction.id, prediction.status, prediction.output, prediction.error
+    )
+
+
+# The watcher shared by all sessions of this process.
+prediction_watcher = PredictionWatcher()
@@ -0,0 +1,123 @@
+"""Compact digests of loaded datasets for use in prompts.
+
+A digest describes the schema, missing values, distributions and a small
+stratified sample of a DataFrame. It is computed once when the data is loaded
+and its size does not depend on the number of rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Number of most frequent values listed for each categorical column.
+TOP_K = 5
+# Number of sample rows included in the digest.
+SAMPLE_ROWS = 10
+# Columns beyond this are only counted, not described.
+MAX_COLUMNS = 50
+# Longer cell values are cut in the digest.
+MAX_CELL_CHARS = 40
+# A column with at most this many distinct values can be used to stratify the
+# sample.
+MAX_STRATA = 20
+
+
+def profile_dataframe(
+    df: pd.DataFrame,
+    top_k: int = TOP_K,
+    sample_rows: int = SAMPLE_ROWS,
+    max_columns: int = MAX_COLUMNS,
+) -> str:
+    """Describe a DataFrame in a compact, fixed-size markdown digest.
+
+    Args:
+        df: The data to describe.
+        top_k: Number of most frequent values listed for categorical columns.
+        sample_rows: Number of sample rows to include.
+        max_columns: Maximum number of columns to describe.
+
+    Returns:
+        The digest text.
+    """
+    rows, cols = df.shape
+    described = df.iloc[:, :max_columns]
+    nulls = described.isna().sum()
+    numeric = described.select_dtypes("number")
+    stats = (
+        numeric.describe(percentiles=[0.25, 0.5, 0.75]).T
+        if not numeric.empty
+        else pd.DataFrame()
+    )
+
+    lines = [f"Dataset: {rows} rows x {cols} columns", "", "Columns:"]
+    for name in described.columns:
+        column = described[name]
+        summary = f"- {_cut(name)} ({column.dtype}, {nulls[name]} nulls)"
+        if name in stats.index:
+            s = stats.loc[name]
+            summary += (
+                f": min {s['min']:.4g}, p25 {s['25%']:.4g}, median {s['50%']:.4g}, "
+                f"p75 {s['75%']:.4g}, max {s['max']:.4g}, mean {s['mean']:.4g}"
+            )
+        elif pd.api.types.is_datetime64_any_dtype(column):
+            summary += f": from {column.min()} to {column.max()}"
+        else:
+            counts = column.value_counts().head(top_k)
+            top = ", ".join(f"{_cut(value)} ({n})" for value, n in counts.items())
+            summary += f": {column.nunique()} distinct, top {top}"
+        lines.append(summary)
+    if cols > max_columns:
+        lines.append(f"- ... and {cols - max_columns} more columns")
+
+    sample, strata = _stratified_sample(described, sample_rows)
+    if not sample.empty:
+        title = f"Sample rows (stratified by {strata})" if strata else "Sample rows"
+        table = sample.apply(lambda col: col.map(_cut)).to_markdown(index=False)
+        lines += ["", f"{title}:", table]
+    return "\n".join(lines)
+
+
+def _stratified_sample(df: pd.DataFrame, n: int) -> tuple[pd.DataFrame, str | None]:
+    """Sample rows, keeping every value of a low-cardinality column represented.
+
+    Args:
+        df: The data to sample.
+        n: The number of rows to sample.
+
+    Returns:
+        The sample and the name of the column it is stratified by, if any.
+    """
+    if len(df) <= n:
+        return df, None
+
+    candidates = {
+        name: df[name].nunique()
+        for name in df.select_dtypes(exclude=["number", "datetime"]).columns
+    }
+    candidates = {
+        name: count for name, count in candidates.items() if 1 < count <= MAX_STRATA
+    }
+    if not candidates:
+        return df.sample(n, random_state=0), None
+
+    strata = min(candidates, key=candidates.get)
+    # Share the sample between the groups in proportion to their size, with at
+    # least one row for each. Small groups are picked first so that they are
+    # not the ones cut when the quotas add up to more than n.
+    sizes = df[strata].value_counts()
+    quotas = (sizes / sizes.sum() * n).round().clip(lower=1).astype(int)
+    indices = df.groupby(strata, sort=False, observed=True).indices
+    rng = np.random.default_rng(0)
+    picked = []
+    for value in sizes.index[::-1]:
+        group = indices[value]
+        size = min(quotas[value], len(group))
+        picked.extend(rng.choice(group, size, replace=False))
+    return df.iloc[sorted(picked[:n])], str(strata)
+
+
+def _cut(value) -> str:
+    """Convert a value to text no longer than MAX_CELL_CHARS."""
+    text = str(value)
+    if len(text) > MAX_CELL_CHARS:
+        return text[: MAX_CELL_CHARS - 1] + "…"
+    return text
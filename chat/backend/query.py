@@ -0,0 +1,279 @@
+"""Restricted queries over loaded datasets.
+
+In analysis mode the model does not see the data itself. It writes a small JSON
+query instead, and the query runs here against the columnar copy of the
+dataset (the .ldb Parquet file or the cached Arrow file). Only the columns the
+query uses are read, filters are pushed down into the scan, and aggregation
+streams over the file in batches, so the data does not have to fit in memory.
+Only the aggregated result goes back into the chat.
+
+A query looks like::
+
+    {
+        "select": ["region", "sales"],
+        "where": [["year", ">=", 2020], ["region", "in", ["EU", "US"]]],
+        "group_by": ["region"],
+        "aggregate": [["sales", "sum"], ["*", "count"]],
+        "order_by": [["sales_sum", "desc"]],
+        "limit": 10
+    }
+"""
+
+import json
+import operator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import acero
+
+from .datasets import dataset_store
+
+# Most rows a query may return.
+MAX_RESULT_ROWS = 200
+
+_COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+_AGGREGATES = ("count", "count_distinct", "sum", "mean", "min", "max")
+
+QUERY_INSTRUCTIONS = f"""\
+You answer questions about a dataset by writing a query. Reply with a single
+JSON object and nothing else, using these optional keys:
+- "select": list of column names to return (ignored when aggregating)
+- "where": list of [column, operator, value] conditions that must all hold;
+  operators: {", ".join(_COMPARISONS)}, in, not in, contains, is null, not null
+- "group_by": list of column names
+- "aggregate": list of [column, function]; functions: {", ".join(_AGGREGATES)};
+  use "*" with count to count rows. Results are named <column>_<function>
+  (or "count" for ["*", "count"])
+- "order_by": list of [column, "asc" or "desc"] over the result columns
+- "limit": maximum number of rows, at most {MAX_RESULT_ROWS}
+"""
+
+
+def query_prompt(digest: str, question: str) -> str:
+    """Build the prompt asking the model for a query.
+
+    Args:
+        digest: The digest of the dataset.
+        question: The user's question.
+
+    Returns:
+        The prompt text.
+    """
+    return f"{QUERY_INSTRUCTIONS}\n{digest}\n\nQuestion: {question}"
+
+
+def parse_query(text: str) -> dict:
+    """Extract the query from the model's reply.
+
+    Args:
+        text: The reply, possibly wrapped in a markdown code block.
+
+    Returns:
+        The query.
+
+    Raises:
+        ValueError: If the reply does not contain a JSON object.
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError("The model did not return a query.")
+    query = json.loads(text[start : end + 1])
+    if not isinstance(query, dict):
+        raise ValueError("The query must be a JSON object.")
+    return query
+
+
+def run_query(
+    query: dict, source: tuple[str, str] | None, frame: pd.DataFrame | None = None
+) -> pd.DataFrame:
+    """Run a query against a dataset.
+
+    Args:
+        query: The query.
+        source: The path and format ("parquet" or "arrow") of the columnar
+            copy of the dataset, if there is one.
+        frame: The in-memory data, used when there is no columnar copy.
+
+    Returns:
+        The query result.
+
+    Raises:
+        ValueError: If the query is invalid.
+    """
+    try:
+        return _run_query(query, source, frame)
+    except (pa.ArrowException, OSError, TypeError, KeyError) as e:
+        raise ValueError(f"Invalid query: {e}") from e
+
+
+def query_dataset(handle: str, query: dict) -> pd.DataFrame:
+    """Run a query against a dataset in the dataset store.
+
+    Args:
+        handle: The dataset handle.
+        query: The query.
+
+    Returns:
+        The query result.
+
+    Raises:
+        KeyError: If the dataset is no longer in the store.
+        ValueError: If the query is invalid.
+    """
+    source = dataset_store.source(handle)
+    frame = dataset_store.get(handle) if source is None else None
+    return run_query(query, source, frame)
+
+
+def _run_query(
+    query: dict, source: tuple[str, str] | None, frame: pd.DataFrame | None
+) -> pd.DataFrame:
+    # Checked before any scan: Arrow aborts the process on a negative slice.
+    limit = _limit(query.get("limit", MAX_RESULT_ROWS))
+    if source is not None:
+        path, format = source
+        dataset = ds.dataset(path, format=format)
+    else:
+        dataset = ds.dataset(pa.Table.from_pandas(frame, preserve_index=False))
+    names = set(dataset.schema.names)
+
+    select = _columns(query.get("select", []), names, "select")
+    group_by = _columns(query.get("group_by", []), names, "group_by")
+    aggregates = [_aggregate(item, names) for item in query.get("aggregate", [])]
+    where = query.get("where", [])
+    condition = _condition(where, names)
+    if group_by and not aggregates:
+        aggregates = [("*", "count")]
+
+    if aggregates:
+        used = set(group_by) | {column for column, _ in aggregates if column != "*"}
+        # The filter runs after the scan, so it needs its columns too.
+        used |= {column for column, *_ in where}
+        table = _aggregate_table(
+            dataset, sorted(used), condition, group_by, aggregates
+        )
+    else:
+        columns = select or dataset.schema.names
+        if query.get("order_by"):
+            table = dataset.to_table(columns=columns, filter=condition)
+        else:
+            # Without ordering only the first rows are needed: stop scanning early.
+            table = dataset.head(limit, columns=columns, filter=condition)
+
+    order_by = query.get("order_by", [])
+    if order_by:
+        table = table.sort_by(_ordering(order_by, set(table.column_names)))
+    return table.slice(0, limit).to_pandas()
+
+
+def _limit(limit) -> int:
+    if isinstance(limit, bool) or not isinstance(limit, int):
+        raise ValueError('"limit" must be a whole number.')
+    if not 1 <= limit <= MAX_RESULT_ROWS:
+        raise ValueError(f'"limit" must be between 1 and {MAX_RESULT_ROWS}.')
+    return limit
+
+
+def _columns(columns: list, names: set[str], key: str) -> list[str]:
+    if not isinstance(columns, list):
+        raise ValueError(f'"{key}" must be a list of column names.')
+    unknown = [column for column in columns if column not in names]
+    if unknown:
+        raise ValueError(f"Unknown columns in {key}: {', '.join(map(str, unknown))}")
+    return columns
+
+
+def _aggregate(item: list, names: set[str]) -> tuple[str, str]:
+    column, function = item
+    if function not in _AGGREGATES:
+        raise ValueError(f"Unknown aggregate function: {function}")
+    if column == "*":
+        if function != "count":
+            raise ValueError('"*" can only be used with count.')
+    else:
+        _columns([column], names, "aggregate")
+    return column, function
+
+
+def _condition(where: list, names: set[str]) -> pc.Expression | None:
+    if not isinstance(where, list):
+        raise ValueError('"where" must be a list of conditions.')
+    condition = None
+    for item in where:
+        if not isinstance(item, list) or len(item) < 2:
+            raise ValueError(f"Invalid condition: {item}")
+        column, op, *value = item
+        _columns([column], names, "where")
+        if op in (*_COMPARISONS, "in", "not in", "contains") and len(value) != 1:
+            raise ValueError(f"{op} needs one value: {item}")
+        if op in ("in", "not in") and not isinstance(value[0], list):
+            raise ValueError(f"{op} needs a list of values: {item}")
+        field = pc.field(column)
+        if op in _COMPARISONS:
+            expression = _COMPARISONS[op](field, value[0])
+        elif op == "in":
+            expression = field.isin(value[0])
+        elif op == "not in":
+            expression = ~field.isin(value[0])
+        elif op == "contains":
+            expression = pc.match_substring(field, str(value[0]))
+        elif op == "is null":
+            expression = field.is_null()
+        elif op == "not null":
+            expression = field.is_valid()
+        else:
+            raise ValueError(f"Unknown operator: {op}")
+        condition = expression if condition is None else condition & expression
+    return condition
+
+
+def _aggregate_table(
+    dataset: ds.Dataset,
+    columns: list[str],
+    condition: pc.Expression | None,
+    group_by: list[str],
+    aggregates: list[tuple[str, str]],
+) -> pa.Table:
+    """Aggregate a dataset in a streaming scan -> filter -> aggregate plan."""
+    prefix = "hash_" if group_by else ""
+    specs = []
+    for column, function in aggregates:
+        if column == "*":
+            specs.append(([], f"{prefix}count_all", None, "count"))
+        else:
+            specs.append((column, f"{prefix}{function}", None, f"{column}_{function}"))
+
+    nodes = [
+        acero.Declaration(
+            "scan",
+            acero.ScanNodeOptions(
+                dataset, columns={c: pc.field(c) for c in columns}, filter=condition
+            ),
+        )
+    ]
+    if condition is not None:
+        # The scan only uses the filter to skip data; rows still need filtering.
+        nodes.append(acero.Declaration("filter", acero.FilterNodeOptions(condition)))
+    nodes.append(
+        acero.Declaration("aggregate", acero.AggregateNodeOptions(specs, keys=group_by))
+    )
+    return acero.Declaration.from_sequence(nodes).to_table()
+
+
+def _ordering(order_by: list, names: set[str]) -> list[tuple[str, str]]:
+    ordering = []
+    for column, direction in order_by:
+        _columns([column], names, "order_by")
+        ordering.append(
+            (column, "descending" if direction == "desc" else "ascending")
+        )
+    return ordering
@@ -0,0 +1,90 @@
+"""Server-side markdown rendering of finished messages.
+
+Finished messages do not change, so they are rendered to HTML once here and
+the client only inserts the result, instead of parsing markdown in the
+browser on every render. Raw HTML in the text is escaped and unsafe link
+schemes (``javascript:`` etc.) are not turned into links, so the output is
+safe to insert. Code blocks are highlighted with Pygments using inline styles.
+Renders are cached by a hash of the text.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from markdown_it import MarkdownIt
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+from .metrics import metrics
+
+# Number of rendered texts kept in memory.
+RENDER_CACHE_SIZE = int(os.getenv("CHAT_RENDER_CACHE_SIZE", "4096"))
+# The Pygments style of highlighted code blocks.
+CODE_STYLE = os.getenv("CHAT_CODE_STYLE", "github-dark")
+
+_formatter = HtmlFormatter(nowrap=True, noclasses=True, style=CODE_STYLE)
+
+
+def _highlight(code: str, lang: str, attrs: str) -> str:
+    try:
+        lexer = get_lexer_by_name(lang) if lang else None
+    except ClassNotFound:
+        lexer = None
+    if lexer is None:
+        # markdown-it escapes and wraps the code itself.
+        return ""
+    return highlight(code, lexer, _formatter)
+
+
+_markdown = (
+    MarkdownIt("commonmark", {"html": False, "highlight": _highlight})
+    .enable("table")
+    .enable("strikethrough")
+)
+
+
+class MarkdownRenderer:
+    """Render markdown to HTML, caching the results by content hash."""
+
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        """Create the renderer.
+
+        Args:
+            max_entries: Number of rendered texts kept in memory.
+        """
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, text: str) -> str:
+        """Render markdown text.
+
+        Args:
+            text: The markdown text.
+
+        Returns:
+            The sanitized HTML.
+        """
+        if not text:
+            return ""
+        key = hashlib.sha256(text.encode()).hexdigest()
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                return html
+        with metrics.span("chat_render_seconds"):
+            html = _markdown.render(text)
+        with self._lock:
+            self._entries[key] = html
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+
+# The renderer shared by all sessions of this process.
+markdown_renderer = MarkdownRenderer()
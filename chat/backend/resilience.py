@@ -0,0 +1,344 @@
+"""Retries, hedging and circuit breaking for model provider calls.
+
+Transient provider errors (rate limits, 5xx, dropped connections) are retried
+with exponential backoff and full jitter. A call that is slower than the
+hedging delay can be raced against a duplicate request, and the first answer
+wins. After a run of consecutive failures the circuit opens and calls fail
+fast until the provider has had time to recover; then one call at a time is
+let through to probe it.
+
+Each policy keeps counters of what it did, see ``Resilience.stats``.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import Counter
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
+from google.api_core import exceptions as google_exceptions
+from replicate.exceptions import ReplicateError
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Number of times a failed call is retried.
+RETRIES = int(os.getenv("CHAT_RETRIES", "3"))
+# Seconds of backoff before the first retry; doubles with every retry.
+BACKOFF_BASE = float(os.getenv("CHAT_BACKOFF_BASE", "0.5"))
+# Most seconds of backoff before a retry.
+BACKOFF_MAX = float(os.getenv("CHAT_BACKOFF_MAX", "8"))
+# Seconds after which a slow call is raced against a duplicate; 0 to disable.
+HEDGE_AFTER = float(os.getenv("CHAT_HEDGE_AFTER", "0"))
+# Consecutive failures that open the circuit.
+BREAKER_THRESHOLD = int(os.getenv("CHAT_BREAKER_THRESHOLD", "5"))
+# Seconds the circuit stays open before a call may probe the provider again.
+BREAKER_RESET = float(os.getenv("CHAT_BREAKER_RESET", "30"))
+
+_RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class TransientError(Exception):
+    """A provider failure that is worth retrying."""
+
+
+class CircuitOpenError(Exception):
+    """The provider is failing, so the call was not made."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an error is a transient provider failure.
+
+    Args:
+        error: The error raised by a provider call.
+
+    Returns:
+        True for rate limits, server errors, timeouts and connection errors.
+    """
+    if isinstance(
+        error,
+        (
+            TransientError,
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServerError,
+            google_exceptions.DeadlineExceeded,
+            google_exceptions.Aborted,
+            httpx.TransportError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, ReplicateError):
+        return error.status in _RETRYABLE_STATUS
+    return False
+
+
+def is_unsent(error: BaseException) -> bool:
+    """Whether a failed call surely had no effect at the provider.
+
+    Calls that are not idempotent (e.g. creating a prediction) may only be
+    retried on these errors: after a timeout or a server error the provider
+    may already have acted on the request.
+
+    Args:
+        error: The error raised by a provider call.
+
+    Returns:
+        True for rate limits and connection errors raised before the request
+        was sent.
+    """
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(error, ReplicateError):
+        return error.status == 429
+    return False
+
+
+class CircuitBreaker:
+    """Fail fast after a run of consecutive failures."""
+
+    def __init__(
+        self, threshold: int = BREAKER_THRESHOLD, reset_after: float = BREAKER_RESET
+    ):
+        """Create a closed breaker.
+
+        Args:
+            threshold: Consecutive failures that open the circuit.
+            reset_after: Seconds before an open circuit lets a probe through.
+        """
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: float | None = None
+        # When the probe in flight was let through, if there is one.
+        self._probe_at: float | None = None
+
+    @property
+    def state(self) -> str:
+        """The state of the circuit: "closed", "open" or "half-open"."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_after:
+            return "open"
+        return "half-open"
+
+    def check(self):
+        """Check that a call may be made.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with a
+                probe already in flight.
+        """
+        state = self.state
+        now = time.monotonic()
+        # A probe that never reported back (e.g. it was cancelled) expires.
+        probing = self._probe_at is not None and now - self._probe_at < self.reset_after
+        if state == "open" or (state == "half-open" and probing):
+            raise CircuitOpenError("The model provider is unavailable.")
+        if state == "half-open":
+            self._probe_at = now
+
+    def record_success(self):
+        """Close the circuit after a successful call."""
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+
+    def record_failure(self) -> bool:
+        """Count a failed call.
+
+        Returns:
+            Whether this failure opened the circuit.
+        """
+        self.failures += 1
+        self._probe_at = None
+        if self.opened_at is not None or self.failures >= self.threshold:
+            # A failed probe opens the circuit again for a full period.
+            was_closed = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return was_closed
+        return False
+
+
+class Resilience:
+    """A retry, hedging and circuit breaking policy for one provider."""
+
+    def __init__(
+        self,
+        name: str,
+        retries: int = RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        hedge_after: float = HEDGE_AFTER,
+        breaker: CircuitBreaker | None = None,
+    ):
+        """Create the policy.
+
+        Args:
+            name: The provider name, for logs.
+            retries: Number of times a failed call is retried.
+            backoff_base: Seconds of backoff before the first retry.
+            backoff_max: Most seconds of backoff before a retry.
+            hedge_after: Seconds after which a slow call is raced against a
+                duplicate, or 0 to never hedge.
+            breaker: The circuit breaker, a new one by default.
+        """
+        self.name = name
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.counters: Counter[str] = Counter()
+
+    async def call(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        hedge: bool = True,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+    ) -> T:
+        """Make a call with retries, hedging and circuit breaking.
+
+        Args:
+            attempt: Starts one attempt of the call.
+            hedge: Whether the call may be hedged. Only hedge idempotent calls.
+            retryable: Whether a failed attempt may be retried. Calls that are
+                not idempotent should pass ``is_unsent``.
+
+        Returns:
+            The result of the first successful attempt.
+
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        retry = 0
+        while True:
+            self.check()
+            try:
+                if hedge and self.hedge_after > 0:
+                    result = await self._hedged(attempt)
+                else:
+                    result = await attempt()
+            except Exception as e:
+                if (
+                    not self.record_failure(e)
+                    or not retryable(e)
+                    or retry >= self.retries
+                ):
+                    raise
+                await self.backoff(retry, e)
+                retry += 1
+            else:
+                self.record_success()
+                return result
+
+    def check(self):
+        """Check that the circuit lets a call through.
+
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        try:
+            self.breaker.check()
+        except CircuitOpenError:
+            self.counters["short_circuited"] += 1
+            raise
+        self.counters["attempts"] += 1
+
+    def record_success(self):
+        """Record a successful call."""
+        if self.breaker.state != "closed":
+            logger.info("%s circuit closed", self.name)
+        self.breaker.record_success()
+
+    def record_failure(self, error: BaseException) -> bool:
+        """Record a failed call.
+
+        Args:
+            error: The error of the call.
+
+        Returns:
+            Whether the error is worth retrying. Other errors (e.g. invalid
+            requests) are not the provider's fault and do not count against
+            the circuit.
+        """
+        if not is_retryable(error):
+            # The provider answered, so it is up.
+            self.breaker.record_success()
+            return False
+        self.counters["failures"] += 1
+        if self.breaker.record_failure():
+            self.counters["circuit_opened"] += 1
+            logger.warning("%s circuit opened after %s", self.name, error)
+        return True
+
+    async def backoff(self, retry: int, error: BaseException):
+        """Sleep before a retry.
+
+        Args:
+            retry: The number of retries made so far.
+            error: The error being retried.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**retry))
+        self.counters["retries"] += 1
+        logger.info(
+            "Retrying %s call in %.2fs after %s: %s",
+            self.name,
+            delay,
+            type(error).__name__,
+            error,
+        )
+        await asyncio.sleep(delay)
+
+    def stats(self) -> dict[str, int | str]:
+        """Get the counters.
+
+        Returns:
+            The counters and the state of the circuit.
+        """
+        return {**self.counters, "circuit": self.breaker.state}
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[T]]) -> T:
+        """Race a slow attempt against a duplicate one."""
+        first = asyncio.ensure_future(attempt())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if done:
+                return first.result()
+            self.counters["hedged"] += 1
+            tasks.append(asyncio.ensure_future(attempt()))
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                if not pending:
+                    # Both failed: report the first error.
+                    return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # Mark the error as seen.
+                    task.exception()
+
+
+# The policies of the providers, shared by all sessions of this process.
+gemini_resilience = Resilience("gemini")
+replicate_resilience = Resilience("replicate")
+for _policy in (gemini_resilience, replicate_resilience):
+    metrics.collect("chat_provider", _policy.stats, provider=_policy.name)
@@ -0,0 +1,175 @@
+"""Cache of model answers for repeated prompts.
+
+Answers are keyed on a normalized hash of the model, system prompt, context
+and question, so identical questions (canned prompts, re-asks after a refresh)
+skip the model round trip. Entries live in an in-memory LRU tier and, when a
+cache directory is configured, in an on-disk tier that survives restarts. Both
+tiers expire entries after a TTL.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Number of answers kept in memory.
+RESPONSE_CACHE_SIZE = int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", "1024"))
+# Seconds an answer stays valid.
+RESPONSE_CACHE_TTL = float(os.getenv("CHAT_RESPONSE_CACHE_TTL", "3600"))
+# Directory of the on-disk tier; empty to keep answers in memory only.
+RESPONSE_CACHE_DIR = os.getenv("CHAT_RESPONSE_CACHE_DIR", "")
+
+
+def response_cache_key(
+    model: str, system_prompt: str, context: str, question: str
+) -> str:
+    """Get the cache key of a prompt.
+
+    Case and runs of whitespace are ignored, so trivially different spellings
+    of the same question share an entry.
+
+    Args:
+        model: The model name.
+        system_prompt: The system prompt.
+        context: The conversation context sent with the question.
+        question: The question.
+
+    Returns:
+        The key.
+    """
+    parts = (model, system_prompt, context, question)
+    normalized = "\0".join(" ".join(part.split()).casefold() for part in parts)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class ResponseCache:
+    """A two-tier (memory, disk) cache of answers with a TTL."""
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_SIZE,
+        ttl: float = RESPONSE_CACHE_TTL,
+        directory: str = RESPONSE_CACHE_DIR,
+    ):
+        """Create the cache.
+
+        Args:
+            max_entries: Number of answers kept in memory.
+            ttl: Seconds an answer stays valid.
+            directory: Directory of the on-disk tier, or empty for none.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        """Look up an answer.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            The cached answer, or None if there is no valid entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+        entry = self._read(key)
+        with self._lock:
+            if entry is not None and entry[1] > now:
+                self._remember(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[0]
+            self.misses += 1
+        if entry is not None:
+            # Expired on disk too.
+            self._delete(key)
+        return None
+
+    def put(self, key: str, answer: str):
+        """Store an answer.
+
+        Args:
+            key: The cache key.
+            answer: The answer.
+        """
+        entry = (answer, time.time() + self.ttl)
+        with self._lock:
+            self._remember(key, entry)
+        self._write(key, entry)
+
+    def stats(self) -> dict[str, int]:
+        """Get the hit and miss counters.
+
+        Returns:
+            The counters and the number of entries in memory.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+            }
+
+    def _remember(self, key: str, entry: tuple[str, float]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read(self, key: str) -> tuple[str, float] | None:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                data = json.load(f)
+            return data["answer"], data["expires"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _write(self, key: str, entry: tuple[str, float]):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"answer": entry[0], "expires": entry[1]}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write response cache entry: %s", e)
+
+
+# The cache shared by all sessions of this process.
+response_cache = ResponseCache()
+metrics.collect("chat_response_cache", response_cache.stats)
@@ -0,0 +1,416 @@
+"""Semantic retrieval over loaded datasets and chat history.
+
+Instead of pasting data or old turns into the prompt, snippets are embedded
+into local vector indexes and only the few most similar to the question are
+put into the prompt. Each loaded dataset gets an index of its columns and a
+sample of its rows, and each chat an index of its turns. Chat turns still in
+the prompt window are not retrieved again.
+
+Embeddings are made offline: by default with a deterministic hashing
+embedder, or with a local sentence-transformers model when
+``CHAT_EMBEDDING_MODEL`` names one. Search is an exact cosine search, a single
+matrix product over the normalized vectors.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+from .context import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Whether snippets are retrieved into prompts.
+RETRIEVAL_ENABLED = os.getenv("CHAT_RETRIEVAL", "1") != "0"
+# Number of snippets put into a prompt.
+RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "5"))
+# Most (estimated) tokens of retrieved snippets in a prompt.
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("CHAT_RETRIEVAL_TOKENS", "1000"))
+# Snippets less similar to the question than this are left out.
+RETRIEVAL_MIN_SCORE = float(os.getenv("CHAT_RETRIEVAL_MIN_SCORE", "0.2"))
+# Most rows of a dataset that are indexed; larger datasets are sampled evenly.
+RETRIEVAL_MAX_ROWS = int(os.getenv("CHAT_RETRIEVAL_MAX_ROWS", "10000"))
+# A local sentence-transformers model, e.g. "all-MiniLM-L6-v2". Empty to use
+# the hashing embedder.
+EMBEDDING_MODEL = os.getenv("CHAT_EMBEDDING_MODEL", "")
+# Dimensions of the hashing embedder. Fewer dimensions make more unrelated
+# words collide.
+HASH_DIMENSIONS = int(os.getenv("CHAT_EMBEDDING_DIMENSIONS", "1024"))
+# Number of chats and datasets whose index is kept in memory.
+MAX_INDEXES = 256
+# Most characters of a snippet.
+MAX_SNIPPET_CHARS = 400
+# Starts the section of retrieved snippets in a prompt.
+_CONTEXT_HEADER = "Relevant context:\n"
+
+_WORD = re.compile(r"\w+")
+# Words too common to tell texts apart.
+_STOPWORDS = frozenset(
+    "a about an and are as at be by can do does for from how i in is it me of on "
+    "or please tell that the this to was what when where which who why with you"
+    .split()
+)
+
+
+@lru_cache(maxsize=65536)
+def _bucket(feature: str, dimensions: int) -> tuple[int, float]:
+    # A stable hash: Python's hash() of strings changes between processes.
+    value = int.from_bytes(
+        hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little"
+    )
+    return value % dimensions, 1.0 if value >> 63 else -1.0
+
+
+class HashEmbedder:
+    """Embed texts by hashing their words and word pairs into a vector.
+
+    Texts that share words get similar vectors. It needs no model and gives
+    the same vectors in every process, which also makes it fit for tests.
+    """
+
+    def __init__(self, dimensions: int = HASH_DIMENSIONS):
+        """Create the embedder.
+
+        Args:
+            dimensions: The length of the vectors.
+        """
+        self.dimensions = dimensions
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed texts.
+
+        Args:
+            texts: The texts.
+
+        Returns:
+            One unit-length float32 vector per text.
+        """
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            words = [
+                word
+                for word in _WORD.findall(text.lower())
+                # Single letters are left over from contractions ("what's").
+                if word not in _STOPWORDS and (len(word) > 1 or word.isdigit())
+            ]
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            for feature in features:
+                column, sign = _bucket(feature, self.dimensions)
+                rows.append(row)
+                columns.append(column)
+                signs.append(sign)
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(vectors, (rows, columns), signs)
+        return _normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """Embed texts with a local sentence-transformers model."""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL):
+        """Load the model.
+
+        Args:
+            model_name: The model name or path.
+        """
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed texts.
+
+        Args:
+            texts: The texts.
+
+        Returns:
+            One unit-length float32 vector per text.
+        """
+        vectors = self.model.encode(
+            list(texts), normalize_embeddings=True, convert_to_numpy=True
+        )
+        return vectors.astype(np.float32)
+
+
+def make_embedder(model_name: str = EMBEDDING_MODEL):
+    """Create the configured embedder.
+
+    Args:
+        model_name: A local sentence-transformers model, or empty.
+
+    Returns:
+        The model embedder, or the hashing embedder if there is no model or it
+        cannot be loaded.
+    """
+    if model_name:
+        try:
+            return SentenceTransformerEmbedder(model_name)
+        except Exception as e:
+            logger.warning(
+                "Could not load embedding model %s, hashing instead: %s",
+                model_name,
+                e,
+            )
+    return HashEmbedder()
+
+
+class VectorIndex:
+    """Snippets and their vectors, searched by cosine similarity."""
+
+    def __init__(self):
+        """Create an empty index."""
+        self.snippets: list[str] = []
+        self._vectors: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        """The number of snippets."""
+        return len(self.snippets)
+
+    def add(self, snippets: Sequence[str], vectors: np.ndarray):
+        """Add snippets.
+
+        Args:
+            snippets: The snippets.
+            vectors: Their unit-length vectors, one row per snippet.
+        """
+        if not len(snippets):
+            return
+        size = len(self.snippets)
+        needed = size + len(snippets)
+        if self._vectors is None or needed > len(self._vectors):
+            # Grow by doubling, so adding one turn at a time stays cheap.
+            capacity = max(needed, 2 * (0 if self._vectors is None else size), 16)
+            grown = np.zeros((capacity, vectors.shape[1]), dtype=np.float32)
+            if self._vectors is not None:
+                grown[:size] = self._vectors[:size]
+            self._vectors = grown
+        self._vectors[size:needed] = vectors
+        self.snippets.extend(snippets)
+
+    def search(
+        self, vector: np.ndarray, k: int, limit: int | None = None
+    ) -> list[tuple[float, str]]:
+        """Find the snippets most similar to a vector.
+
+        Args:
+            vector: The unit-length query vector.
+            k: The number of snippets.
+            limit: Only search the first snippets, or None for all.
+
+        Returns:
+            Up to k (similarity, snippet) pairs, most similar first.
+        """
+        size = len(self.snippets) if limit is None else min(limit, len(self))
+        if size == 0 or k <= 0:
+            return []
+        scores = self._vectors[:size] @ vector
+        if size > k:
+            # Only the top k need sorting.
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(size)
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(float(scores[i]), self.snippets[i]) for i in top]
+
+
+class Retriever:
+    """Keep the vector indexes of datasets and chats, and search them."""
+
+    def __init__(
+        self,
+        embedder=None,
+        top_k: int = RETRIEVAL_TOP_K,
+        token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+        min_score: float = RETRIEVAL_MIN_SCORE,
+    ):
+        """Create the retriever.
+
+        Args:
+            embedder: Embeds texts, the configured embedder by default.
+            top_k: The number of snippets put into a prompt.
+            token_budget: Most tokens of snippets in a prompt.
+            min_score: The least similarity of a retrieved snippet.
+        """
+        self._embedder = embedder
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.min_score = min_score
+        self._indexes: OrderedDict[str, VectorIndex] = OrderedDict()
+        # Keys of the chat turns in each chat index, to tell if it is current.
+        self._turn_keys: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+        # Held while a chat index is checked and extended, so two requests
+        # never append to the same index.
+        self._chat_lock = threading.Lock()
+
+    @property
+    def embedder(self):
+        """The embedder, created on first use."""
+        if self._embedder is None:
+            self._embedder = make_embedder()
+        return self._embedder
+
+    def index_dataset(self, handle: str, df: pd.DataFrame):
+        """Index the columns and a sample of the rows of a dataset.
+
+        Args:
+            handle: The dataset handle.
+            df: The data.
+        """
+        snippets = [_column_snippet(df[column]) for column in df.columns]
+        if len(df) > RETRIEVAL_MAX_ROWS:
+            positions = np.linspace(0, len(df) - 1, RETRIEVAL_MAX_ROWS).astype(int)
+            sample = df.iloc[positions]
+        else:
+            sample = df
+        columns = [str(column) for column in df.columns]
+        for position, values in zip(sample.index, sample.astype(str).values):
+            cells = "; ".join(f"{c}={v}" for c, v in zip(columns, values))
+            snippets.append(f"Row {position}: {cells}"[:MAX_SNIPPET_CHARS])
+        index = VectorIndex()
+        index.add(snippets, self.embedder.embed(snippets))
+        self._put(f"data:{handle}", index)
+
+    def drop_dataset(self, handle: str):
+        """Drop the index of a dataset.
+
+        Args:
+            handle: The dataset handle.
+        """
+        self._drop(f"data:{handle}")
+
+    def forget_chat(self, chat_key: str):
+        """Drop the index of a chat.
+
+        Args:
+            chat_key: Identifies the chat.
+        """
+        self._drop(f"chat:{chat_key}")
+
+    def context(
+        self,
+        question: str,
+        chat_key: str,
+        history: Sequence[tuple[str, str]],
+        window_start: int,
+        handle: str = "",
+    ) -> str:
+        """Get the snippets relevant to a question, to put into its prompt.
+
+        Args:
+            question: The question.
+            chat_key: Identifies the chat.
+            history: The earlier (question, answer) turns, oldest first.
+            window_start: The number of old turns not in the prompt window;
+                only these are retrieved.
+            handle: The handle of the loaded dataset, or empty.
+
+        Returns:
+            The snippets as a prompt section, or empty if none are relevant.
+        """
+        vector = self.embedder.embed([question])[0]
+        found = []
+        if window_start > 0:
+            index = self._chat_index(f"chat:{chat_key}", history)
+            found += [
+                (score, "Earlier in this chat: " + snippet)
+                for score, snippet in index.search(vector, self.top_k, window_start)
+            ]
+        if handle:
+            with self._lock:
+                index = self._indexes.get(f"data:{handle}")
+            if index is not None:
+                found += [
+                    (score, "From the loaded data: " + snippet)
+                    for score, snippet in index.search(vector, self.top_k)
+                ]
+
+        lines = []
+        # Count the header and line breaks too: prompts reserve token_budget
+        # for the whole section.
+        used = estimate_tokens(_CONTEXT_HEADER)
+        for score, snippet in sorted(found, reverse=True)[: self.top_k]:
+            if score < self.min_score:
+                break
+            line = f"- {snippet}"
+            used += estimate_tokens(line) + 1
+            if used > self.token_budget:
+                break
+            lines.append(line)
+        if not lines:
+            return ""
+        return _CONTEXT_HEADER + "\n".join(lines)
+
+    def _chat_index(
+        self, key: str, history: Sequence[tuple[str, str]]
+    ) -> VectorIndex:
+        """Get the index of a chat, embedding only the turns added since."""
+        with self._chat_lock:
+            return self._update_chat_index(key, history)
+
+    def _update_chat_index(
+        self, key: str, history: Sequence[tuple[str, str]]
+    ) -> VectorIndex:
+        with self._lock:
+            index = self._indexes.get(key)
+            turn_keys = self._turn_keys.get(key, [])
+        # Like the prompt prefix, the history only grows by appending.
+        if index is None or (
+            turn_keys
+            and (
+                len(turn_keys) > len(history)
+                or turn_keys[-1] != hash(tuple(history[len(turn_keys) - 1]))
+            )
+        ):
+            index, turn_keys = VectorIndex(), []
+        new_turns = history[len(turn_keys) :]
+        if new_turns:
+            snippets = [
+                f"Q: {question}\nA: {answer}"[:MAX_SNIPPET_CHARS]
+                for question, answer in new_turns
+            ]
+            # Weigh the question as much as the answer, which is often long.
+            vectors = self.embedder.embed(
+                [question for question, _ in new_turns]
+            ) + self.embedder.embed([answer for _, answer in new_turns])
+            index.add(snippets, _normalize(vectors))
+            turn_keys = turn_keys + [hash(tuple(turn)) for turn in new_turns]
+        self._put(key, index)
+        with self._lock:
+            self._turn_keys[key] = turn_keys
+        return index
+
+    def _drop(self, key: str):
+        with self._lock:
+            self._indexes.pop(key, None)
+            self._turn_keys.pop(key, None)
+
+    def _put(self, key: str, index: VectorIndex):
+        with self._lock:
+            self._indexes[key] = index
+            self._indexes.move_to_end(key)
+            while len(self._indexes) > MAX_INDEXES:
+                dropped, _ = self._indexes.popitem(last=False)
+                self._turn_keys.pop(dropped, None)
+
+
+def _column_snippet(column: pd.Series) -> str:
+    values = ", ".join(map(str, column.dropna().unique()[:5]))
+    return f"Column {column.name} ({column.dtype}), e.g. {values}"[:MAX_SNIPPET_CHARS]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# The retriever shared by all sessions of this process.
+retriever = Retriever()
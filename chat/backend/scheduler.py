@@ -0,0 +1,323 @@
+"""Fair scheduling of outbound model requests.
+
+Every request to a model provider (chat answers, data queries, image
+generation) takes a slot from the scheduler first. The scheduler enforces a
+global and a per-user limit on requests in flight, and global and per-user
+requests-per-minute budgets with token buckets, so bursts queue up here
+instead of running into provider rate limits.
+
+Waiting requests are granted round robin across users, so one user with many
+requests cannot starve the others, and each waiting request can tell its
+position in the queue.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from .metrics import metrics
+
+# Maximum number of requests in flight across all users.
+SCHEDULER_CONCURRENCY = int(os.getenv("CHAT_SCHEDULER_CONCURRENCY", "16"))
+# Maximum number of requests in flight per user.
+SCHEDULER_USER_CONCURRENCY = int(os.getenv("CHAT_SCHEDULER_USER_CONCURRENCY", "2"))
+# Requests started per minute across all users.
+SCHEDULER_RPM = float(os.getenv("CHAT_SCHEDULER_RPM", "600"))
+# Requests started per minute per user.
+SCHEDULER_USER_RPM = float(os.getenv("CHAT_SCHEDULER_USER_RPM", "30"))
+# Seconds of budget a bucket can save up for a burst.
+BURST_SECONDS = 10
+# Number of per-user buckets kept before idle ones are swept.
+MAX_IDLE_BUCKETS = 1024
+
+
+class TokenBucket:
+    """A token bucket refilled at a constant rate."""
+
+    def __init__(self, per_minute: float, burst_seconds: float = BURST_SECONDS):
+        """Create a full bucket.
+
+        Args:
+            per_minute: Tokens added per minute.
+            burst_seconds: Seconds of tokens the bucket holds when full.
+        """
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Get the seconds until a token is available.
+
+        Args:
+            now: The current monotonic time.
+
+        Returns:
+            0 if a token is available now.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        """Take a token. Call wait_time first to check one is available.
+
+        Args:
+            now: The current monotonic time.
+        """
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """Whether the bucket is full.
+
+        Args:
+            now: The current monotonic time.
+
+        Returns:
+            True if no tokens are missing.
+        """
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def _refill(self, now: float):
+        # A bucket created after now was read has nothing to refill yet.
+        if now <= self.updated:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+@dataclass(eq=False)
+class Ticket:
+    """A request waiting for or holding a slot."""
+
+    user: str
+    future: asyncio.Future = field(repr=False)
+    released: bool = False
+
+    @property
+    def granted(self) -> bool:
+        """Whether the request may run."""
+        return self.future.done()
+
+
+class Scheduler:
+    """Grant slots to requests within concurrency and rate budgets."""
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_CONCURRENCY,
+        user_concurrency: int = SCHEDULER_USER_CONCURRENCY,
+        rpm: float = SCHEDULER_RPM,
+        user_rpm: float = SCHEDULER_USER_RPM,
+    ):
+        """Create the scheduler.
+
+        Args:
+            max_concurrency: Maximum number of requests in flight.
+            user_concurrency: Maximum number of requests in flight per user.
+            rpm: Requests started per minute across all users.
+            user_rpm: Requests started per minute per user.
+        """
+        self.max_concurrency = max_concurrency
+        self.user_concurrency = user_concurrency
+        self.user_rpm = user_rpm
+        self._bucket = TokenBucket(rpm)
+        self._user_buckets: dict[str, TokenBucket] = {}
+        # Users with waiting requests, in the order they are served.
+        self._ring: deque[str] = deque()
+        self._waiting: dict[str, deque[Ticket]] = {}
+        self._running: dict[str, int] = {}
+        self._active = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self._timer_at = 0.0
+
+    def submit(self, user: str) -> Ticket:
+        """Queue a request.
+
+        Args:
+            user: Identifies the user the request is for.
+
+        Returns:
+            The ticket of the request. It must be released when the request
+            is done, or abandoned.
+        """
+        ticket = Ticket(user, asyncio.get_running_loop().create_future())
+        if user not in self._waiting:
+            self._waiting[user] = deque()
+            self._ring.append(user)
+        self._waiting[user].append(ticket)
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: Ticket, timeout: float | None = None) -> bool:
+        """Wait for a request to be granted a slot.
+
+        Args:
+            ticket: The ticket of the request.
+            timeout: Seconds to wait, or None to wait until granted.
+
+        Returns:
+            Whether the request was granted a slot.
+        """
+        done, _ = await asyncio.wait([ticket.future], timeout=timeout)
+        return bool(done)
+
+    def position(self, ticket: Ticket) -> int:
+        """Get the position of a waiting request in the queue.
+
+        Args:
+            ticket: The ticket of the request.
+
+        Returns:
+            1 for the next request to be granted, 0 if it is already granted.
+        """
+        if ticket.granted or ticket.released:
+            return 0
+        queue = self._waiting[ticket.user]
+        index = queue.index(ticket)
+        ahead = index
+        before = True
+        for user in self._ring:
+            if user == ticket.user:
+                before = False
+                continue
+            # Round robin: every user before this one in the ring is served
+            # once more than the users after it.
+            ahead += min(len(self._waiting[user]), index + before)
+        return ahead + 1
+
+    def release(self, ticket: Ticket):
+        """Give back the slot of a finished request, or abandon a waiting one.
+
+        Args:
+            ticket: The ticket of the request.
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        user = ticket.user
+        if ticket.granted:
+            self._active -= 1
+            self._running[user] -= 1
+            if not self._running[user]:
+                del self._running[user]
+        else:
+            ticket.future.cancel()
+            self._waiting[user].remove(ticket)
+            if not self._waiting[user]:
+                self._remove_waiting(user)
+        self._forget_idle([user])
+        if len(self._user_buckets) > MAX_IDLE_BUCKETS:
+            self._forget_idle(list(self._user_buckets))
+        self._dispatch()
+
+    def stats(self) -> dict[str, int]:
+        """Get the number of requests in flight and waiting.
+
+        Returns:
+            The counts.
+        """
+        return {
+            "active": self._active,
+            "waiting": sum(len(queue) for queue in self._waiting.values()),
+            "waiting_users": len(self._ring),
+        }
+
+    @asynccontextmanager
+    async def slot(self, user: str) -> AsyncIterator[None]:
+        """Hold a slot while the body runs.
+
+        Args:
+            user: Identifies the user the request is for.
+        """
+        ticket = self.submit(user)
+        try:
+            await self.wait(ticket)
+            yield
+        finally:
+            self.release(ticket)
+
+    def _dispatch(self):
+        """Grant slots to waiting requests, round robin across users."""
+        now = time.monotonic()
+        retry_in = None
+        while self._active < self.max_concurrency and self._ring:
+            wait = self._bucket.wait_time(now)
+            if wait:
+                retry_in = wait
+                break
+            granted = False
+            for _ in range(len(self._ring)):
+                user = self._ring[0]
+                self._ring.rotate(-1)
+                if self._running.get(user, 0) >= self.user_concurrency:
+                    continue
+                bucket = self._user_bucket(user)
+                wait = bucket.wait_time(now)
+                if wait:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    continue
+                self._bucket.take(now)
+                bucket.take(now)
+                self._grant(self._waiting[user].popleft())
+                if not self._waiting[user]:
+                    self._remove_waiting(user)
+                granted = True
+                break
+            if not granted:
+                break
+
+        if retry_in is not None and (
+            self._timer is None or now + retry_in < self._timer_at
+        ):
+            # Try again once the budget has refilled.
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer_at = now + retry_in
+            self._timer = asyncio.get_running_loop().call_later(
+                retry_in, self._on_timer
+            )
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _grant(self, ticket: Ticket):
+        self._active += 1
+        self._running[ticket.user] = self._running.get(ticket.user, 0) + 1
+        ticket.future.set_result(None)
+
+    def _remove_waiting(self, user: str):
+        del self._waiting[user]
+        self._ring.remove(user)
+
+    def _user_bucket(self, user: str) -> TokenBucket:
+        bucket = self._user_buckets.get(user)
+        if bucket is None:
+            bucket = self._user_buckets[user] = TokenBucket(self.user_rpm)
+        return bucket
+
+    def _forget_idle(self, users: list[str]):
+        # A full bucket is the same as a new one, so idle users need no state.
+        now = time.monotonic()
+        for user in users:
+            bucket = self._user_buckets.get(user)
+            if (
+                bucket is not None
+                and user not in self._waiting
+                and user not in self._running
+                and bucket.full(now)
+            ):
+                del self._user_buckets[user]
+
+
+# The scheduler of all outbound model requests of this process.
+scheduler = Scheduler()
+metrics.collect("chat_scheduler", scheduler.stats)
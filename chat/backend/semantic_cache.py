@@ -0,0 +1,211 @@
+"""Cache of model answers for similar questions.
+
+The response cache only matches prompts that are the same after
+normalization. This cache also matches paraphrases: the answer of the most
+similar earlier question is reused when the similarity of the questions is
+above a threshold and they were asked in the same context.
+
+The context (e.g. the previous question) must be the same after
+normalization, not merely similar: "What is my name?" has a different answer
+after "My name is Bob" than after "My name is Alice". Answers given in a
+context are also only reused within the same chat, since the rest of the
+conversation may differ; only questions asked without context are shared
+across chats and users.
+
+Entries are only matched within a scope (the model, system prompt and loaded
+dataset), expire after a TTL, and the least recently used are evicted when
+the cache is full. The vectors of all entries are kept in one matrix, so a
+lookup is a single matrix product.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from .metrics import metrics
+from .retrieval import retriever
+
+# Whether answers to similar questions are reused.
+SEMANTIC_CACHE_ENABLED = os.getenv("CHAT_SEMANTIC_CACHE", "1") != "0"
+# Least similarity of a question to a cached one for its answer to be reused.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("CHAT_SEMANTIC_CACHE_THRESHOLD", "0.9"))
+# Seconds an answer stays valid.
+SEMANTIC_CACHE_TTL = float(os.getenv("CHAT_SEMANTIC_CACHE_TTL", "3600"))
+# Number of answers kept.
+SEMANTIC_CACHE_SIZE = int(os.getenv("CHAT_SEMANTIC_CACHE_SIZE", "4096"))
+
+CACHED_MARKER = "\n\n♻️ _Answer reused from a similar question._"
+
+
+@dataclass(frozen=True)
+class SemanticKey:
+    """The embedded question and the hashed context of a lookup."""
+
+    scope: int
+    context: int
+    vector: np.ndarray
+
+
+def _hash(text: str) -> int:
+    """Hash a text, ignoring case and whitespace, to a signed 64-bit int."""
+    normalized = " ".join(text.split()).casefold()
+    digest = hashlib.blake2b(normalized.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class SemanticCache:
+    """A size-bounded cache of answers, matched by question similarity."""
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: float = SEMANTIC_CACHE_TTL,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        embedder=None,
+    ):
+        """Create the cache.
+
+        Args:
+            threshold: Least similarity for a cached answer to be reused.
+            ttl: Seconds an answer stays valid.
+            max_entries: Number of answers kept.
+            embedder: Embeds texts, the retriever's embedder by default.
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._embedder = embedder
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Slot -> answer, least recently used first. The vector, scope,
+        # context and expiry of a slot are rows of the arrays below.
+        self._entries: OrderedDict[int, str] = OrderedDict()
+        self._vectors: np.ndarray | None = None
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._contexts = np.zeros(max_entries, dtype=np.int64)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._lock = threading.Lock()
+
+    @property
+    def embedder(self):
+        """The embedder."""
+        return self._embedder or retriever.embedder
+
+    def key(
+        self, question: str, context: str = "", scope: str = "", chat: str = ""
+    ) -> SemanticKey:
+        """Embed a question for a lookup.
+
+        Args:
+            question: The question.
+            context: The context the question is asked in, e.g. the previous
+                question. Only questions asked in the same context match.
+            scope: Only entries with the same scope match, e.g. the model.
+            chat: Identifies the chat of the question, and its user.
+                Questions asked with a context only match those of the same
+                chat.
+
+        Returns:
+            The key to look the question up and store its answer with.
+        """
+        vector = self.embedder.embed([question])[0].astype(np.float32)
+        vector /= max(float(np.linalg.norm(vector)), 1e-12)
+        if context.strip():
+            scope = f"{scope}\0{chat}"
+        return SemanticKey(_hash(scope), _hash(context), vector)
+
+    def get(self, key: SemanticKey) -> str | None:
+        """Look up the answer to the most similar question.
+
+        Args:
+            key: The key of the question.
+
+        Returns:
+            The cached answer, or None if no valid entry is similar enough.
+        """
+        with self._lock:
+            slot, score = self._nearest(key)
+            if slot is None or score < self.threshold:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            return self._entries[slot]
+
+    def put(self, key: SemanticKey, answer: str):
+        """Store an answer.
+
+        Args:
+            key: The key of the question.
+            answer: The answer.
+        """
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros(
+                    (self.max_entries, len(key.vector)), dtype=np.float32
+                )
+            slot, score = self._nearest(key)
+            if slot is None or score < self.threshold:
+                slot = self._free_slot()
+            self._vectors[slot] = key.vector
+            self._scopes[slot] = key.scope
+            self._contexts[slot] = key.context
+            self._expires[slot] = time.time() + self.ttl
+            self._entries[slot] = answer
+            self._entries.move_to_end(slot)
+
+    def stats(self) -> dict[str, int | float]:
+        """Get the hit and miss counters.
+
+        Returns:
+            The counters, the hit rate and the number of entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+            }
+
+    def _nearest(self, key: SemanticKey) -> tuple[int | None, float]:
+        """Find the most similar valid entry in the key's scope and context."""
+        if not self._entries:
+            return None, 0.0
+        scores = self._vectors @ key.vector
+        valid = (
+            (self._scopes == key.scope)
+            & (self._contexts == key.context)
+            & (self._expires > time.time())
+        )
+        scores[~valid] = -np.inf
+        slot = int(np.argmax(scores))
+        if not valid[slot]:
+            return None, 0.0
+        return slot, float(scores[slot])
+
+    def _free_slot(self) -> int:
+        """Get an unused slot, evicting the least recently used if needed."""
+        if len(self._entries) < self.max_entries:
+            # Slots are used in order and never emptied, only reused.
+            return len(self._entries)
+        expired = np.flatnonzero(self._expires <= time.time())
+        if len(expired):
+            # Reuse an expired entry before evicting a valid one.
+            return int(expired[0])
+        slot, _ = self._entries.popitem(last=False)
+        self.evictions += 1
+        return slot
+
+
+# The cache shared by all sessions of this process.
+semantic_cache = SemanticCache()
+metrics.collect("chat_semantic_cache", semantic_cache.stats)
@@ -0,0 +1,176 @@
+"""Server-side paging of loaded datasets for the data table.
+
+The data table only ever holds one page of rows in state. Sorting, filtering
+and slicing run here against the dataset in the dataset store, and the client
+is sent the visible page as strings.
+
+Sorting or filtering a large dataset is costly, so the resulting row order is
+cached per dataset, sort and filter: moving between pages of the same view
+only slices the cached order. Cached orders are kept up to a size limit and
+the least recently used are dropped first.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from .datasets import dataset_store
+
+# Rows per page of the data table.
+TABLE_PAGE_SIZE = int(os.getenv("CHAT_TABLE_PAGE_SIZE", "50"))
+# The page sizes the user can pick from.
+TABLE_PAGE_SIZES = (25, 50, 100, 200)
+# Total size of the cached row orders.
+TABLE_INDEX_LIMIT = int(os.getenv("CHAT_TABLE_INDEX_MB", "256")) * 2**20
+
+
+@dataclass
+class TablePage:
+    """One page of a sorted and filtered dataset."""
+
+    columns: list[str]
+    rows: list[list[str]]
+    # Number of rows that pass the filter.
+    total: int
+
+
+class TablePager:
+    """Page through datasets, caching the row order of each view."""
+
+    def __init__(self, index_limit: int = TABLE_INDEX_LIMIT):
+        """Create the pager.
+
+        Args:
+            index_limit: Bytes of row orders to keep in memory.
+        """
+        self.index_limit = index_limit
+        self._indexes: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def page(
+        self,
+        handle: str,
+        page: int,
+        page_size: int = TABLE_PAGE_SIZE,
+        sort: str = "",
+        descending: bool = False,
+        filter: str = "",
+    ) -> TablePage:
+        """Get a page of a dataset.
+
+        Args:
+            handle: The dataset handle.
+            page: The page number, from 0. Pages past the end give the last one.
+            page_size: Rows per page.
+            sort: The column to sort by, or empty to keep the original order.
+            descending: Whether to sort from the largest value.
+            filter: Only keep rows with a cell containing this text, ignoring
+                case. Empty to keep all rows.
+
+        Returns:
+            The page.
+
+        Raises:
+            KeyError: If the dataset is no longer in the store.
+        """
+        frame = dataset_store.get(handle)
+        if sort not in frame.columns:
+            sort = ""
+        index = self._index(handle, frame, sort, descending, filter.strip())
+        total = len(frame) if index is None else len(index)
+        last_page = max(0, (total - 1) // page_size)
+        start = min(max(0, page), last_page) * page_size
+        if index is None:
+            rows = frame.iloc[start : start + page_size]
+        else:
+            rows = frame.iloc[index[start : start + page_size]]
+        return TablePage(
+            columns=[str(column) for column in frame.columns],
+            rows=rows.astype(object).fillna("").astype(str).values.tolist(),
+            total=total,
+        )
+
+    def _index(
+        self,
+        handle: str,
+        frame: pd.DataFrame,
+        sort: str,
+        descending: bool,
+        filter: str,
+    ) -> np.ndarray | None:
+        """Get the row positions of a view, or None for all rows in order."""
+        if not sort and not filter:
+            return None
+        key = (handle, sort, descending, filter.lower())
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+
+        if not sort:
+            positions = np.flatnonzero(_matches(frame, filter))
+        elif filter:
+            # Sorting the filtered view reuses the cached filter.
+            positions = self._index(handle, frame, "", False, filter)
+        else:
+            positions = np.arange(len(frame))
+        if sort:
+            positions = positions[_sort_order(frame[sort].iloc[positions], descending)]
+        # The positions fit 32 bits for any dataset that fits in memory.
+        index = positions.astype(np.int32 if len(frame) < 2**31 else np.int64)
+
+        with self._lock:
+            self._indexes[key] = index
+            size = sum(cached.nbytes for cached in self._indexes.values())
+            while size > self.index_limit and len(self._indexes) > 1:
+                _, dropped = self._indexes.popitem(last=False)
+                size -= dropped.nbytes
+        return index
+
+
+# The characters numbers are written with, e.g. "-1.5e+20", "nan" and "inf".
+_NUMBER_CHARACTERS = set("0123456789.-+eainf")
+
+
+def _sort_order(column: pd.Series, descending: bool = False) -> np.ndarray:
+    """Get the positions that sort a column, with missing values last."""
+    column = column.reset_index(drop=True)
+    try:
+        ordered = column.sort_values(
+            ascending=not descending, kind="stable", na_position="last"
+        )
+    except TypeError:
+        # Mixed types cannot be compared: sort them as text.
+        ordered = column.astype(str).sort_values(
+            ascending=not descending, kind="stable"
+        )
+    return ordered.index.to_numpy()
+
+
+def _matches(frame: pd.DataFrame, text: str) -> np.ndarray:
+    """Get a mask of the rows with a cell containing the text."""
+    mask = np.zeros(len(frame), dtype=bool)
+    numeric_text = set(text.lower()) <= _NUMBER_CHARACTERS
+    for name in frame.columns:
+        column = frame[name]
+        if (
+            pd.api.types.is_numeric_dtype(column)
+            and not pd.api.types.is_bool_dtype(column)
+            and not numeric_text
+        ):
+            # No number is written with these characters: skip the slow
+            # conversion to text.
+            continue
+        if not pd.api.types.is_string_dtype(column):
+            column = column.astype(str)
+        mask |= column.str.contains(text, case=False, regex=False, na=False).to_numpy()
+    return mask
+
+
+# The pager shared by all sessions of this process.
+table_pager = TablePager()
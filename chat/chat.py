@@ -2,14 +2,23 @@
 
 import reflex as rx
 
+from chat.backend.api import api
+from chat.backend.chat_store import create_tables
+from chat.backend.llm import warm_up_models
+from chat.backend.metrics import setup_logging
 from chat.components import chat, navbar
+from chat.state import State
 from chat.views.mobile_ui import mobile_ui, mobile_header
 
+# Write logs and spans as JSON lines when CHAT_LOG_FILE is set.
+setup_logging()
+
 
 @rx.page(
     "/",
     title="Aryan's ChatBot",
     description="A simple chat app using Reflex.",
+    on_load=State.load_chats,
 )
 def index() -> rx.Component:
     """The main app."""
@@ -58,5 +67,11 @@ app = rx.App(
         appearance="dark",
         accent_color="violet",
     ),
+    # Extra HTTP endpoints, e.g. the Replicate webhook receiver.
+    api_transformer=api,
 )
 app.add_page(index)
+# Open the Gemini connections before the first question comes in.
+app.register_lifespan_task(warm_up_models)
+# Create the chat history tables on first start.
+app.register_lifespan_task(create_tables)
@@ -1,9 +1,9 @@
-import logging
 import reflex as rx
 import reflex_chakra as rc
 
 from chat.state import QA, State
 from chat.components import loading_icon
+from chat.components.in_view import in_view
 
 
 message_style = dict(
@@ -13,50 +13,49 @@ message_style = dict(
     max_width=["30em", "30em", "50em", "50em", "50em", "50em"],
 )
 
-
-def setup_logging(log_filepath):
-    """
-    Setup the logger.
-
-    Parameters:-
-    ------------
-    log_filepath -- (str) log file path
+# Styles for the server-rendered HTML of finished messages.
+rendered_style = {
+    "& > :first-child": {"margin_top": "0"},
+    "& > :last-child": {"margin_bottom": "0"},
+    "& p, & ul, & ol, & table, & pre": {"margin_y": "0.5em"},
+    "& ul, & ol": {"padding_left": "1.5em"},
+    "& table": {
+        "border_collapse": "collapse",
+        "display": "block",
+        "overflow_x": "auto",
+    },
+    "& th, & td": {
+        "border": f"1px solid {rx.color('mauve', 7)}",
+        "padding": "0.25em 0.5em",
+    },
+    "& pre": {
+        "background_color": "#0d1117",
+        "padding": "0.75em",
+        "border_radius": "6px",
+        "overflow_x": "auto",
+    },
+    "& code": {"font_family": "monospace", "font_size": "0.9em"},
+}
+
+
+def bubble(question: rx.Var, answer: rx.Var, content=rx.markdown) -> rx.Component:
+    """A question and its answer. Render only if question or answer is non-empty.
+
+    Args:
+        question: The question.
+        answer: The answer.
+        content: Renders the text: rx.markdown for markdown, or rx.html for
+            text that is already rendered.
     """
-    # setup logger
-    logger = logging.getLogger("designdash_setup_logger")
-    logger.setLevel(logging.DEBUG)
-    fatal_logger = logging.getLogger("designdash_setup_fatal_logger")
-    fatal_logger.setLevel(logging.DEBUG)
-
-    # create logging handlers
-    file_handler = logging.FileHandler(log_filepath, "w")
-    file_handler.setLevel(logging.DEBUG)
-    fatal_f_handler = logging.FileHandler(log_filepath.replace(".log", ".err"), "w")
-    fatal_f_handler.setLevel(logging.DEBUG)
-
-    # set logging formats
-    FILE_FORMAT = "%(asctime)s - %(levelname)s: %(message)s"
-    file_formatter = logging.Formatter(fmt=FILE_FORMAT)
-    file_handler.setFormatter(file_formatter)
-    fatal_f_handler.setFormatter(file_formatter)
-
-    # add handlers to the logger
-    logger.addHandler(file_handler)
-    fatal_logger.addHandler(fatal_f_handler)
-    return logger, fatal_logger
-
-
-def message(qa: QA) -> rx.Component:
-    """A single question/answer message. Render only if question or answer is non-empty."""
 
     return rx.cond(
-        (qa.question != "") | (qa.answer != ""),
+        (question != "") | (answer != ""),
         rx.box(
             rx.cond(
-                qa.question != "",
+                question != "",
                 rx.box(
-                    rx.markdown(
-                        qa.question,
+                    content(
+                        question,
                         background_color=rx.color("mauve", 4),
                         color=rx.color("mauve", 12),
                         **message_style,
@@ -66,10 +65,10 @@ def message(qa: QA) -> rx.Component:
                 ),
             ),
             rx.cond(
-                qa.answer != "",
+                answer != "",
                 rx.box(
-                    rx.markdown(
-                        qa.answer,
+                    content(
+                        answer,
                         background_color=rx.color("accent", 4),
                         color=rx.color("accent", 12),
                         **message_style,
@@ -83,10 +82,86 @@ def message(qa: QA) -> rx.Component:
     )
 
 
+def rendered_html(html: rx.Var, **props) -> rx.Component:
+    """Markdown rendered to HTML on the server."""
+    return rx.html(html, style=rendered_style, **props)
+
+
+@rx.memo
+def finished_message(question: rx.Var[str], answer: rx.Var[str]) -> rx.Component:
+    """A finished message, rendered on the server. Memoized: renders only once."""
+    return rx.box(
+        bubble(question, answer, content=rendered_html),
+        # Let the browser skip layout and paint while the message is off screen.
+        content_visibility="auto",
+        contain_intrinsic_size="auto 6em",
+        width="100%",
+    )
+
+
+def message(qa: QA) -> rx.Component:
+    """A single finished question/answer message."""
+    # Key by message id, so loading older pages or dropping the oldest messages
+    # does not re-render the ones that stay.
+    return finished_message(
+        question=qa.question_html, answer=qa.answer_html, key=qa.id
+    )
+
+
 def chat() -> rx.Component:
     """List all the messages in a single conversation."""
     return rx.vstack(
-        rx.box(rx.foreach(State.chats[State.current_chat], message), width="100%"),
+        rx.box(
+            rx.cond(
+                State.has_older_messages,
+                # Load the previous page when scrolling up to the first message.
+                in_view(
+                    rx.center(
+                        rx.button(
+                            "Load older messages",
+                            on_click=State.load_older_messages,
+                            variant="soft",
+                            size="1",
+                        ),
+                    ),
+                    root_margin="200px 0px",
+                    on_change=State.on_history_top,
+                ),
+            ),
+            rx.foreach(State.messages, message),
+            rx.cond(
+                State.has_newer_messages,
+                # Load the next page when scrolling down to the last message.
+                in_view(
+                    rx.center(
+                        rx.button(
+                            "Load newer messages",
+                            on_click=State.load_newer_messages,
+                            variant="soft",
+                            size="1",
+                        ),
+                    ),
+                    root_margin="200px 0px",
+                    on_change=State.on_history_bottom,
+                ),
+            ),
+            # The message being answered updates on its own while it streams in.
+            rx.cond(
+                State.pending_question != "",
+                bubble(State.pending_question, State.streaming_answer),
+            ),
+            rx.cond(
+                State.queue_position > 0,
+                rx.text(
+                    f"⏳ Waiting for the model... position {State.queue_position} "
+                    "in the queue",
+                    color=rx.color("mauve", 10),
+                    font_size=".85em",
+                    padding_top="1em",
+                ),
+            ),
+            width="100%",
+        ),
         py="8",
         flex="1",
         width="100%",
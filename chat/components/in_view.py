@@ -0,0 +1,33 @@
+"""Reflex custom component InView."""
+
+# Wraps https://github.com/thebuilder/react-intersection-observer
+
+import reflex as rx
+
+
+class InView(rx.Component):
+    """Tell when the wrapped content scrolls into or out of the viewport."""
+
+    # The React library to wrap.
+    library = "react-intersection-observer"
+
+    # The React component tag.
+    tag = "InView"
+
+    # Margin around the viewport, e.g. "200px 0px", to trigger before the
+    # content is actually visible.
+    root_margin: rx.Var[str]
+
+    # Share of the content that must be visible, between 0 and 1.
+    threshold: rx.Var[float]
+
+    # Only report the first time the content becomes visible.
+    trigger_once: rx.Var[bool]
+
+    def get_event_triggers(self) -> dict:
+        # The second argument is the IntersectionObserverEntry, which cannot be
+        # sent to the backend.
+        return {"on_change": lambda in_view, entry: [in_view]}
+
+
+in_view = InView.create
@@ -99,6 +99,16 @@ def navbar():
                         variant="soft",
                     )
                 ),
+                rx.desktop_only(
+                    rx.tooltip(
+                        rx.switch(
+                            checked=State.response_cache_enabled,
+                            on_change=State.set_response_cache,
+                            size="1",
+                        ),
+                        content="Reuse cached answers to repeated questions.",
+                    )
+                ),
                 align_items="center",
             ),
             rx.hstack(
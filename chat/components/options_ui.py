@@ -3,6 +3,7 @@ import reflex as rx
 from .. import styles
 from chat.state import State
 from chat.backend.options import OptionsState
+from chat.backend.table import TABLE_PAGE_SIZES
 from ..backend.generation import GeneratorState
 
 
@@ -86,24 +87,96 @@ def generate_button() -> rx.Component:
     )
 
 
+def sort_header(column: rx.Var[str]) -> rx.Component:
+    """A column header that sorts the table by its column when clicked."""
+    return rx.table.column_header_cell(
+        rx.hstack(
+            rx.text(column),
+            rx.cond(
+                State.table_sort == column,
+                rx.icon(
+                    rx.cond(State.table_descending, "arrow-down", "arrow-up"),
+                    size=14,
+                ),
+            ),
+            spacing="1",
+            align="center",
+        ),
+        on_click=State.sort_table(column),
+        cursor="pointer",
+        white_space="nowrap",
+    )
+
+
+def table_pager() -> rx.Component:
+    """Page controls of the data table."""
+    return rx.hstack(
+        rx.icon_button(
+            rx.icon("chevron-left"),
+            size="1",
+            variant="soft",
+            disabled=State.table_page == 0,
+            on_click=State.set_table_page(State.table_page - 1),
+        ),
+        rx.text(
+            "Page ",
+            State.table_page + 1,
+            " of ",
+            State.table_page_count,
+            " (",
+            State.table_total,
+            " rows)",
+            size="2",
+        ),
+        rx.icon_button(
+            rx.icon("chevron-right"),
+            size="1",
+            variant="soft",
+            disabled=State.table_page + 1 >= State.table_page_count,
+            on_click=State.set_table_page(State.table_page + 1),
+        ),
+        rx.spacer(),
+        rx.select(
+            [str(size) for size in TABLE_PAGE_SIZES],
+            value=State.table_page_size.to_string(),
+            on_change=State.set_table_page_size,
+            size="1",
+        ),
+        align="center",
+        width="100%",
+    )
+
+
 def data_table():
-    """Render the data as a table using Reflex-native iteration."""
-    return rx.table.root(
-        rx.table.header(
-            rx.table.row(
-                rx.foreach(State.columns, lambda col: rx.table.column_header_cell(col))
-            )
+    """Render the visible page of the data, sorted, filtered and paged on the
+    server."""
+    return rx.vstack(
+        rx.debounce_input(
+            rx.input(
+                placeholder="Filter rows...",
+                value=State.table_filter,
+                on_change=State.set_table_filter,
+                width="100%",
+            ),
+            debounce_timeout=300,
         ),
-        rx.table.body(
-            rx.foreach(
-                State.rows,
-                lambda row: rx.table.row(
-                    rx.foreach(row, lambda cell: rx.table.cell(cell))
-                ),
-            )
+        rx.table.root(
+            rx.table.header(
+                rx.table.row(rx.foreach(State.columns, sort_header))
+            ),
+            rx.table.body(
+                rx.foreach(
+                    State.rows,
+                    lambda row: rx.table.row(
+                        rx.foreach(row, lambda cell: rx.table.cell(cell))
+                    ),
+                )
+            ),
+            width="100%",
+            style={"overflowX": "auto", "maxHeight": "500px", "overflowY": "scroll"},
         ),
+        table_pager(),
         width="100%",
-        style={"overflowX": "auto", "maxHeight": "500px", "overflowY": "scroll"},
     )
 
 
@@ -139,8 +212,26 @@ def data_path() -> rx.Component:
             # value=OptionsState.prompt,
             on_change=State.set_data_path,
         ),
-        rx.button("Load Data", on_click=State.load_data),
-        # rx.cond(State.error_message != "", rx.text(State.error_message, color="red")),
-        # rx.cond(State.columns != [], data_table()),
+        rx.cond(
+            ~State.loading,
+            rx.button("Load Data", on_click=State.load_data),
+            rx.button(
+                rx.spinner(size="2"),
+                "Cancel",
+                color_scheme="tomato",
+                on_click=State.cancel_load,
+            ),
+        ),
+        rx.hstack(
+            rx.switch(
+                checked=State.analysis_mode,
+                on_change=State.set_analysis_mode,
+            ),
+            rx.text("Answer by querying the data", size="2"),
+            spacing="2",
+            align="center",
+        ),
+        rx.cond(State.error_message != "", rx.text(State.error_message, color="red")),
+        rx.cond(State.columns, data_table()),
         width="100%",
     )
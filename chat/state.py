@@ -1,77 +1,392 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+
 import pandas as pd
 import reflex as rx
-import google.generativeai as genai
-
 
-genai.configure(api_key="")
+from chat.backend.chat_store import HISTORY_PAGE_SIZE, MessageRecord, chat_store
+from chat.backend.context import SYSTEM_PROMPT, ContextBuilder
+from chat.backend.datasets import dataset_store
+from chat.backend.llm import DEFAULT_MODEL, get_client
+from chat.backend.loading import SUPPORTED_EXTENSIONS, columnar_source, iter_chunks
+from chat.backend.metrics import metrics
+from chat.backend.profiling import profile_dataframe
+from chat.backend.query import parse_query, query_dataset, query_prompt
+from chat.backend.rendering import markdown_renderer
+from chat.backend.resilience import CircuitOpenError
+from chat.backend.response_cache import response_cache, response_cache_key
+from chat.backend.retrieval import RETRIEVAL_ENABLED, retriever
+from chat.backend.scheduler import Ticket, scheduler
+from chat.backend.semantic_cache import (
+    CACHED_MARKER,
+    SEMANTIC_CACHE_ENABLED,
+    semantic_cache,
+)
+from chat.backend.table import TABLE_PAGE_SIZE, table_pager
+
+
+logger = logging.getLogger(__name__)
+
+# Stream answers chunk by chunk instead of waiting for the full response.
+STREAM_ANSWERS = os.getenv("CHAT_STREAM_ANSWERS", "1") != "0"
+# Partial answers are flushed to the client at most every STREAM_FLUSH_INTERVAL
+# seconds, or as soon as STREAM_FLUSH_CHARS characters are buffered.
+STREAM_FLUSH_INTERVAL = float(os.getenv("CHAT_STREAM_FLUSH_INTERVAL", "0.1"))
+STREAM_FLUSH_CHARS = int(os.getenv("CHAT_STREAM_FLUSH_CHARS", "80"))
+
+# Most messages of the current chat kept on the client. Older ones are dropped
+# from the list as new ones arrive and are loaded again on scroll-up; newer ones
+# are dropped while scrolling up and loaded again on scroll-down.
+MESSAGE_WINDOW = int(os.getenv("CHAT_MESSAGE_WINDOW", "100"))
+
+# Seconds between updates of the queue position of a waiting question.
+QUEUE_POLL_INTERVAL = 0.5
+
+# One in this many streamed state updates has its size measured, since
+# serializing an update costs about as much as sending it; 0 for none.
+DELTA_SAMPLE_RATE = int(os.getenv("CHAT_METRICS_DELTA_SAMPLE", "20"))
+# Counts the streamed state updates, to pick the ones that are measured.
+_deltas = itertools.count()
+
+DATA_EXPIRED = "❌ The loaded data has expired. Please load it again."
+
+# Caches the prompt prefix of every chat between questions.
+context_builder = ContextBuilder()
 
 
 class QA(rx.Base):
-    """A question and answer pair."""
+    """A finished question and answer pair, as shown to the client.
 
-    question: str
-    answer: str | pd.DataFrame
+    Only the rendered HTML is sent; the markdown stays in the chat store.
+    """
+
+    # The id of the stored message.
+    id: int
+    question_html: str
+    answer_html: str
+
+    @classmethod
+    def render(cls, id: int, question: str, answer: str) -> "QA":
+        """Render a message to HTML.
+
+        Args:
+            id: The id of the stored message.
+            question: The question, as markdown.
+            answer: The answer, as markdown.
+
+        Returns:
+            The rendered message.
+        """
+        return cls(
+            id=id,
+            question_html=markdown_renderer.render(question),
+            answer_html=markdown_renderer.render(answer),
+        )
+
+    @classmethod
+    def from_record(cls, record: MessageRecord) -> "QA":
+        """Create the message shown to the client from a stored message.
+
+        Args:
+            record: The stored message.
+
+        Returns:
+            The rendered message.
+        """
+        return cls.render(record.id, record.question, record.answer)
+
+
+# The chats every user starts with.
+DEFAULT_CHATS = ("Intros",)
+
+# How long the browser keeps the user id, in seconds.
+USER_ID_MAX_AGE = 365 * 24 * 3600
+
+
+def _read_titles(user: str) -> list[str]:
+    """Read a user's chat titles, creating the default chats if none.
 
+    Args:
+        user: The user id.
 
-DEFAULT_CHATS = {
-    "Intros": [],
-}
+    Returns:
+        The titles, oldest chat first.
+    """
+    titles = chat_store.titles(user)
+    if not titles:
+        for name in DEFAULT_CHATS:
+            chat_store.create_chat(user, name)
+        titles = list(DEFAULT_CHATS)
+    return titles
+
+
+def _read_page(
+    user: str, chat: str, before: int | None = None
+) -> tuple[list[QA], bool]:
+    """Read and render a page of messages of a chat.
+
+    Args:
+        user: The user id.
+        chat: The chat name.
+        before: The id of the oldest message already loaded, or None for the
+            newest page.
+
+    Returns:
+        The messages of the page, oldest first, and whether there are older
+        ones.
+    """
+    page = chat_store.messages(user, chat, before=before, limit=HISTORY_PAGE_SIZE + 1)
+    # The extra message only tells that there are older ones.
+    messages = [QA.from_record(record) for record in page[-HISTORY_PAGE_SIZE:]]
+    return messages, len(page) > HISTORY_PAGE_SIZE
+
+
+def _read_newer_page(user: str, chat: str, after: int) -> tuple[list[QA], bool]:
+    """Read and render the page of messages of a chat that follows a message.
+
+    Args:
+        user: The user id.
+        chat: The chat name.
+        after: The id of the newest message loaded.
+
+    Returns:
+        The messages of the page, oldest first, and whether there are newer
+        ones.
+    """
+    page = chat_store.newer_messages(user, chat, after, limit=HISTORY_PAGE_SIZE + 1)
+    # The extra message only tells that there are newer ones.
+    messages = [QA.from_record(record) for record in page[:HISTORY_PAGE_SIZE]]
+    return messages, len(page) > HISTORY_PAGE_SIZE
 
 
 class State(rx.State):
     """The app state."""
 
     data_path: str = ""
+
+    # Handle of the loaded dataset in the server-side dataset store.
+    _dataset_handle: str = ""
+
+    # Column names and the visible page of rows of the loaded dataset. Sorting,
+    # filtering and paging run on the server; only this page is in the state.
     columns: list[str] = []
     rows: list[list[str]] = []
+
+    # The data table view: the page from 0, rows per page, the column sorted by
+    # ("" for file order) and its direction, the filter text, and the number
+    # of rows that pass the filter.
+    table_page: int = 0
+    table_page_size: int = TABLE_PAGE_SIZE
+    table_sort: str = ""
+    table_descending: bool = False
+    table_filter: str = ""
+    table_total: int = 0
     error_message: str = ""
 
-    # A dict from the chat name to the list of questions and answers.
-    chats: dict[str, list[QA]] = DEFAULT_CHATS
+    # Identifies the browser across sessions; chats are stored per user.
+    user_id: str = rx.Cookie("", name="chat_user_id", max_age=USER_ID_MAX_AGE)
+
+    # The names of all chats. Messages are stored in the chat store and only
+    # the current chat's are loaded, a page at a time.
+    chat_titles: list[str] = []
 
     # The current chat name.
     current_chat = "Intros"
 
+    # The loaded messages of the current chat.
+    messages: list[QA] = []
+
+    # Whether the current chat has messages older than the loaded ones.
+    has_older_messages: bool = False
+
+    # Whether the current chat has messages newer than the loaded ones, which
+    # were dropped from the list while scrolling up.
+    has_newer_messages: bool = False
+
+    # All turns of the current chat, read when the first question is asked.
+    _history: list[tuple[str, str]] | None = None
+
+    # The question being answered and its answer so far. Only these change while
+    # an answer streams in, so each flush sends just this text to the client.
+    pending_question: str = ""
+    streaming_answer: str = ""
+
     # The current question.
     question: str
 
     # Whether we are processing the question.
     processing: bool = False
 
+    # Position of the question in the model request queue, 0 when not waiting.
+    queue_position: int = 0
+
     # The name of the new chat.
     new_chat_name: str = ""
 
-    main_df: pd.DataFrame = None
+    # Seconds until the first chunk of the last answer arrived.
+    time_to_first_token: float = 0.0
+
+    # Estimated number of tokens in the last prompt.
+    prompt_tokens: int = 0
+
+    # Chats whose questions always go to the model, bypassing the response cache.
+    uncached_chats: list[str] = []
+
+    # Whether questions are answered by querying the loaded data.
+    analysis_mode: bool = False
+
+    # Whether a dataset is being loaded.
+    loading: bool = False
 
-    def create_chat(self):
+    # Incremented for every load, so a cancelled load can tell it is stale.
+    _load_id: int = 0
+
+    async def load_chats(self):
+        """Load the user's chat titles and open a chat when the page loads."""
+        if not self.user_id:
+            self.user_id = uuid.uuid4().hex
+        await self._load_titles()
+        if self.current_chat in self.chat_titles:
+            await self._show_chat(self.current_chat)
+        else:
+            await self._show_chat(self.chat_titles[0])
+
+    async def create_chat(self):
         """Create a new chat."""
         # Add the new chat to the list of chats.
-        self.current_chat = self.new_chat_name
-        self.chats[self.new_chat_name] = []
+        await asyncio.to_thread(
+            chat_store.create_chat, self.user_id, self.new_chat_name
+        )
+        await self._load_titles()
+        await self._show_chat(self.new_chat_name)
 
-    def delete_chat(self):
+    async def delete_chat(self):
         """Delete the current chat."""
-        del self.chats[self.current_chat]
-        if len(self.chats) == 0:
-            self.chats = DEFAULT_CHATS
-        self.current_chat = list(self.chats.keys())[0]
+        context_builder.forget(self._chat_key())
+        retriever.forget_chat(self._chat_key())
+        await asyncio.to_thread(
+            chat_store.delete_chat, self.user_id, self.current_chat
+        )
+        await self._load_titles()
+        await self._show_chat(self.chat_titles[0])
 
-    def set_chat(self, chat_name: str):
+    async def set_chat(self, chat_name: str):
         """Set the name of the current chat.
 
+        Args:
+            chat_name: The name of the chat.
+        """
+        if chat_name in self.chat_titles:
+            await self._show_chat(chat_name)
+
+    async def on_history_top(self, visible: bool):
+        """Load older messages when the top of the message list scrolls into view.
+
+        Args:
+            visible: Whether the top of the list is visible.
+        """
+        if visible:
+            await self._load_older_messages()
+
+    async def load_older_messages(self):
+        """Load the previous page of messages of the current chat."""
+        await self._load_older_messages()
+
+    async def _load_older_messages(self):
+        """Prepend the previous page of messages of the current chat."""
+        if not self.has_older_messages or not self.messages:
+            return
+        page, self.has_older_messages = await asyncio.to_thread(
+            _read_page, self.user_id, self.current_chat, self.messages[0].id
+        )
+        self.messages = page + self.messages
+        if len(self.messages) > MESSAGE_WINDOW:
+            # Keep the client's list bounded; scrolling down loads them again.
+            del self.messages[MESSAGE_WINDOW:]
+            self.has_newer_messages = True
+
+    async def on_history_bottom(self, visible: bool):
+        """Load newer messages when the bottom of the message list scrolls into view.
+
+        Args:
+            visible: Whether the bottom of the list is visible.
+        """
+        if visible:
+            await self._load_newer_messages()
+
+    async def load_newer_messages(self):
+        """Load the next page of messages of the current chat."""
+        await self._load_newer_messages()
+
+    async def _load_newer_messages(self):
+        """Append the next page of messages of the current chat."""
+        if not self.has_newer_messages or not self.messages:
+            return
+        page, self.has_newer_messages = await asyncio.to_thread(
+            _read_newer_page, self.user_id, self.current_chat, self.messages[-1].id
+        )
+        self.messages = self.messages + page
+        if len(self.messages) > MESSAGE_WINDOW:
+            # Keep the client's list bounded; scrolling up loads them again.
+            del self.messages[: len(self.messages) - MESSAGE_WINDOW]
+            self.has_older_messages = True
+
+    async def _load_titles(self):
+        """Read the user's chat titles, creating the default chats if none."""
+        self.chat_titles = await asyncio.to_thread(_read_titles, self.user_id)
+
+    async def _show_chat(self, chat_name: str):
+        """Make a chat the current one and send its newest messages to the client.
+
         Args:
             chat_name: The name of the chat.
         """
         self.current_chat = chat_name
+        self._history = None
+        await self._show_newest_messages()
+
+    async def _show_newest_messages(self):
+        """Send the newest page of messages of the current chat to the client."""
+        self.messages, self.has_older_messages = await asyncio.to_thread(
+            _read_page, self.user_id, self.current_chat
+        )
+        self.has_newer_messages = False
+
+    def set_response_cache(self, enabled: bool):
+        """Turn the response cache on or off for the current chat.
+
+        Args:
+            enabled: Whether repeated prompts may be answered from the cache.
+        """
+        if enabled and self.current_chat in self.uncached_chats:
+            self.uncached_chats.remove(self.current_chat)
+        elif not enabled and self.current_chat not in self.uncached_chats:
+            self.uncached_chats.append(self.current_chat)
 
     @rx.var(cache=True)
-    def chat_titles(self) -> list[str]:
-        """Get the list of chat titles.
+    def response_cache_enabled(self) -> bool:
+        """Whether the current chat uses the response cache.
 
         Returns:
-            The list of chat names.
+            False if the current chat bypasses the cache.
         """
-        return list(self.chats.keys())
+        return self.current_chat not in self.uncached_chats
+
+    def _chat_key(self, chat: str | None = None) -> str:
+        """Identify a chat across sessions.
+
+        Args:
+            chat: The chat name, the current chat by default.
+
+        Returns:
+            A key unique to this user and chat.
+        """
+        return f"{self.user_id}:{self.current_chat if chat is None else chat}"
 
     async def process_question(self, form_data: dict[str, str]):
         # Get the question from the form
@@ -89,86 +404,522 @@ class State(rx.State):
     async def gemini_process_question(self, question: str):
         """Get the response from the Gemini API."""
 
-        if self.main_df is not None and question == "Load Data":
-            question += str(self.main_df)
+        if self._dataset_handle and question == "Load Data":
+            try:
+                question += "\n" + dataset_store.digest(self._dataset_handle)
+            except KeyError:
+                self._dataset_handle = ""
 
-        # Add the question to the list of questions.
-        qa = QA(question=question, answer="")
-        self.chats[self.current_chat].append(qa)
+        # Show the question; it joins the chat once it is answered.
+        chat = self.current_chat
+        self.pending_question = question
+        self.streaming_answer = ""
 
         # Clear the input and start the processing.
         self.processing = True
         yield
 
-        # Build the messages.
-        messages = [
-            {"role": "system", "content": "You are a friendly chatbot named Reflex."}
-        ]
-        for qa in self.chats[self.current_chat]:
-            messages.append({"role": "user", "content": qa.question})
-            messages.append({"role": "assistant", "content": qa.answer})
+        # Build the prompt from the history that fits in the context window.
+        if self._history is None:
+            self._history = await asyncio.to_thread(
+                chat_store.turns, self.user_id, chat
+            )
+        context = ""
+        # Keep room for the retrieved snippets, so adding them never slides
+        # the window.
+        reserve = retriever.token_budget if RETRIEVAL_ENABLED else 0
+        if RETRIEVAL_ENABLED:
+            with metrics.span("chat_prompt_build_seconds"):
+                window_start = context_builder.window(
+                    self._chat_key(), self._history, question, reserve
+                )
+            # Add the snippets of the data and of the turns left out of the
+            # window that are relevant to the question.
+            with metrics.span("chat_retrieval_seconds"):
+                context = await asyncio.to_thread(
+                    retriever.context,
+                    question,
+                    self._chat_key(),
+                    self._history,
+                    window_start,
+                    self._dataset_handle,
+                )
+        with metrics.span("chat_prompt_build_seconds"):
+            prompt, prompt_metrics = context_builder.build(
+                self._chat_key(), self._history, question, context, reserve
+            )
+        self.prompt_tokens = prompt_metrics.prompt_tokens
+        logger.info("Prompt built: %s", prompt_metrics)
+
+        analysis = self.analysis_mode and bool(self._dataset_handle)
+        cache_key = semantic_key = None
+        if self.current_chat not in self.uncached_chats:
+            cache_key = response_cache_key(
+                DEFAULT_MODEL, SYSTEM_PROMPT, prompt, question
+            )
+            if SEMANTIC_CACHE_ENABLED and not analysis:
+                # Similar questions in the same context share an answer.
+                previous = self._history[-1][0] if self._history else ""
+                semantic_key = await asyncio.to_thread(
+                    semantic_cache.key,
+                    question,
+                    f"{previous}\n{context}",
+                    self._semantic_scope(),
+                    self._chat_key(),
+                )
 
-        # Remove the last mock answer.
-        messages = messages[:-1]
+        ticket = None
+        # Stays "cancelled" if the client goes away before an answer.
+        outcome = "cancelled"
+        try:
+            if (
+                not analysis
+                and cache_key
+                # The disk tier reads a file: keep it off the event loop.
+                and (cached := await asyncio.to_thread(response_cache.get, cache_key))
+            ):
+                # The same prompt was answered before.
+                outcome = "cached"
+                self._append_answer(cached)
+                yield
+            elif semantic_key and (cached := semantic_cache.get(semantic_key)):
+                # A similar question was answered before, maybe in another
+                # session.
+                outcome = "similar"
+                self._append_answer(cached + CACHED_MARKER)
+                yield
+            else:
+                # Wait for the scheduler to let this user call the model.
+                ticket = scheduler.submit(self.user_id)
+                async for _ in self._wait_for_turn(ticket):
+                    yield
+                with metrics.span("chat_llm_seconds", analysis=str(analysis)):
+                    if analysis:
+                        # Let the model query the data instead of reading it.
+                        await self._answer_with_query(question)
+                        yield
+                    elif not STREAM_ANSWERS:
+                        # Get the response without blocking the event loop.
+                        self._append_answer(await get_client().generate(prompt))
+                        yield
+                    else:
+                        async for _ in self._stream_answer(prompt):
+                            yield
+                outcome = "answered"
+                answer = self.streaming_answer
+                # An empty answer is not worth replaying.
+                if answer.strip():
+                    if cache_key and not analysis:
+                        await asyncio.to_thread(response_cache.put, cache_key, answer)
+                    if semantic_key:
+                        semantic_cache.put(semantic_key, answer)
+        except TimeoutError:
+            outcome = "timeout"
+            self._append_answer(
+                "❌ The model took too long to answer. Please try again."
+            )
+            yield
+        except CircuitOpenError:
+            outcome = "unavailable"
+            self._append_answer(
+                "❌ The model is unavailable right now. Please try again later."
+            )
+            yield
+        except Exception as e:
+            outcome = "error"
+            logger.exception("Could not answer the question")
+            self._append_answer(f"❌ Could not get an answer: {e}")
+            yield
+        finally:
+            metrics.inc("chat_questions_total", outcome=outcome)
+            if ticket is not None:
+                scheduler.release(ticket)
+            self.queue_position = 0
+            # Move the answered question into the chat.
+            await self._add_message(
+                chat, self.pending_question, self.streaming_answer
+            )
+            self.pending_question = ""
+            self.streaming_answer = ""
+            # Toggle the processing flag.
+            self.processing = False
 
-        # Configure Gemini API
-        model = genai.GenerativeModel("gemini-2.0-flash")
+    def _semantic_scope(self) -> str:
+        """Tell apart the answers that must not be reused for each other.
 
-        # Get the response from Gemini
-        response = model.generate_content(
-            contents="\n".join([message["content"] for message in messages])
-        )
-        answer_text = response.text
+        Returns:
+            The model, the system prompt and the digest of the loaded data.
+        """
+        try:
+            digest = (
+                dataset_store.digest(self._dataset_handle)
+                if self._dataset_handle
+                else ""
+            )
+        except KeyError:
+            digest = ""
+        return "\0".join((DEFAULT_MODEL, SYSTEM_PROMPT, digest))
 
-        # Update the chat with the answer
-        self.chats[self.current_chat][-1].answer += answer_text
-        self.chats = self.chats  # Trigger reactivity
-        yield
+    async def _wait_for_turn(self, ticket: Ticket):
+        """Wait for a queued request to be granted, showing its queue position.
 
-        # Toggle the processing flag.
-        self.processing = False
+        Args:
+            ticket: The ticket of the request.
+        """
+        started = time.perf_counter()
+        while not await scheduler.wait(ticket, QUEUE_POLL_INTERVAL):
+            position = scheduler.position(ticket)
+            if position != self.queue_position:
+                self.queue_position = position
+                yield
+        metrics.observe("chat_queue_wait_seconds", time.perf_counter() - started)
+        if self.queue_position:
+            self.queue_position = 0
+            yield
+
+    async def _answer_with_query(self, question: str):
+        """Answer a question about the loaded data by running a model-written query.
 
-    def load_data(self):
-        path = self.data_path.strip()
-        if not path:
-            qa = QA(question="Load Data", answer="❌ Please enter a valid file path.")
-            self.chats[self.current_chat].append(qa)
+        Args:
+            question: The user's question.
+        """
+        handle = self._dataset_handle
+        try:
+            digest = dataset_store.digest(handle)
+        except KeyError:
+            self._dataset_handle = ""
+            self._append_answer(DATA_EXPIRED)
             return
 
+        reply = await get_client().generate(query_prompt(digest, question))
         try:
-            if path.endswith(".csv"):
-                df = pd.read_csv(path)
-            elif path.endswith(".xlsx"):
-                df = pd.read_excel(path)
-            elif path.endswith(".ldb"):
-                df = pd.read_parquet(path, engine="pyarrow")
-            else:
-                qa = QA(
-                    question="Load Data",
-                    answer="❌ Unsupported file type. Use CSV, XLSX, or LDB.",
+            query = parse_query(reply)
+            result = await asyncio.to_thread(query_dataset, handle, query)
+        except KeyError:
+            self._dataset_handle = ""
+            self._append_answer(DATA_EXPIRED)
+            return
+        except ValueError as e:
+            self._append_answer(f"❌ Could not run the query: {e}\n```\n{reply}\n```")
+            return
+
+        self._append_answer(
+            f"```json\n{json.dumps(query, indent=2)}\n```\n"
+            + (result.to_markdown(index=False) if not result.empty else "No rows.")
+        )
+
+    async def _stream_answer(self, prompt: str):
+        """Stream the answer into the last message, flushing in batches.
+
+        Args:
+            prompt: The full prompt text.
+        """
+        started = time.perf_counter()
+        last_flush = started
+        self.time_to_first_token = 0.0
+        buffer: list[str] = []
+        buffered = 0
+
+        async for text in get_client().stream(prompt):
+            buffer.append(text)
+            buffered += len(text)
+            now = time.perf_counter()
+
+            # Always flush the first chunk so the answer shows up right away.
+            first = self.time_to_first_token == 0.0
+            if first:
+                self.time_to_first_token = now - started
+                logger.info("Time to first token: %.3fs", self.time_to_first_token)
+                metrics.observe(
+                    "chat_time_to_first_token_seconds", self.time_to_first_token
                 )
-                self.chats[self.current_chat].append(qa)
-                return
+            if (
+                first
+                or buffered >= STREAM_FLUSH_CHARS
+                or now - last_flush >= STREAM_FLUSH_INTERVAL
+            ):
+                self._append_answer("".join(buffer))
+                buffer, buffered, last_flush = [], 0, now
+                self._observe_delta()
+                yield
+
+        if buffer:
+            self._append_answer("".join(buffer))
+            self._observe_delta()
+            yield
+        logger.info("Answer streamed in %.3fs", time.perf_counter() - started)
+
+    def _observe_delta(self):
+        """Record the size of the state update about to be sent, if sampled."""
+        if (
+            metrics.enabled
+            and DELTA_SAMPLE_RATE > 0
+            and next(_deltas) % DELTA_SAMPLE_RATE == 0
+        ):
+            size = len(json.dumps(self.get_delta(), default=str))
+            metrics.observe("chat_state_delta_bytes", size)
+
+    def _append_answer(self, text: str):
+        """Append text to the answer being streamed.
 
-            # Store the main DataFrame in a state variable for LLM access
-            self.main_df = df
+        Args:
+            text: The text to append.
+        """
+        self.streaming_answer += text
+
+    async def _add_message(self, chat: str, question: str, answer: str) -> int:
+        """Store a finished message in a chat.
+
+        Args:
+            chat: The name of the chat.
+            question: The question.
+            answer: The answer.
 
-            # Generate a markdown preview table with borders using GitHub table format
-            preview_table = df.head(5).to_markdown(index=False)
-            summary = (
-                "✅ Data loaded successfully! Here are the top 5 rows of the data:\n"
-                f"```\n{preview_table}\n```"
+        Returns:
+            The id of the stored message.
+        """
+        record = await asyncio.to_thread(
+            chat_store.add_message, self.user_id, chat, question, answer
+        )
+        if chat == self.current_chat and self.has_newer_messages:
+            # The newest messages are not loaded: jump to them, this one
+            # included.
+            await self._show_newest_messages()
+        elif chat == self.current_chat:
+            self.messages.append(QA.render(record.id, question, answer))
+            if len(self.messages) > MESSAGE_WINDOW:
+                # Keep the client's list bounded; scrolling up loads them again.
+                del self.messages[: len(self.messages) - MESSAGE_WINDOW]
+                self.has_older_messages = True
+            if self._history is not None:
+                self._history.append((question, answer))
+        return record.id
+
+    @rx.event(background=True)
+    async def load_data(self):
+        """Load the dataset at data_path in the background, reporting progress."""
+        async with self:
+            if self.loading:
+                return
+            path = self.data_path.strip()
+            if not path:
+                answer = "❌ Please enter a valid file path."
+            elif not path.endswith(SUPPORTED_EXTENSIONS):
+                answer = "❌ Unsupported file type. Use CSV, XLSX, or LDB."
+            else:
+                answer = "⏳ Loading data..."
+            chat = self.current_chat
+            message_id = await self._add_message(chat, "Load Data", answer)
+            if not answer.startswith("⏳"):
+                return
+            self.loading = True
+            self._load_id += 1
+            load_id = self._load_id
+
+        reader = iter_chunks(path)
+        chunks = []
+        preview = ""
+        try:
+            while True:
+                # Parse the next piece on a worker thread.
+                item = await asyncio.to_thread(next, reader, None)
+                if item is None:
+                    break
+                chunk, progress = item
+                chunks.append(chunk)
+                async with self:
+                    if self._load_cancelled(load_id):
+                        await self._set_answer(
+                            chat, message_id, "⏹️ Loading cancelled."
+                        )
+                        return
+                    if not preview:
+                        # Show the first rows as soon as the first piece is in.
+                        preview = chunk.head(5).to_markdown(index=False)
+                        self.columns = [str(column) for column in chunk.columns]
+                        self.rows = chunk.head(5).astype(str).values.tolist()
+                    self._show_answer(
+                        chat,
+                        message_id,
+                        f"⏳ Loading data... {progress}\n"
+                        f"Here are the top 5 rows of the data:\n```\n{preview}\n```",
+                    )
+
+            if len(chunks) == 1:
+                # Cached files are read in one piece: concatenating would copy it.
+                df = chunks[0]
+            else:
+                df = await asyncio.to_thread(pd.concat, chunks, ignore_index=True)
+            # Profile the data once; prompts use the digest instead of the rows.
+            digest = await asyncio.to_thread(profile_dataframe, df)
+            # Keep the data on the server, out of the serialized state. Storing
+            # it may spill other datasets to disk, so keep it off the event loop.
+            handle = await asyncio.to_thread(
+                lambda: dataset_store.put(df, digest, columnar_source(path))
             )
 
-            # Create QA object and trigger reactivity
-            qa = QA(question="Load Data", answer=summary)
-            self.chats[self.current_chat].append(qa)
+            async with self:
+                if self._load_cancelled(load_id):
+                    dataset_store.drop(handle)
+                    await self._set_answer(
+                        chat, message_id, "⏹️ Loading cancelled."
+                    )
+                    return
+                if self._dataset_handle:
+                    dataset_store.drop(self._dataset_handle)
+                    retriever.drop_dataset(self._dataset_handle)
+                self._dataset_handle = handle
+                self.table_page, self.table_sort, self.table_filter = 0, "", ""
+                await self._show_table_page()
+                await self._set_answer(
+                    chat,
+                    message_id,
+                    f"✅ Data loaded successfully! {len(df):,} rows. "
+                    "Here are the top 5 rows of the data:\n"
+                    f"```\n{preview}\n```",
+                )
+                self.loading = False
 
-            # Force state update to trigger UI refresh
-            self.chats = dict(self.chats)
+            if RETRIEVAL_ENABLED:
+                # Index the data so questions can retrieve relevant rows.
+                try:
+                    await asyncio.to_thread(retriever.index_dataset, handle, df)
+                except Exception:
+                    logger.exception("Could not index the dataset")
 
         except Exception as e:
-            qa = QA(question="Load Data", answer=f"❌ Failed to load data: {str(e)}")
-            self.chats[self.current_chat].append(qa)
-            # Force state update for error case too
-            self.chats = dict(self.chats)
+            async with self:
+                await self._set_answer(
+                    chat, message_id, f"❌ Failed to load data: {str(e)}"
+                )
+                if not self._load_cancelled(load_id):
+                    self.loading = False
+        finally:
+            reader.close()
+
+    async def sort_table(self, column: str):
+        """Sort the data table by a column, or reverse the order if it already is.
+
+        Args:
+            column: The column name.
+        """
+        if self.table_sort == column:
+            self.table_descending = not self.table_descending
+        else:
+            self.table_sort, self.table_descending = column, False
+        self.table_page = 0
+        await self._show_table_page()
+
+    async def set_table_filter(self, text: str):
+        """Only show the rows of the data table that contain a text.
+
+        Args:
+            text: The text to look for, or empty to show all rows.
+        """
+        self.table_filter = text
+        self.table_page = 0
+        await self._show_table_page()
+
+    async def set_table_page(self, page: int):
+        """Show a page of the data table.
+
+        Args:
+            page: The page, from 0.
+        """
+        # Pages past the end are clamped once the page is read.
+        self.table_page = max(0, page)
+        await self._show_table_page()
+
+    async def set_table_page_size(self, size: str):
+        """Set the number of rows per page of the data table.
+
+        Args:
+            size: The number of rows.
+        """
+        # Keep the first visible row on the new page.
+        first_row = self.table_page * self.table_page_size
+        self.table_page_size = int(size)
+        self.table_page = first_row // self.table_page_size
+        await self._show_table_page()
+
+    @rx.var(cache=True)
+    def table_page_count(self) -> int:
+        """The number of pages of the data table.
+
+        Returns:
+            At least 1.
+        """
+        return max(1, -(-self.table_total // self.table_page_size))
+
+    async def _show_table_page(self):
+        """Send the current page of the data table to the client."""
+        if not self._dataset_handle:
+            return
+        try:
+            page = await asyncio.to_thread(
+                table_pager.page,
+                self._dataset_handle,
+                self.table_page,
+                self.table_page_size,
+                self.table_sort,
+                self.table_descending,
+                self.table_filter,
+            )
+        except KeyError:
+            self._dataset_handle = ""
+            self.columns, self.rows, self.table_total = [], [], 0
+            self.error_message = DATA_EXPIRED
+            return
+        self.columns, self.rows, self.table_total = page.columns, page.rows, page.total
+        self.table_page = min(
+            self.table_page, max(0, (page.total - 1) // self.table_page_size)
+        )
+        self.error_message = ""
+
+    def cancel_load(self):
+        """Cancel loading the dataset."""
+        self.loading = False
+
+    def _load_cancelled(self, load_id: int) -> bool:
+        """Whether a load was cancelled or superseded by a newer one.
+
+        Args:
+            load_id: The id of the load.
+
+        Returns:
+            True if the load should stop.
+        """
+        return not self.loading or self._load_id != load_id
+
+    async def _set_answer(self, chat: str, message_id: int, answer: str):
+        """Store the final answer of a message, if the message still exists.
+
+        Args:
+            chat: The name of the chat the message is in.
+            message_id: The id of the stored message.
+            answer: The new answer.
+        """
+        await asyncio.to_thread(chat_store.set_answer, message_id, answer)
+        # The prompt prefix and the retrieval index assume the history only
+        # grows; a turn changed, so rebuild them from the new history.
+        context_builder.forget(self._chat_key(chat))
+        retriever.forget_chat(self._chat_key(chat))
+        if chat == self.current_chat:
+            # Read the history again for the next prompt.
+            self._history = None
+        self._show_answer(chat, message_id, answer)
+
+    def _show_answer(self, chat: str, message_id: int, answer: str):
+        """Show a new answer of a message without storing it, e.g. progress.
+
+        Args:
+            chat: The name of the chat the message is in.
+            message_id: The id of the stored message.
+            answer: The answer to show.
+        """
+        if chat != self.current_chat:
+            return
+        for qa in self.messages:
+            if qa.id == message_id:
+                qa.answer_html = markdown_renderer.render(answer)
+                break
@@ -3,4 +3,6 @@ import reflex as rx
 
 config = rx.Config(
     app_name="chat",
+    # Chats and messages are stored here; override with the DB_URL variable.
+    db_url="sqlite:///reflex.db",
 )
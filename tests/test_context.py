@@ -0,0 +1,78 @@
+"""Tests of the token-budgeted prompt builder."""
+
+from chat.backend.context import ContextBuilder, estimate_tokens
+
+
+def turns(count: int) -> list[tuple[str, str]]:
+    # Each turn is "question N\nanswer N ...", about 10 tokens.
+    return [(f"question {i}", f"answer {i} " + "x" * 20) for i in range(count)]
+
+
+def test_recent_turns_fit_the_budget():
+    builder = ContextBuilder(system_prompt="System.", token_budget=100)
+    history = turns(30)
+    prompt, metrics = builder.build("chat", history, "Next?")
+
+    assert prompt.startswith("System.\n")
+    assert prompt.endswith("question 29\nanswer 29 " + "x" * 20 + "\nNext?")
+    assert "question 0\n" not in prompt
+    assert 0 < metrics.turns_included < metrics.turns_total == 30
+    assert metrics.prompt_tokens <= 100
+
+
+def test_cached_prefix_is_extended():
+    builder = ContextBuilder(token_budget=1000)
+    history = turns(3)
+    _, first = builder.build("chat", history, "Next?")
+    assert not first.cache_hit
+
+    history.append(("question 3", "answer 3"))
+    prompt, second = builder.build("chat", history, "Next?")
+    assert second.cache_hit
+    assert second.turns_included == 4
+    assert "question 3\nanswer 3\nNext?" in prompt
+
+
+def test_changed_history_rebuilds_the_prefix():
+    builder = ContextBuilder(token_budget=1000)
+    history = turns(3)
+    builder.build("chat", history, "Next?")
+
+    history[-1] = ("question 2", "a new answer")
+    prompt, metrics = builder.build("chat", history, "Next?")
+    assert not metrics.cache_hit
+    assert "a new answer" in prompt
+
+    builder.forget("chat")
+    _, metrics = builder.build("chat", history, "Next?")
+    assert not metrics.cache_hit
+
+
+def test_context_within_reserve_keeps_the_window():
+    builder = ContextBuilder(system_prompt="System.", token_budget=200)
+    history = turns(30)
+    reserve = 50
+    start = builder.window("chat", history, "Next?", reserve)
+
+    context = "Relevant context:\n- " + "y" * 150
+    assert estimate_tokens(context) <= reserve
+    prompt, metrics = builder.build("chat", history, "Next?", context, reserve)
+    assert metrics.turns_total - metrics.turns_included == start
+    assert context in prompt
+    assert metrics.prompt_tokens <= 200
+
+    # The next turn without context keeps the same window, plus the new turn.
+    history.append(("question 30", "answer 30"))
+    _, metrics = builder.build("chat", history, "Next?", "", reserve)
+    assert metrics.turns_total - metrics.turns_included == start
+
+
+def test_summary_lists_dropped_questions():
+    builder = ContextBuilder(token_budget=200, strategy="summary")
+    prompt, metrics = builder.build("chat", turns(40), "Next?")
+
+    assert metrics.turns_summarized > 0
+    assert "Earlier in this conversation the user asked:" in prompt
+    # The newest dropped question comes first.
+    newest = metrics.turns_summarized - 1
+    assert f"asked:\n- question {newest}\n" in prompt
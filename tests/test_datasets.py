@@ -0,0 +1,93 @@
+"""Tests of the server-side dataset store."""
+
+import os
+
+import pandas as pd
+import pytest
+
+from chat.backend import datasets
+from chat.backend.datasets import DatasetStore
+
+
+def frame(rows: int = 1000, seed: int = 0) -> pd.DataFrame:
+    return pd.DataFrame({"id": range(seed, seed + rows), "value": [1.5] * rows})
+
+
+def nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def test_put_and_get(tmp_path):
+    store = DatasetStore(spill_dir=str(tmp_path))
+    df = frame()
+    handle = store.put(df, "digest", ("data.parquet", "parquet"))
+
+    assert store.get(handle) is df
+    assert store.digest(handle) == "digest"
+    assert store.source(handle) == ("data.parquet", "parquet")
+
+
+def test_least_recently_used_is_spilled_and_read_back(tmp_path):
+    df = frame()
+    store = DatasetStore(memory_limit=nbytes(df) * 2, spill_dir=str(tmp_path))
+    first = store.put(df)
+    second = store.put(frame(seed=1000))
+    store.get(first)
+    third = store.put(frame(seed=2000))
+
+    # The second was used least recently.
+    assert len(os.listdir(tmp_path)) == 1
+    pd.testing.assert_frame_equal(store.get(second), frame(seed=1000))
+    assert store.get(third)["id"].iloc[0] == 2000
+
+
+def test_drop_removes_the_spilled_file(tmp_path):
+    df = frame()
+    store = DatasetStore(memory_limit=nbytes(df), spill_dir=str(tmp_path))
+    first = store.put(df)
+    store.put(frame(seed=1000))
+    assert len(os.listdir(tmp_path)) == 1
+
+    store.drop(first)
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(KeyError):
+        store.get(first)
+    with pytest.raises(KeyError):
+        store.digest(first)
+
+
+def test_oldest_spilled_datasets_are_dropped_beyond_the_disk_limit(tmp_path):
+    df = frame()
+    store = DatasetStore(
+        memory_limit=nbytes(df), disk_limit=nbytes(df), spill_dir=str(tmp_path)
+    )
+    first = store.put(df)
+    second = store.put(frame(seed=1000))
+    store.put(frame(seed=2000))
+    # Spilling the second pushed the first off the disk.
+    store.put(frame(seed=3000))
+
+    with pytest.raises(KeyError):
+        store.get(first)
+    assert store.get(second)["id"].iloc[0] == 1000
+
+
+def test_failed_spill_keeps_the_frame(tmp_path, monkeypatch):
+    df = frame()
+    store = DatasetStore(memory_limit=nbytes(df), spill_dir=str(tmp_path))
+    first = store.put(df)
+
+    def full_disk(frame, path):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(datasets, "_write_spill", full_disk)
+    # The new dataset is stored even though the old one cannot be spilled.
+    second = store.put(frame(seed=1000))
+    assert store.get(second)["id"].iloc[0] == 1000
+    assert store.get(first) is df
+
+    # The spill is retried once the disk works again.
+    monkeypatch.undo()
+    store.put(frame(seed=2000))
+    assert len(os.listdir(tmp_path)) == 2
+    pd.testing.assert_frame_equal(store.get(first), df)
@@ -0,0 +1,104 @@
+"""Tests of the restricted dataset queries."""
+
+import pandas as pd
+import pytest
+
+from chat.backend.query import MAX_RESULT_ROWS, parse_query, run_query
+
+
+@pytest.fixture(params=["frame", "parquet"])
+def data(request, tmp_path):
+    """Sales rows, in memory or as a Parquet file."""
+    df = pd.DataFrame(
+        {
+            "region": ["EU", "US", "EU", "APAC", "US", "EU"],
+            "year": [2019, 2020, 2021, 2021, 2022, 2022],
+            "sales": [10.0, 20.0, 30.0, 40.0, 50.0, None],
+            "product": ["tea", "coffee", "green tea", "tea", "coffee", "tea"],
+        }
+    )
+    if request.param == "frame":
+        return None, df
+    path = tmp_path / "sales.parquet"
+    df.to_parquet(path)
+    return (str(path), "parquet"), None
+
+
+def query(data, **query) -> pd.DataFrame:
+    source, frame = data
+    return run_query(query, source, frame)
+
+
+def test_select_where_and_limit(data):
+    result = query(
+        data,
+        select=["region", "sales"],
+        where=[["year", ">=", 2021], ["region", "in", ["EU", "US"]]],
+        limit=2,
+    )
+    assert list(result.columns) == ["region", "sales"]
+    assert result.to_dict("list") == {"region": ["EU", "US"], "sales": [30.0, 50.0]}
+
+
+def test_other_operators(data):
+    assert len(query(data, where=[["region", "not in", ["EU"]]])) == 3
+    assert len(query(data, where=[["product", "contains", "tea"]])) == 4
+    assert len(query(data, where=[["sales", "is null"]])) == 1
+    assert len(query(data, where=[["sales", "not null"]])) == 5
+
+
+def test_group_by_and_order_by(data):
+    result = query(
+        data,
+        group_by=["region"],
+        aggregate=[["sales", "sum"], ["*", "count"]],
+        order_by=[["sales_sum", "desc"]],
+    )
+    assert result.to_dict("list") == {
+        "region": ["US", "EU", "APAC"],
+        "sales_sum": [70.0, 40.0, 40.0],
+        "count": [2, 3, 1],
+    }
+
+
+def test_aggregate_with_filter(data):
+    result = query(data, where=[["year", ">", 2020]], aggregate=[["sales", "max"]])
+    assert result.to_dict("list") == {"sales_max": [50.0]}
+
+
+@pytest.mark.parametrize(
+    "invalid",
+    [
+        {"limit": 0},
+        {"limit": -1},
+        {"limit": MAX_RESULT_ROWS + 1},
+        {"limit": 2.5},
+        {"limit": "10"},
+        {"limit": True},
+        {"where": {"year": 2020}},
+        {"where": ["year"]},
+        {"where": [["year"]]},
+        {"where": [["year", ">"]]},
+        {"where": [["year", ">", 1, 2]]},
+        {"where": [["region", "in", "EU"]]},
+        {"where": [["region", "like", "E%"]]},
+        {"where": [["country", "==", "EU"]]},
+        {"select": ["country"]},
+        {"select": "region"},
+        {"aggregate": [["sales", "median"]]},
+        {"aggregate": [["*", "sum"]]},
+        {"order_by": [["country", "asc"]]},
+    ],
+)
+def test_invalid_queries_are_rejected(data, invalid):
+    with pytest.raises(ValueError):
+        query(data, **invalid)
+
+
+def test_parse_query():
+    reply = 'Here it is:\n```json\n{"select": ["region"], "limit": 5}\n```'
+    assert parse_query(reply) == {"select": ["region"], "limit": 5}
+    with pytest.raises(ValueError):
+        parse_query("I cannot answer that.")
+    with pytest.raises(ValueError):
+        parse_query("{not json}")
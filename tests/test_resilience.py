@@ -0,0 +1,116 @@
+"""Tests of retries, circuit breaking and hedging of LLM calls."""
+
+import asyncio
+import time
+
+import pytest
+
+from chat.backend.llm import FakeBackend, LLMClient
+from chat.backend.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Resilience,
+    TransientError,
+)
+
+# With these seeds and rates, the first call fails (or is slow) and the
+# second one is fine.
+FAIL_FIRST_SEED = 1
+SLOW_FIRST_SEED = 9
+
+
+def make_client(backend: FakeBackend, **policy) -> tuple[LLMClient, Resilience]:
+    policy.setdefault("backoff_base", 0)
+    resilience = Resilience("test", **policy)
+    return LLMClient(backend, max_concurrency=4, resilience=resilience), resilience
+
+
+def answer(prompt: str) -> str:
+    return FakeBackend(latency=0, chunk_delay=0).generate("model", prompt)
+
+
+async def collect(client: LLMClient, prompt: str) -> str:
+    return "".join([text async for text in client.stream(prompt, model="model")])
+
+
+def test_stream_is_retried_before_the_first_chunk():
+    backend = FakeBackend(
+        latency=0, chunk_delay=0, failure_rate=0.5, seed=FAIL_FIRST_SEED
+    )
+    client, resilience = make_client(backend)
+
+    assert asyncio.run(collect(client, "Hello?")) == answer("Hello?")
+    assert resilience.counters["attempts"] == 2
+    assert resilience.counters["failures"] == 1
+    assert resilience.counters["retries"] == 1
+    assert resilience.breaker.state == "closed"
+
+
+def test_retries_give_up_with_the_error():
+    backend = FakeBackend(latency=0, chunk_delay=0, failure_rate=1, seed=0)
+    client, resilience = make_client(backend, retries=2)
+
+    with pytest.raises(TransientError):
+        asyncio.run(client.generate("Hello?", model="model"))
+    assert resilience.counters["attempts"] == 3
+
+
+def test_breaker_opens_and_lets_one_probe_through():
+    backend = FakeBackend(latency=0, chunk_delay=0, failure_rate=1, seed=0)
+    breaker = CircuitBreaker(threshold=2, reset_after=0.1)
+    client, resilience = make_client(backend, retries=0, breaker=breaker)
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(TransientError):
+                await collect(client, "Hello?")
+        assert breaker.state == "open"
+        assert resilience.counters["circuit_opened"] == 1
+        # Calls fail fast without reaching the backend.
+        with pytest.raises(CircuitOpenError):
+            await client.generate("Hello?", model="model")
+        assert resilience.counters["short_circuited"] == 1
+
+        # A failed probe opens the circuit again.
+        await asyncio.sleep(0.1)
+        assert breaker.state == "half-open"
+        with pytest.raises(TransientError):
+            await collect(client, "Hello?")
+        assert breaker.state == "open"
+
+        # While a probe is in flight, other calls still fail fast.
+        await asyncio.sleep(0.1)
+        backend.failure_rate = 0
+        backend.latency = 0.05
+        probe = asyncio.create_task(client.generate("Hello?", model="model"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CircuitOpenError):
+            await client.generate("Hello?", model="model")
+        assert await probe == answer("Hello?")
+        assert breaker.state == "closed"
+
+    asyncio.run(main())
+
+
+def test_slow_call_is_hedged():
+    backend = FakeBackend(
+        latency=0.05, chunk_delay=0, slow_rate=0.5, seed=SLOW_FIRST_SEED
+    )
+    client, resilience = make_client(backend, hedge_after=0.1)
+
+    started = time.monotonic()
+    assert asyncio.run(client.generate("Hello?", model="model")) == answer("Hello?")
+    # The duplicate answered before the slow call would have.
+    assert time.monotonic() - started < 0.5
+    assert resilience.counters["hedged"] == 1
+    assert resilience.counters["hedge_wins"] == 1
+
+
+def test_streams_are_not_hedged():
+    backend = FakeBackend(
+        latency=0.05, chunk_delay=0, slow_rate=0.5, seed=SLOW_FIRST_SEED
+    )
+    client, resilience = make_client(backend, hedge_after=0.1)
+
+    assert asyncio.run(collect(client, "Hello?")) == answer("Hello?")
+    assert resilience.counters["hedged"] == 0
@@ -0,0 +1,74 @@
+"""Tests of the fair request scheduler."""
+
+import asyncio
+
+from chat.backend.scheduler import Scheduler, TokenBucket
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(per_minute=60, burst_seconds=2)
+    now = bucket.updated
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.wait_time(now) == 1.0
+    assert bucket.wait_time(now + 0.5) == 0.5
+    assert bucket.wait_time(now + 1) == 0.0
+    assert not bucket.full(now + 1)
+    # It never holds more than its burst.
+    assert bucket.full(now + 60)
+    assert bucket.tokens == 2
+
+
+def test_users_are_served_round_robin():
+    async def main():
+        scheduler = Scheduler(max_concurrency=1, user_concurrency=1)
+        first = scheduler.submit("alice")
+        queued = [scheduler.submit(user) for user in ["alice", "alice", "bob"]]
+        assert first.granted
+        assert not any(ticket.granted for ticket in queued)
+        # Bob is served before Alice's third request.
+        assert [scheduler.position(ticket) for ticket in queued] == [1, 3, 2]
+
+        order = []
+        running = first
+        for _ in queued:
+            scheduler.release(running)
+            running = next(t for t in queued if t.granted and t not in order)
+            order.append(running)
+        assert order == [queued[0], queued[2], queued[1]]
+
+    asyncio.run(main())
+
+
+def test_user_concurrency_leaves_room_for_others():
+    async def main():
+        scheduler = Scheduler(max_concurrency=3, user_concurrency=2)
+        alice = [scheduler.submit("alice") for _ in range(3)]
+        bob = scheduler.submit("bob")
+        assert [ticket.granted for ticket in alice] == [True, True, False]
+        assert bob.granted
+        assert scheduler.stats() == {"active": 3, "waiting": 1, "waiting_users": 1}
+
+        scheduler.release(alice[0])
+        assert alice[2].granted
+
+    asyncio.run(main())
+
+
+def test_user_rate_limit_delays_requests():
+    async def main():
+        scheduler = Scheduler(user_rpm=6)
+        async with scheduler.slot("alice"):
+            pass
+        # The bucket holds a single request, refilled every ten seconds.
+        ticket = scheduler.submit("alice")
+        assert not await scheduler.wait(ticket, timeout=0.05)
+        assert scheduler.submit("bob").granted
+        assert scheduler.position(ticket) == 1
+
+        # An abandoned request leaves the queue.
+        scheduler.release(ticket)
+        assert scheduler.stats()["waiting"] == 0
+        assert ticket.future.cancelled()
+
+    asyncio.run(main())
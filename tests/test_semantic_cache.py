@@ -0,0 +1,64 @@
+"""Tests of the semantic answer cache."""
+
+from chat.backend.retrieval import HashEmbedder
+from chat.backend.semantic_cache import SemanticCache
+
+SCOPE = "model\0system prompt\0"
+
+
+def make_cache() -> SemanticCache:
+    return SemanticCache(threshold=0.9, ttl=60, max_entries=8, embedder=HashEmbedder())
+
+
+def test_answer_depends_on_previous_question():
+    cache = make_cache()
+    bob = cache.key("What is my name?", "My name is Bob\n", SCOPE, "bob:Intro")
+    cache.put(bob, "Your name is Bob.")
+
+    alice = cache.key("What is my name?", "My name is Alice\n", SCOPE, "alice:Intro")
+    assert cache.get(alice) is None
+    # Even with the same previous question, another user's conversation may
+    # differ.
+    other = cache.key("What is my name?", "My name is Bob\n", SCOPE, "alice:Intro")
+    assert cache.get(other) is None
+    assert cache.get(bob) == "Your name is Bob."
+
+
+def test_answer_in_context_is_not_shared_across_chats():
+    cache = make_cache()
+    first = cache.key("What did I ask?", "Define entropy\n", SCOPE, "bob:Physics")
+    cache.put(first, "You asked about entropy in thermodynamics.")
+
+    # The same user asking after the same question in another chat may have
+    # said something else before.
+    other = cache.key("What did I ask?", "Define entropy\n", SCOPE, "bob:Coding")
+    assert cache.get(other) is None
+    assert cache.get(first) == "You asked about entropy in thermodynamics."
+
+
+def test_context_must_match_exactly():
+    cache = make_cache()
+    cache.put(
+        cache.key("What is my name?", "My name is Bob", SCOPE, "bob:Intro"),
+        "Your name is Bob.",
+    )
+    similar = cache.key("What is my name?", "My name is Bobby", SCOPE, "bob:Intro")
+    assert cache.get(similar) is None
+    # Case and whitespace do not matter.
+    same = cache.key("What is my name?", "my  name is BOB ", SCOPE, "bob:Intro")
+    assert cache.get(same) == "Your name is Bob."
+
+
+def test_questions_without_context_are_shared():
+    cache = make_cache()
+    cache.put(
+        cache.key("What is the capital of France?", "\n", SCOPE, "bob:Intro"),
+        "Paris.",
+    )
+    key = cache.key("what is the capital of france", "", SCOPE, "alice:Intro")
+    assert cache.get(key) == "Paris."
+    assert cache.get(cache.key("What is the capital of Spain?", "", SCOPE)) is None
+    other_scope = cache.key(
+        "What is the capital of France?", "", "other", "alice:Intro"
+    )
+    assert cache.get(other_scope) is None